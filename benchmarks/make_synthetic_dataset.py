@@ -0,0 +1,122 @@
+# Generate a synthetic dataset in medical decathlon format, used to benchmark the feature extraction and conversion
+
+import argparse
+import json
+import os
+import numpy as np
+import SimpleITK as sitk
+
+
+def make_volume_pair(rng, shape, dtype, nr_classes, density):
+    """ Creates a synthetic CT volume and a label map with spherical blobs of each class
+    :param rng: numpy random generator
+    :param shape: shape of the volume (z, y, x)
+    :param dtype: dtype of the label map
+    :param nr_classes: number of non-zero label classes
+    :param density: number of blobs per 10^6 voxels
+    :return: image (int16, HU) and label map
+    """
+    image = rng.normal(-700, 200, shape).astype(np.int16)
+    labels = np.zeros(shape, dtype=dtype)
+
+    nr_blobs = max(1, int(density * np.prod(shape) / 1e6))
+    centers = rng.uniform(0, 1, (nr_blobs, 3)) * np.array(shape)
+    radii = rng.uniform(1, max(2, min(shape) / 10), nr_blobs)
+    classes = rng.integers(1, nr_classes + 1, nr_blobs)
+    for center, radius, cls in zip(centers, radii, classes):
+        # only the bounding box of the blob is touched
+        lower = np.maximum(np.floor(center - radius).astype(int), 0)
+        upper = np.minimum(np.ceil(center + radius).astype(int) + 1, shape)
+        grid = np.ogrid[tuple(slice(lo, up) for lo, up in zip(lower, upper))]
+        inside = sum((g - c) ** 2 for g, c in zip(grid, center)) <= radius ** 2
+        box = tuple(slice(lo, up) for lo, up in zip(lower, upper))
+        labels[box][inside] = cls
+        image[box][inside] = rng.normal(-100 + 100 * cls, 50)
+    return image, labels
+
+
+def write_volume(array, path, spacing):
+    img = sitk.GetImageFromArray(array)
+    img.SetSpacing(spacing)
+    sitk.WriteImage(img, path, True)
+
+
+def make_synthetic_dataset(destination, nr_cases=10, shape=(64, 128, 128), dtype="uint8", nr_classes=2, density=50,
+                           nrrd=True, seed=0):
+    """ Creates a synthetic dataset in medical decathlon structure
+    :param destination: directory of the dataset
+    :param nr_cases: number of image/label pairs
+    :param shape: shape of the volumes (z, y, x)
+    :param dtype: dtype of the label maps
+    :param nr_classes: number of non-zero label classes
+    :param density: number of blobs per 10^6 voxels
+    :param nrrd: also store every volume as nrrd file in the nrrd directory
+    :param seed: seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    directories = ["imagesTr", "imagesTs", "labelsTr", "lungLabelsTr"]
+    for directory in directories:
+        os.makedirs(os.path.join(destination, directory), exist_ok=True)
+        if nrrd:
+            os.makedirs(os.path.join(destination, "nrrd", directory), exist_ok=True)
+
+    tr_label_paths = []
+    for case in range(nr_cases):
+        filename = "case_%04d" % case
+        spacing = tuple(float(x) for x in rng.uniform([0.6, 0.6, 1], [0.9, 0.9, 5]))
+        image, labels = make_volume_pair(rng, shape, dtype, nr_classes, density)
+        # the lung mask is split into a left and a right half
+        lung_labels = np.ones(shape, dtype=np.uint8)
+        lung_labels[..., shape[2] // 2:] = 2
+
+        for directory, array in zip(["imagesTr", "labelsTr", "lungLabelsTr"], [image, labels, lung_labels]):
+            write_volume(array, os.path.join(destination, directory, filename + ".nii.gz"), spacing)
+            if nrrd:
+                write_volume(array, os.path.join(destination, "nrrd", directory, filename + ".nrrd"), spacing)
+
+        tr_label_paths.append({
+            "image": os.path.join("./imagesTr", filename + ".nii.gz"),
+            "label": os.path.join("./labelsTr", filename + ".nii.gz"),
+            "lungLabel": os.path.join("./lungLabelsTr", filename + ".nii.gz")
+        })
+
+    data = {
+        "name": "Synthetic",
+        "description": "Synthetic CT volumes with spherical blobs",
+        "modality": {
+            "0": "CT"
+        },
+        "labels": {str(i): "class " + str(i) for i in range(nr_classes + 1)},
+        "numTraining": nr_cases,
+        "numTest": 0,
+        "training": tr_label_paths,
+        "test": []
+    }
+
+    with open(os.path.join(destination, "dataset.json"), 'w') as f:
+        json.dump(data, f, indent=4)
+
+
+def main():
+    # ARGUMENT PARSING
+    parser = argparse.ArgumentParser(description='Generate a synthetic dataset in medical decathlon format')
+
+    parser.add_argument('-o', '--output', type=str, help='directory of the dataset', required=True)
+    parser.add_argument('-n', '--cases', type=int, default=10, help='number of cases (default: 10)')
+    parser.add_argument('-s', '--shape', type=int, nargs=3, default=[64, 128, 128],
+                        help='shape of the volumes as z y x (default: 64 128 128)')
+    parser.add_argument('-d', '--dtype', type=str, default="uint8", help='dtype of the label maps (default: uint8)')
+    parser.add_argument('-c', '--classes', type=int, default=2, help='number of label classes (default: 2)')
+    parser.add_argument('-b', '--density', type=float, default=50,
+                        help='number of blobs per million voxels (default: 50)')
+    parser.add_argument('--no_nrrd', action='store_true', help='do not store the volumes as nrrd files')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator (default: 0)')
+
+    args = parser.parse_args()
+
+    make_synthetic_dataset(args.output, args.cases, tuple(args.shape), args.dtype, args.classes, args.density,
+                           not args.no_nrrd, args.seed)
+
+
+if __name__ == '__main__':
+    main()
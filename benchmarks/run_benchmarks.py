@@ -0,0 +1,252 @@
+# Time the hot paths of the feature extraction and the dataset conversion on a synthetic dataset
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import pathlib
+import queue as queue_module
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from make_synthetic_dataset import make_synthetic_dataset
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+SRC = ROOT / "src"
+
+# make_dataset scripts whose create_json is benchmarked
+CONVERTERS = ["covid19ct_zenodo", "radiopaedia", "mosmed", "imagenglab"]
+
+
+def setup_path():
+    """Makes the modules in src importable, like when the scripts are run directly"""
+    for path in [str(SRC), str(SRC / "features")]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def load_converter(name):
+    """ Imports the make_dataset.py script of a dataset
+    :param name: name of the dataset directory in src/data/covid19
+    :return: the Converter declared in the script
+    """
+    import data
+    spec = importlib.util.spec_from_file_location("make_dataset_" + name, SRC / "data/covid19" / name / "make_dataset.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return next(value for value in vars(module).values()
+                if isinstance(value, type) and issubclass(value, data.Converter) and value is not data.Converter)()
+
+
+def count_voxels(paths):
+    import SimpleITK as sitk
+    voxels = 0
+    for path in paths:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(path))
+        reader.ReadImageInformation()
+        size = reader.GetSize()
+        voxels += size[0] * size[1] * size[2]
+    return voxels
+
+
+def bench_extract_features(dataset, scratch, options):
+    import extract_features
+    sys.argv = ["extract_features.py", "-p", dataset, "-w", str(options["workers"])]
+    with contextlib.redirect_stdout(io.StringIO()):
+        extract_features.main()
+    labels = sorted((pathlib.Path(dataset) / "labelsTr").iterdir())
+    return len(labels), count_voxels(labels)
+
+
+def bench_connected_components(dataset, scratch, options):
+    import SimpleITK as sitk
+    import extract_features
+    labels = [sitk.GetArrayFromImage(sitk.ReadImage(str(path)))
+              for path in sorted((pathlib.Path(dataset) / "labelsTr").iterdir())]
+    # only the labeling is timed, not the decoding
+    start = time.perf_counter()
+    for array in labels:
+        extract_features.connected_components(array, 1)
+    return len(labels), sum(array.size for array in labels), time.perf_counter() - start
+
+
+def bench_nrrd_to_nifti(dataset, scratch, options):
+    import data
+    sources = sorted((pathlib.Path(dataset) / "nrrd" / "imagesTr").iterdir())
+    for source in sources:
+        data.nrrd_to_nifti(str(source), os.path.join(scratch, source.stem + ".nii.gz"))
+    return len(sources), count_voxels(sources)
+
+
+def bench_move_files(dataset, scratch, options):
+    import data
+    # move a copy of the images to the scratch directory and back
+    source = os.path.join(scratch, "source")
+    destination = os.path.join(scratch, "destination")
+    shutil.copytree(os.path.join(dataset, "imagesTr"), source)
+    os.makedirs(destination)
+    start = time.perf_counter()
+    data.move_files(source, destination)
+    data.move_files(destination, source)
+    files = sorted(pathlib.Path(source).iterdir())
+    return len(files), count_voxels(files), time.perf_counter() - start
+
+
+def bench_create_json(name):
+    def bench(dataset, scratch, options):
+        # create_json only lists the directories, so empty files with the same names are sufficient
+        for directory in ["imagesTr", "imagesTs", "labelsTr", "lungLabelsTr"]:
+            os.makedirs(os.path.join(scratch, directory))
+            for filename in os.listdir(os.path.join(dataset, directory)):
+                open(os.path.join(scratch, directory, filename), 'w').close()
+        import data
+        converter = load_converter(name)
+        start = time.perf_counter()
+        for _ in range(options["json_repeat"]):
+            data.create_json(scratch, converter)
+        nr_cases = len(os.listdir(os.path.join(scratch, "imagesTr")))
+        return nr_cases * options["json_repeat"], 0, time.perf_counter() - start
+    return bench
+
+
+BENCHMARKS = {
+    "extract_features.main": bench_extract_features,
+    "connected_components": bench_connected_components,
+    "nrrd_to_nifti": bench_nrrd_to_nifti,
+    "move_files": bench_move_files,
+}
+BENCHMARKS.update({"create_json[" + name + "]": bench_create_json(name) for name in CONVERTERS})
+
+
+def run_child(queue, name, dataset, options):
+    """Runs one benchmark in a fresh process, so that its peak memory is measured in isolation"""
+    setup_path()
+    scratch = tempfile.mkdtemp()
+    try:
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = BENCHMARKS[name](dataset, scratch, options)
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        nr_cases, voxels = result[:2]
+        # some benchmarks only time their hot loop and exclude the setup
+        if len(result) > 2:
+            wall = result[2]
+        # ru_maxrss is in kB on Linux
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+        queue.put({"wall_time": wall, "cpu_time": cpu, "cases": nr_cases, "voxels": voxels,
+                   "cases_per_second": nr_cases / wall if wall > 0 else None,
+                   "voxels_per_second": voxels / wall if wall > 0 else None,
+                   "peak_rss_mb": peak_rss / 2 ** 20})
+    except Exception:
+        # the parent waits for a result, so the error is sent instead
+        queue.put({"error": traceback.format_exc()})
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def run_benchmark(name, dataset, options, repeat):
+    """ Runs a benchmark several times, each in a fresh process
+    :return: the result of the fastest run, and the wall times of all runs
+    """
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        queue = context.Queue()
+        process = context.Process(target=run_child, args=(queue, name, dataset, options))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=1)
+            except queue_module.Empty:
+                # a child that crashed (e.g. killed for its memory) never sends a result
+                if not process.is_alive():
+                    try:
+                        result = queue.get(timeout=1)
+                    except queue_module.Empty:
+                        raise RuntimeError("benchmark %s exited with code %s without a result"
+                                           % (name, process.exitcode))
+        process.join()
+        if "error" in result:
+            raise RuntimeError("benchmark %s failed:\n%s" % (name, result["error"]))
+        runs.append(result)
+    best = min(runs, key=lambda run: run["wall_time"])
+    best["wall_times"] = [run["wall_time"] for run in runs]
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    # ARGUMENT PARSING
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on a synthetic dataset')
+
+    parser.add_argument('-o', '--output', type=str, help='json file to store the results', required=True)
+    parser.add_argument('-p', '--path', type=str,
+                        help='existing synthetic dataset, a temporary one is generated if not given')
+    parser.add_argument('-n', '--cases', type=int, default=10, help='number of generated cases (default: 10)')
+    parser.add_argument('-s', '--shape', type=int, nargs=3, default=[64, 128, 128],
+                        help='shape of the generated volumes as z y x (default: 64 128 128)')
+    parser.add_argument('-d', '--dtype', type=str, default="uint8", help='dtype of the label maps (default: uint8)')
+    parser.add_argument('-c', '--classes', type=int, default=2, help='number of label classes (default: 2)')
+    parser.add_argument('-b', '--density', type=float, default=50,
+                        help='number of blobs per million voxels (default: 50)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='workers of extract_features.main (default: 1)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per benchmark, the fastest counts (default: 3)')
+    parser.add_argument('-k', '--benchmarks', type=str, nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--baseline', type=str, help='results of an earlier run to compare against')
+
+    args = parser.parse_args()
+
+    parameters = {"cases": args.cases, "shape": args.shape, "dtype": args.dtype, "classes": args.classes,
+                  "density": args.density, "workers": args.workers}
+    options = {"workers": args.workers, "json_repeat": 100}
+
+    tmp_dir = None
+    dataset = args.path
+    if dataset is None:
+        tmp_dir = tempfile.mkdtemp()
+        dataset = os.path.join(tmp_dir, "synthetic")
+        make_synthetic_dataset(dataset, args.cases, tuple(args.shape), args.dtype, args.classes, args.density)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+
+    results = {}
+    try:
+        for name in args.benchmarks:
+            results[name] = run_benchmark(name, dataset, options, args.repeat)
+            result = results[name]
+            line = "%-32s %9.3f s  %9.1f cases/s  %6.0f MB" % (name, result["wall_time"], result["cases_per_second"],
+                                                                  result["peak_rss_mb"])
+            if name in baseline:
+                line += "  (%.2fx of baseline)" % (baseline[name]["wall_time"] / result["wall_time"])
+            print(line)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "parameters": parameters,
+                   "benchmarks": results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+from .utils import move_files, nrrd_to_nifti, nrrd_to_nifti_batch
+from .transfer import TRANSFER_MODES, copy_file, transfer_file, transfer_files
+from .manifest import MANIFEST_FILE, DatasetManifest, load_manifest, read_header
+from .dataset import ArrayCache, Case, DecathlonDataset
+from .converter import Converter, add_build_arguments, build_dataset, create_json, default_data_root
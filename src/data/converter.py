@@ -0,0 +1,174 @@
+import json
+import os
+import pathlib
+from .manifest import load_manifest
+from .transfer import TRANSFER_MODES, transfer_files
+from .utils import nrrd_to_nifti_batch
+
+# key of each directory in the training entries of dataset.json
+JSON_KEYS = {"imagesTr": "image", "labelsTr": "label", "lungLabelsTr": "lungLabel"}
+
+# journal of the finished format conversions, stored in the destination directory
+JOURNAL_FILE = "conversion_journal.jsonl"
+
+
+def default_data_root():
+    """ Returns the data directory of the repository, next to src """
+    return str(pathlib.Path(__file__).resolve().parents[2] / "data")
+
+
+class Converter:
+    """Declaration of a dataset: its destination name, its dataset.json metadata and how its source files are found.
+    A new dataset only overrides these, build_dataset() creates the structure.
+    """
+
+    # name of the directory of the dataset in the data directory, e.g. "01_covid19ct_zenodo"
+    name = None
+    # directories of the medical decathlon structure, the training pairs are formed from all but imagesTs
+    directories = ("imagesTr", "imagesTs", "labelsTr")
+    # content of dataset.json, without the numbers of cases and the lists of training and test cases
+    metadata = {}
+
+    def discover(self, **sources):
+        """ Finds the source files of the dataset
+        :param sources: paths given on the command line, e.g. image_path and label_path
+        :return: list of (source file, destination directory, destination file name)
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def files(source_path, directory, suffix=".nii.gz"):
+        """ Lists the files of a source directory that keep their name
+        :param source_path: directory of the downloaded files
+        :param directory: destination directory, e.g. "imagesTr"
+        :param suffix: (default=".nii.gz") only files with this suffix are listed
+        :return: list of (source file, destination directory, destination file name)
+        """
+        return [(os.path.join(source_path, filename), directory, filename)
+                for filename in sorted(os.listdir(source_path)) if filename.endswith(suffix)]
+
+
+def _suffix(path):
+    return "".join(pathlib.PurePath(path).suffixes[-2:]) if path.endswith(".gz") else pathlib.PurePath(path).suffix
+
+
+def is_up_to_date(source, destination, mode="move"):
+    """ Checks if a file was already transferred by a previous build
+    :param source: path to the source file
+    :param destination: path to the destination file
+    :param mode: (default="move") transfer mode of the build, see TRANSFER_MODES
+    :return: True if the destination holds the current source. A moved source no longer exists, then the
+        destination is up to date if it exists
+    """
+    if not os.path.lexists(destination):
+        return False
+    if not os.path.exists(source):
+        return os.path.exists(destination)
+    if mode == "symlink":
+        return os.path.islink(destination) and os.path.realpath(destination) == os.path.realpath(source)
+    source_stat, destination_stat = os.stat(source), os.stat(destination)
+    return os.path.samefile(source, destination) or (source_stat.st_size == destination_stat.st_size and
+                                                     destination_stat.st_mtime_ns >= source_stat.st_mtime_ns)
+
+
+def create_json(destination, converter):
+    """ Creates the json file for the medical decathlon directory from the index of its directories. The file is
+    replaced atomically, and is not touched at all if its content did not change
+    :param destination: directory of the medical decathlon dir
+    :param converter: Converter of the dataset
+    :return: True if dataset.json was written
+    """
+    json_file = os.path.join(destination, "dataset.json")
+
+    # index of the dataset directories, only new or changed files are scanned again
+    manifest = load_manifest(destination)
+
+    training_directories = [directory for directory in converter.directories if directory != "imagesTs"]
+    training = []
+    for filenames in manifest.pairs(training_directories):
+        training.append({JSON_KEYS[directory]: os.path.join(".", directory, filename)
+                         for directory, filename in zip(training_directories, filenames)})
+
+    data = dict(converter.metadata)
+    data.update({
+        "numTraining": len(manifest.files("imagesTr")),
+        "numTest": len(manifest.files("imagesTs")),
+        "training": training,
+        "test": [os.path.join("./imagesTs", filename) for filename in manifest.files("imagesTs")],
+    })
+    content = json.dumps(data, indent=4)
+
+    if os.path.exists(json_file):
+        with open(json_file) as f:
+            if f.read() == content:
+                return False
+    with open(json_file + ".tmp", 'w') as f:
+        f.write(content)
+    os.replace(json_file + ".tmp", json_file)
+    return True
+
+
+def build_dataset(converter, destination=None, mode="move", workers=1, verify="size", compression_level=-1,
+                  use_processes=False, **sources):
+    """ Creates or updates the medical decathlon structure of a dataset. Files are transferred or, if their format
+    changes (e.g. nrrd to nifti), converted on a pool of workers. Files that are already up to date are skipped, so
+    building an unchanged dataset again does nothing
+    :param converter: Converter of the dataset
+    :param destination: (optional) directory of the dataset, the converter's directory in the data directory of the
+        repository by default
+    :param mode: (default="move") how the files are transferred, see TRANSFER_MODES
+    :param workers: (default=1) number of files that are transferred or converted in parallel
+    :param verify: (default="size") verification of copied files, "size" or "checksum"
+    :param compression_level: (default=-1) gzip compression level of converted nifti files from 0 to 9
+    :param use_processes: (default=False) convert on a process pool instead of a thread pool
+    :param sources: paths to the downloaded files, passed to the discovery of the converter
+    :return: path to the dataset directory
+    """
+    if destination is None:
+        destination = os.path.join(default_data_root(), converter.name)
+    for directory in converter.directories:
+        os.makedirs(os.path.join(destination, directory), exist_ok=True)
+
+    transfers = []
+    conversions = []
+    up_to_date = 0
+    for source, directory, filename in converter.discover(**sources):
+        target = os.path.join(destination, directory, filename)
+        if _suffix(source) != _suffix(target):
+            conversions.append((source, target))
+        elif is_up_to_date(source, target, mode):
+            up_to_date += 1
+        elif not os.path.exists(source):
+            raise FileNotFoundError(source)
+        else:
+            transfers.append((source, target))
+
+    if transfers or up_to_date:
+        print(up_to_date, "of", up_to_date + len(transfers), "files are already transferred")
+    transfer_files(transfers, mode, workers, verify)
+    if conversions:
+        # the journal skips the conversions that were finished by a previous build
+        nrrd_to_nifti_batch([source for source, _ in conversions], [target for _, target in conversions], workers,
+                            compression_level, os.path.join(destination, JOURNAL_FILE), use_processes)
+
+    if create_json(destination, converter):
+        print("dataset.json written")
+    return destination
+
+
+def add_build_arguments(parser, transfer=True):
+    """ Adds the options of build_dataset() to the argument parser of a make_dataset.py script
+    :param parser: argparse.ArgumentParser of the script
+    :param transfer: (default=True) add the options of the file transfer (mode and verification)
+    """
+    parser.add_argument('-d', '--destination', type=str,
+                        help='directory of the dataset (default: the directory of the dataset in the data directory '
+                             'of the repository)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of files that are transferred or converted in parallel (default: 1)')
+    if transfer:
+        parser.add_argument('-m', '--mode', type=str, default="move", choices=TRANSFER_MODES,
+                            help='how the files are transferred, files that cannot be renamed or linked (e.g. across '
+                                 'filesystems) are copied and verified (default: move)')
+        parser.add_argument('--verify', type=str, default="size", choices=["size", "checksum"],
+                            help='verification of copied files (default: size)')
@@ -0,0 +1,227 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import SimpleITK as sitk
+import copy
+import json
+import os
+import threading
+from .manifest import load_manifest
+
+
+class ArrayCache:
+    """Least recently used cache of decoded volumes, bounded by the number of bytes of the cached arrays.
+    The cached arrays are read-only, so a caller cannot change the volume another caller gets from the cache.
+    """
+
+    def __init__(self, max_bytes=2 * 2 ** 30):
+        """
+        :param max_bytes: (default=2GB) maximum number of bytes of all cached arrays
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.arrays = OrderedDict()
+        self.lock = threading.Lock()
+        # paths that are being decoded right now, so that concurrent requests of a volume decode it only once
+        self.loading = {}
+
+    def get(self, path, load):
+        """ Returns the cached array of a path, or loads and caches it
+        :param path: path to the volume, the key of the cache
+        :param load: function that decodes the volume, called with the path if it is not cached
+        :return: the (read-only) array
+        """
+        with self.lock:
+            if path in self.arrays:
+                self.arrays.move_to_end(path)
+                return self.arrays[path]
+            event = self.loading.get(path)
+            if event is None:
+                self.loading[path] = threading.Event()
+        if event is not None:
+            event.wait()
+            return self.get(path, load)
+
+        try:
+            array = load(path)
+            array.setflags(write=False)
+            self.put(path, array)
+        finally:
+            with self.lock:
+                self.loading.pop(path).set()
+        return array
+
+    def put(self, path, array):
+        """ Caches an array and evicts the least recently used arrays until the cache fits into its budget
+        :param path: path to the volume
+        :param array: decoded volume, it is not cached if it alone exceeds the budget
+        """
+        with self.lock:
+            if path in self.arrays:
+                self.nbytes -= self.arrays.pop(path).nbytes
+            if array.nbytes > self.max_bytes:
+                return
+            self.arrays[path] = array
+            self.nbytes += array.nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.arrays.popitem(last=False)[1].nbytes
+
+    def __contains__(self, path):
+        with self.lock:
+            return path in self.arrays
+
+    def clear(self):
+        with self.lock:
+            self.arrays.clear()
+            self.nbytes = 0
+
+
+def read_array(path):
+    """ Decodes a volume
+    :param path: path to the volume
+    :return: voxel data of shape (z, y, x)
+    """
+    return sitk.GetArrayFromImage(sitk.ReadImage(path))
+
+
+class Case:
+    """Lazy handle of one case of a dataset. The header metadata is available right away, the voxel data is only
+    decoded when image, label or lung_label is accessed, and is then kept in the cache of the dataset.
+    """
+
+    def __init__(self, dataset, index, image_file, label_file=None, lung_label_file=None):
+        self.dataset = dataset
+        self.index = index
+        self.image_file = image_file
+        self.label_file = label_file
+        self.lung_label_file = lung_label_file
+
+    @property
+    def header(self):
+        """Header metadata of the image: spacing, size, origin, direction and dtype"""
+        return self.dataset.manifest.header(os.path.relpath(self.image_file, self.dataset.root))
+
+    @property
+    def label_header(self):
+        """Header metadata of the label map, None for test cases"""
+        if self.label_file is None:
+            return None
+        return self.dataset.manifest.header(os.path.relpath(self.label_file, self.dataset.root))
+
+    @property
+    def spacing(self):
+        """Voxel spacing of the image in (x, y, z) order"""
+        return tuple(self.header["spacing"])
+
+    @property
+    def image(self):
+        """Voxel data of the image, shape (z, y, x)"""
+        return self.dataset.cache.get(self.image_file, read_array)
+
+    @property
+    def label(self):
+        """Voxel data of the label map, shape (z, y, x), None for test cases"""
+        return self.dataset.cache.get(self.label_file, read_array) if self.label_file is not None else None
+
+    @property
+    def lung_label(self):
+        """Voxel data of the lung mask, None if the dataset has none"""
+        if self.lung_label_file is None:
+            return None
+        return self.dataset.cache.get(self.lung_label_file, read_array)
+
+    def files(self):
+        """ Paths of all volumes of the case
+        :return: list of the existing image, label and lung mask paths
+        """
+        return [path for path in (self.image_file, self.label_file, self.lung_label_file) if path is not None]
+
+    def load(self):
+        """ Decodes all volumes of the case into the cache """
+        for path in self.files():
+            self.dataset.cache.get(path, read_array)
+
+    def __repr__(self):
+        return "Case(%d, %s)" % (self.index, os.path.basename(self.image_file))
+
+
+class DecathlonDataset:
+    """Dataset in medical decathlon structure, built on its dataset.json.
+    Indexing returns a lazy Case, slicing a DecathlonDataset with a subset of the cases that shares the cache.
+    Iterating decodes the next cases on background threads, while the current one is processed.
+    """
+
+    def __init__(self, root, split="training", cache_bytes=2 * 2 ** 30, prefetch=2, cache=None):
+        """
+        :param root: directory of the dataset
+        :param split: (default="training") "training" or "test" section of dataset.json
+        :param cache_bytes: (default=2GB) budget of the cache of decoded volumes
+        :param prefetch: (default=2) number of cases that are decoded ahead while iterating, 0 to disable
+        :param cache: (optional) ArrayCache to share with other datasets, cache_bytes is ignored then
+        """
+        self.root = root
+        self.prefetch = prefetch
+        self.cache = cache if cache is not None else ArrayCache(cache_bytes)
+        self.manifest = load_manifest(root)
+
+        with open(os.path.join(root, "dataset.json")) as f:
+            self.info = json.load(f)
+
+        def resolve(path):
+            return os.path.normpath(os.path.join(root, path)) if path is not None else None
+
+        self.cases = []
+        for index, entry in enumerate(self.info.get(split, [])):
+            # the test section lists only the image paths
+            if isinstance(entry, str):
+                entry = {"image": entry}
+            self.cases.append(Case(self, index, resolve(entry["image"]), resolve(entry.get("label")),
+                                   resolve(entry.get("lungLabel"))))
+
+    @property
+    def name(self):
+        return self.info.get("name", os.path.basename(os.path.normpath(self.root)))
+
+    @property
+    def labels(self):
+        return self.info.get("labels", {})
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            subset = copy.copy(self)
+            subset.cases = self.cases[item]
+            return subset
+        return self.cases[item]
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, prefetch=None, cached_first=False):
+        """ Iterates over the cases, while the next cases are decoded on background threads
+        :param prefetch: (optional) number of cases decoded ahead, the prefetch of the dataset by default
+        :param cached_first: (default=False) yield the cases whose volumes are all cached first, so that they are
+            processed before the prefetching evicts them
+        :return: generator of the cases
+        """
+        prefetch = self.prefetch if prefetch is None else prefetch
+        cases = self.cases
+        if cached_first:
+            cached = [all(path in self.cache for path in case.files()) for case in cases]
+            cases = [case for case, c in zip(cases, cached) if c] + [case for case, c in zip(cases, cached) if not c]
+        if prefetch <= 0:
+            yield from cases
+            return
+
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            futures = {}
+            for i, case in enumerate(cases):
+                for j in range(i + 1, min(i + 1 + prefetch, len(cases))):
+                    if j not in futures:
+                        futures[j] = executor.submit(cases[j].load)
+                # errors of the prefetching are raised when the case is accessed
+                futures.pop(i, None)
+                yield case
+            for future in futures.values():
+                future.cancel()
@@ -0,0 +1,183 @@
+from concurrent.futures import ThreadPoolExecutor
+import SimpleITK as sitk
+import json
+import os
+from .transfer import file_checksum
+
+# index of a dataset, stored next to its dataset.json
+MANIFEST_FILE = "dataset_index.json"
+
+# directories of the medical decathlon structure that are indexed
+DIRECTORIES = ["imagesTr", "labelsTr", "lungLabelsTr", "imagesTs"]
+
+
+def read_header(path):
+    """ Reads the header metadata of an image file, without decoding its voxel data
+    :param path: path to the image
+    :return: dict with spacing, size, origin, direction and dtype of the image
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return {
+        "spacing": list(reader.GetSpacing()),
+        "size": list(reader.GetSize()),
+        "origin": list(reader.GetOrigin()),
+        "direction": list(reader.GetDirection()),
+        "dtype": sitk.GetPixelIDValueAsString(reader.GetPixelID()),
+    }
+
+
+class DatasetManifest:
+    """Index of the files of a dataset in medical decathlon structure.
+    Every file is recorded with its size and modification time, and on request with its header metadata and sha256.
+    An update scans each directory once with os.scandir and only reads the headers (or contents) of files that are
+    new or have changed since the last update, so pairing and metadata queries do not touch the files again.
+    """
+
+    def __init__(self, root, path=None):
+        """
+        :param root: directory of the dataset
+        :param path: (optional) path to the index file, MANIFEST_FILE in the dataset directory by default
+        """
+        self.root = root
+        self.path = path if path is not None else os.path.join(root, MANIFEST_FILE)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)["files"]
+        self.changed = False
+
+    def update(self, headers=True, checksums=False, workers=1):
+        """ Brings the index up to date with the directories of the dataset
+        :param headers: (default=True) read the header metadata of new and changed files
+        :param checksums: (default=False) compute the sha256 of new and changed files
+        :param workers: (default=1) number of files whose header or checksum is read in parallel
+        :return: number of files whose header or checksum was read
+        """
+        entries = {}
+        for directory in DIRECTORIES:
+            directory_path = os.path.join(self.root, directory)
+            if not os.path.isdir(directory_path):
+                continue
+            with os.scandir(directory_path) as it:
+                for dir_entry in it:
+                    if not dir_entry.is_file():
+                        continue
+                    stat = dir_entry.stat()
+                    key = directory + "/" + dir_entry.name
+                    entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+                    previous = self.entries.get(key)
+                    if previous is not None and (previous["size"], previous["mtime"]) == (entry["size"],
+                                                                                         entry["mtime"]):
+                        entry = previous
+                    entries[key] = entry
+        self.changed = self.changed or entries.keys() != self.entries.keys() or \
+            any(entries[key] is not self.entries[key] for key in entries)
+        self.entries = entries
+
+        todo = [key for key, entry in entries.items()
+                if headers and "header" not in entry or checksums and "sha256" not in entry]
+
+        def index_file(key):
+            entry = self.entries[key]
+            file_path = os.path.join(self.root, key)
+            if headers and "header" not in entry:
+                try:
+                    entry["header"] = read_header(file_path)
+                except RuntimeError:
+                    # not an image, e.g. a readme that was downloaded with the data
+                    entry["header"] = None
+            if checksums and "sha256" not in entry:
+                entry["sha256"] = file_checksum(file_path)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(index_file, todo))
+        self.changed = self.changed or len(todo) > 0
+        return len(todo)
+
+    def save(self):
+        """ Writes the index, if it changed. The file is replaced atomically, so readers never see a partial index """
+        if not self.changed:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({"files": self.entries}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # e.g. a read-only or shared dataset mount, the index is kept in memory
+            print("The index of the dataset could not be written to", self.path, "(%s)" % e.strerror)
+            return
+        self.changed = False
+
+    def files(self, directory):
+        """ Lists the files of a directory of the dataset
+        :param directory: name of the directory, e.g. "imagesTr"
+        :return: sorted list of file names
+        """
+        prefix = directory + "/"
+        return sorted(key[len(prefix):] for key in self.entries if key.startswith(prefix))
+
+    def pairs(self, directories=("imagesTr", "labelsTr")):
+        """ Pairs the files of several directories by their sorted order, like the cases of a decathlon dataset
+        :param directories: (default=("imagesTr", "labelsTr")) names of the directories
+        :return: list of tuples of file names, one per NIfTI file of the first directory
+        """
+        return [names for names in zip(*[self.files(directory) for directory in directories])
+                if names[0].endswith(".nii.gz")]
+
+    def entry(self, path):
+        """ Looks up the index entry of a file
+        :param path: path to the file, absolute or relative to the dataset directory (e.g. "./imagesTr/case.nii.gz")
+        :return: dict with size, mtime and, if indexed, header and sha256. None if the file is not in the index
+        """
+        return self.entries.get(self.key(path))
+
+    def key(self, path):
+        """ Key of a file in the index
+        :param path: path to the file, absolute, relative to the working directory (e.g. "dataset/imagesTr/case.nii.gz"
+            for the root "dataset") or relative to the dataset directory (e.g. "./imagesTr/case.nii.gz")
+        :return: path relative to the dataset directory, with "/" as separator
+        """
+        root = os.path.abspath(self.root)
+        candidates = [os.path.abspath(path)]
+        if not os.path.isabs(path):
+            candidates.append(os.path.normpath(os.path.join(root, path)))
+        keys = [os.path.relpath(candidate, root).replace(os.sep, "/") for candidate in candidates]
+        # a path that is indexed or exists wins, the dataset directory may be relative to the working directory
+        for key in keys:
+            if key in self.entries:
+                return key
+        for key, candidate in zip(keys, candidates):
+            if os.path.exists(candidate):
+                return key
+        return keys[-1]
+
+    def header(self, path):
+        """ Header metadata of a file, read from the file only if it is not indexed yet
+        :param path: path to the file, absolute or relative to the dataset directory
+        :return: dict with spacing, size, origin, direction and dtype, see read_header
+        """
+        entry = self.entry(path)
+        if entry is not None and entry.get("header") is not None:
+            return entry["header"]
+        header = read_header(os.path.join(self.root, self.key(path)))
+        if entry is not None:
+            entry["header"] = header
+            self.changed = True
+        return header
+
+
+def load_manifest(root, headers=True, checksums=False, workers=1):
+    """ Loads the index of a dataset, updates it and stores it again
+    :param root: directory of the dataset
+    :param headers: (default=True) read the header metadata of new and changed files
+    :param checksums: (default=False) compute the sha256 of new and changed files
+    :param workers: (default=1) number of files whose header or checksum is read in parallel
+    :return: the up to date DatasetManifest
+    """
+    manifest = DatasetManifest(root)
+    manifest.update(headers, checksums, workers)
+    manifest.save()
+    return manifest
@@ -0,0 +1,157 @@
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import hashlib
+import os
+import shutil
+
+# supported ways of transferring a file into the dataset directory
+TRANSFER_MODES = ["move", "copy", "hardlink", "reflink", "symlink"]
+
+# ioctl request to clone a file on copy-on-write filesystems (btrfs, xfs), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# errors after which a rename or link is retried as copy, e.g. across filesystems
+FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK}
+
+
+def file_checksum(path, chunk_size=2 ** 24):
+    """ Computes the sha256 of a file with large sequential reads
+    :param path: path to the file
+    :param chunk_size: number of bytes read at once
+    :return: hex digest of the file content
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _copy_range(source_fd, destination_fd, offset, count):
+    """ Copies a byte range between two open files, in the kernel if possible """
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                count -= copied
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    while count > 0:
+        chunk = os.pread(source_fd, min(count, 2 ** 24), offset)
+        if not chunk:
+            break
+        os.pwrite(destination_fd, chunk, offset)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+def copy_file(source, destination, workers=4, chunk_size=2 ** 26, verify="size"):
+    """ Copies a file in parallel chunks and verifies the copy before it becomes visible under its final name
+    :param source: path to the source file
+    :param destination: path of the copy
+    :param workers: (default=4) number of chunks that are copied in parallel
+    :param chunk_size: (default=64MB) size of the chunks
+    :param verify: (default="size") "size" compares the file sizes, "checksum" additionally the sha256 of the contents
+    """
+    size = os.path.getsize(source)
+    partial_file = destination + ".part"
+
+    source_fd = os.open(source, os.O_RDONLY)
+    destination_fd = os.open(partial_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(destination_fd, size)
+        offsets = range(0, size, chunk_size)
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(offsets)))) as executor:
+            list(executor.map(lambda offset: _copy_range(source_fd, destination_fd, offset,
+                                                         min(chunk_size, size - offset)), offsets))
+        os.fsync(destination_fd)
+    finally:
+        os.close(source_fd)
+        os.close(destination_fd)
+
+    if os.path.getsize(partial_file) != size or \
+            verify == "checksum" and file_checksum(partial_file) != file_checksum(source):
+        os.remove(partial_file)
+        raise IOError("Verification of the copy of %s failed" % source)
+    shutil.copystat(source, partial_file)
+    os.replace(partial_file, destination)
+
+
+def _reflink(source, destination):
+    """ Clones a file on a copy-on-write filesystem, the data blocks are shared until one of the files is modified """
+    import fcntl
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+
+def transfer_file(source, destination, mode="move", verify="size", copy_workers=4):
+    """ Transfers a file into the dataset directory. If the requested mode is not possible (e.g. renaming or hard
+    linking across filesystems, or reflinks on filesystems without copy-on-write), the file is copied instead and
+    the copy is verified. In "move" mode, the source is only removed after the copy was verified.
+    :param source: path to the source file
+    :param destination: path to the destination file, an existing file is replaced
+    :param mode: (default="move") one of TRANSFER_MODES
+    :param verify: (default="size") verification of copies, "size" or "checksum"
+    :param copy_workers: (default=4) number of chunks of a copy that are copied in parallel
+    """
+    if mode not in TRANSFER_MODES:
+        raise ValueError("Unknown transfer mode %s, expected one of %s" % (mode, ", ".join(TRANSFER_MODES)))
+
+    if mode == "move":
+        try:
+            os.replace(source, destination)
+            return
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+        copy_file(source, destination, copy_workers, verify=verify)
+        os.remove(source)
+        return
+
+    if mode == "copy":
+        copy_file(source, destination, copy_workers, verify=verify)
+        return
+
+    # links cannot replace an existing file
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    if mode == "symlink":
+        os.symlink(os.path.abspath(source), destination)
+        return
+
+    try:
+        if mode == "hardlink":
+            os.link(source, destination)
+        else:
+            _reflink(source, destination)
+    except (OSError, ImportError) as e:
+        if isinstance(e, OSError) and e.errno not in FALLBACK_ERRNOS | {errno.ENOTTY, errno.EINVAL, errno.EBADF}:
+            raise
+        copy_file(source, destination, copy_workers, verify=verify)
+
+
+def transfer_files(pairs, mode="move", workers=1, verify="size"):
+    """ Transfers several files on a thread pool
+    :param pairs: list of (source, destination) paths
+    :param mode: (default="move") one of TRANSFER_MODES
+    :param workers: (default=1) number of files that are transferred in parallel
+    :param verify: (default="size") verification of copies, "size" or "checksum"
+    """
+    # the chunks of a single large copy are parallelized as well, so that few big files still saturate the disk
+    copy_workers = max(1, 8 // max(1, workers))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(transfer_file, source, destination, mode, verify, copy_workers)
+                   for source, destination in pairs]
+        for future in futures:
+            future.result()
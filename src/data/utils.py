@@ -1,32 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import SimpleITK as sitk
+import json
 import os
+from .transfer import transfer_files
 
 
-def move_files(source_path, destination_path, only_nifti_files=True):
+def move_files(source_path, destination_path, only_nifti_files=True, mode="move", workers=1, verify="size"):
     """Moves files from one directory to another.
     :param source_path: source directory from which to move files
     :param destination_path: destination directory to move the files
     :param only_nifti_files: (default=True) if only .nii.gz files should be moved
-    :param limit:
+    :param mode: (default="move") how the files are transferred, one of transfer.TRANSFER_MODES. If the files cannot
+        be renamed or linked, e.g. across filesystems, they are copied and the copies are verified
+    :param workers: (default=1) number of files that are transferred in parallel
+    :param verify: (default="size") verification of copies, "size" or "checksum"
     """
+    pairs = []
     for filename in os.listdir(source_path):
         if only_nifti_files and not filename.endswith(".nii.gz"):
             continue
 
         source_file = os.path.join(source_path, filename)
         destination_file = os.path.join(destination_path, filename)
+        pairs.append((source_file, destination_file))
 
-        os.replace(source_file, destination_file)
+    transfer_files(pairs, mode, workers, verify)
 
 
-def nrrd_to_nifti(img_path, dest=None):
+def nrrd_to_nifti(img_path, dest=None, compression_level=-1):
     """ Converts a nrrd file to a nifti file and stores it in the same location or destination location if specified
     :param img_path: path to the image
     :param dest:  path where the file should be stored. If not given, this is the same is the given image path
-    :return:
+    :param compression_level: (default=-1) gzip compression level of the nifti file from 0 to 9, -1 for the default
+    :return: path of the nifti file
     """
     new_img_path = os.path.splitext(img_path)[0] + ".nii.gz"
     if dest is not None:
         new_img_path = dest
     img = sitk.ReadImage(img_path)
-    sitk.WriteImage(img, new_img_path)
+    sitk.WriteImage(img, new_img_path, True, compression_level)
+    return new_img_path
+
+
+class ConversionJournal:
+    """Append-only journal of finished conversions, so that an interrupted batch conversion can be resumed.
+    Every line is a json record of one conversion, with the size and modification time of its source and the size of
+    its output.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the journal file, it is created if it does not exist
+        """
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line can be incomplete if the previous run crashed while writing it
+                        continue
+                    self.records[record["dest"]] = record
+
+    def is_done(self, source, dest):
+        """ Checks if the conversion of source to dest was finished and the output is still valid
+        :param source: path to the source file
+        :param dest: path to the converted file
+        :return: True if the output exists, matches the journal and its header can be read
+        """
+        record = self.records.get(dest)
+        if record is None or record["source"] != os.path.abspath(source) or not os.path.exists(dest):
+            return False
+        source_stat, dest_stat = os.stat(source), os.stat(dest)
+        if (source_stat.st_size, source_stat.st_mtime_ns) != (record["source_size"], record["source_mtime"]) or \
+                dest_stat.st_size != record["dest_size"]:
+            return False
+        try:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(dest)
+            reader.ReadImageInformation()
+        except RuntimeError:
+            return False
+        return True
+
+    def add(self, source, dest):
+        """ Records a finished conversion
+        :param source: path to the source file
+        :param dest: path to the converted file
+        """
+        source_stat = os.stat(source)
+        record = {"source": os.path.abspath(source), "dest": dest, "source_size": source_stat.st_size,
+                  "source_mtime": source_stat.st_mtime_ns, "dest_size": os.path.getsize(dest)}
+        self.records[dest] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def nrrd_to_nifti_batch(img_paths, dests=None, workers=1, compression_level=-1, journal_path=None,
+                        use_processes=False):
+    """ Converts several nrrd files to nifti files on a thread or process pool
+    :param img_paths: list of paths to the images
+    :param dests: (optional) list of paths where the files should be stored, see nrrd_to_nifti
+    :param workers: (default=1) number of parallel conversions
+    :param compression_level: (default=-1) gzip compression level of the nifti files from 0 to 9, -1 for the default
+    :param journal_path: (optional) path to a journal of the finished conversions. Conversions that are recorded in it
+        and whose output is still valid are skipped, so an interrupted run continues where it stopped
+    :param use_processes: (default=False) use processes instead of threads. SimpleITK releases the GIL while reading
+        and writing, so threads are usually sufficient
+    :return: list of the paths of the nifti files
+    """
+    if dests is None:
+        dests = [os.path.splitext(img_path)[0] + ".nii.gz" for img_path in img_paths]
+    dests = [os.path.abspath(dest) for dest in dests]
+
+    journal = ConversionJournal(journal_path) if journal_path is not None else None
+    todo = [(img_path, dest) for img_path, dest in zip(img_paths, dests)
+            if journal is None or not journal.is_done(img_path, dest)]
+    print(len(img_paths) - len(todo), "of", len(img_paths), "files are already converted")
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(nrrd_to_nifti, img_path, dest, compression_level): (img_path, dest)
+                   for img_path, dest in todo}
+        for future in as_completed(futures):
+            img_path, dest = futures[future]
+            future.result()
+            print(dest)
+            if journal is not None:
+                journal.add(img_path, dest)
+    return dests
@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import hashlib
+import json
+import os
+import zlib
+from .manifest import DatasetManifest, read_header
+
+# number of bytes read at once, large sequential reads keep network storage and disks streaming
+READ_SIZE = 2 ** 24
+
+# maximum number of bytes a gzip stream is decompressed into at once, the decompressed data is discarded
+DECODE_SIZE = 2 ** 26
+
+
+def scan_file(path, decode=False, read_size=READ_SIZE):
+    """ Computes the sha256 of a file and, on request, decompresses its gzip stream in the same sequential pass.
+    The decompression checks the CRC and length of every gzip member, so truncated or corrupt files are found
+    without decoding the image
+    :param path: path to the file
+    :param decode: (default=False) decompress the file if it is gzip compressed (.gz)
+    :param read_size: (default=16MB) number of bytes read at once
+    :return: the hex digest of the file content, and an error message or None if the file is intact
+    """
+    sha256 = hashlib.sha256()
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if decode and path.endswith(".gz") else None
+    error = None
+    with open(path, 'rb') as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for chunk in iter(lambda: f.read(read_size), b''):
+            sha256.update(chunk)
+            if decoder is None:
+                continue
+            try:
+                data = chunk
+                while data:
+                    decoder.decompress(data, DECODE_SIZE)
+                    data = decoder.unconsumed_tail
+                    if decoder.eof:
+                        # a gzip file may consist of several members
+                        data = decoder.unused_data
+                        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if data else decoder
+            except zlib.error as e:
+                error = "corrupt gzip stream: %s" % e
+                decoder = None
+    if decoder is not None and not decoder.eof:
+        error = "truncated gzip stream"
+    return sha256.hexdigest(), error
+
+
+def verify_dataset(root, workers=4, decode=False, full=False):
+    """ Verifies the files of a dataset in medical decathlon structure and records their digests in its index
+    (dataset_index.json, next to dataset.json). Only files that are new or whose size or modification time changed
+    are hashed again, unless a full verification is requested
+    :param root: directory of the dataset
+    :param workers: (default=4) number of files that are read in parallel
+    :param decode: (default=False) also decompress every gzip file, files that were already decoded are not decoded
+        again as long as they do not change
+    :param full: (default=False) hash all files again and compare them with the recorded digests, to find files
+        whose content changed although size and modification time did not
+    :return: dict of the problem of each broken file, by its path relative to the dataset directory
+    """
+    manifest = DatasetManifest(root)
+    manifest.update(headers=False)
+
+    todo = [key for key, entry in manifest.entries.items()
+            if full or "sha256" not in entry or decode and "integrity" not in entry]
+    problems = {}
+
+    def check(key):
+        entry = manifest.entries[key]
+        file_path = os.path.join(root, key)
+        digest, error = scan_file(file_path, decode and (full or "integrity" not in entry))
+        if error is None and "header" not in entry:
+            try:
+                entry["header"] = read_header(file_path)
+            except RuntimeError:
+                # not an image, e.g. a readme that was downloaded with the data
+                entry["header"] = None
+        if full and entry.get("sha256") not in (None, digest):
+            # the recorded digest is kept, the file is reported until it is restored
+            error = "content changed, the sha256 differs from the recorded one"
+            entry["integrity"] = error
+        else:
+            entry["sha256"] = digest
+            if decode:
+                entry["integrity"] = error
+        return key, error
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for key, error in executor.map(check, todo):
+            if error is not None:
+                problems[key] = error
+    manifest.changed = manifest.changed or len(todo) > 0
+
+    # problems found by earlier runs are reported until the file changes
+    for key, entry in manifest.entries.items():
+        if entry.get("integrity") is not None and key not in problems:
+            problems[key] = entry["integrity"]
+    manifest.save()
+    print(len(todo), "of", len(manifest.entries), "files were read")
+    return problems
+
+
+def broken_cases(root, problems):
+    """ Finds the cases of dataset.json that have a broken or missing file
+    :param root: directory of the dataset
+    :param problems: problem of each broken file, see verify_dataset
+    :return: list of (case index, training entry, list of problems) of the broken cases, empty if the dataset has no
+        dataset.json
+    """
+    json_file = os.path.join(root, "dataset.json")
+    if not os.path.exists(json_file):
+        return []
+    with open(json_file) as f:
+        training = json.load(f).get("training", [])
+    cases = []
+    for index, case in enumerate(training):
+        case_problems = []
+        for path in case.values():
+            key = os.path.relpath(os.path.join(root, path), root).replace(os.sep, "/")
+            if not os.path.exists(os.path.join(root, key)):
+                case_problems.append(key + ": missing")
+            elif key in problems:
+                case_problems.append(key + ": " + problems[key])
+        if case_problems:
+            cases.append((index, case, case_problems))
+    return cases
+
+
+def main():
+    # ARGUMENT PARSING
+    parser = argparse.ArgumentParser(description='Verify the files of a dataset and record their checksums')
+
+    parser.add_argument('-p', '--path', type=str, help='path to the dataset', required=True)
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of files that are read in parallel (default: 4)')
+    parser.add_argument('--decode', action='store_true',
+                        help='also decompress every gzip file to find truncated or corrupt files')
+    parser.add_argument('--full', action='store_true',
+                        help='hash all files again and compare them with the recorded checksums')
+
+    args = parser.parse_args()
+
+    problems = verify_dataset(args.path, args.workers, args.decode, args.full)
+    for key, problem in sorted(problems.items()):
+        print(key + ":", problem)
+    cases = broken_cases(args.path, problems)
+    print(len(cases), "broken cases")
+    for index, case, case_problems in cases:
+        print("  ", index, ", ".join(case_problems))
+    if problems or cases:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# compare the per-case feature distributions of several datasets in medical decathlon structure
+import numpy as np
+import argparse
+import json
+import os
+from extract_features import DEFAULT_FEATURES, FEATURE_VERSION, FEATURES, extract_features, list_cases, \
+    lung_label_files
+from feature_store import case_columns, case_identities, dataset_files, dataset_id, feature_column_names, \
+    read_dataset, read_metadata, write_dataset
+from resampling import ResampleCache, resample_cases
+from running_statistics import RunningStatistics
+
+
+def dataset_name(path):
+    """Name of a dataset as given in its dataset.json, or the name of its directory.
+    Parameters:
+    path (str): path to the dataset
+    Returns:
+    str: name of the dataset
+    """
+    json_file = os.path.join(path, "dataset.json")
+    if os.path.exists(json_file):
+        with open(json_file) as f:
+            return json.load(f).get("name", os.path.basename(os.path.normpath(path)))
+    return os.path.basename(os.path.normpath(path))
+
+
+def pairwise_distances(samples):
+    """Pairwise distances between the empirical distributions of several datasets, for several features at once.
+    All features and dataset pairs are computed with one broadcast over the empirical CDFs of the datasets, evaluated
+    on the sorted union of all values of a feature.
+    Parameters:
+    samples (list(list(numpy.ndarray))): samples[f][d] are the values of feature f in dataset d
+    Returns:
+    dict(str, numpy.ndarray): arrays of shape (features, datasets, datasets) with the Wasserstein-1 distance, the
+        Kolmogorov-Smirnov statistic and the standardized mean difference (row minus column)
+    Raises:
+    ValueError: if there are no features or datasets, or a dataset has no values of a feature
+    """
+    if len(samples) == 0 or len(samples[0]) == 0:
+        raise ValueError("no features or datasets to compare")
+    nr_datasets = len(samples[0])
+    for f, feature_samples in enumerate(samples):
+        if len(feature_samples) != nr_datasets:
+            raise ValueError("feature %d has values of %d datasets instead of %d" % (f, len(feature_samples),
+                                                                                  nr_datasets))
+        empty = [d for d, values in enumerate(feature_samples) if len(values) == 0]
+        if empty:
+            raise ValueError("feature %d has no values in dataset(s) %s" % (f, ", ".join(map(str, empty))))
+    grids = [np.unique(np.concatenate(feature_samples)) for feature_samples in samples]
+    grid_size = max(len(grid) for grid in grids)
+
+    # the grids are padded by repeating their last value, padded steps have zero width and do not change the CDF
+    padded_grids = np.array([np.pad(grid, (0, grid_size - len(grid)), mode='edge') for grid in grids])
+    cdfs = np.empty((len(samples), nr_datasets, grid_size))
+    for f, feature_samples in enumerate(samples):
+        for d, values in enumerate(feature_samples):
+            cdfs[f, d] = np.searchsorted(np.sort(values), padded_grids[f], side='right') / len(values)
+
+    cdf_differences = np.abs(cdfs[:, :, np.newaxis, :] - cdfs[:, np.newaxis, :, :])
+    widths = np.diff(padded_grids, axis=1)[:, np.newaxis, np.newaxis, :]
+    wasserstein = np.sum(cdf_differences[..., :-1] * widths, axis=-1)
+    ks = np.max(cdf_differences, axis=-1)
+
+    means = np.array([[np.mean(values) for values in feature_samples] for feature_samples in samples])
+    variances = np.array([[np.var(values) for values in feature_samples] for feature_samples in samples])
+    mean_differences = means[:, :, np.newaxis] - means[:, np.newaxis, :]
+    pooled_std = np.sqrt((variances[:, :, np.newaxis] + variances[:, np.newaxis, :]) / 2)
+    # constant features have a (numerically) vanishing std, their difference is only defined if the means are equal
+    scale = np.maximum(np.abs(means[:, :, np.newaxis]), np.abs(means[:, np.newaxis, :]))
+    constant = pooled_std <= 1e-9 * np.maximum(scale, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        smd = np.where(constant, np.where(np.abs(mean_differences) <= 1e-9 * np.maximum(scale, 1), 0, np.nan),
+                       mean_differences / pooled_std)
+
+    return {"wasserstein": wasserstein, "ks": ks, "smd": smd}
+
+
+def compare_datasets(paths, workers=1, features=tuple(DEFAULT_FEATURES), parameters=None, store=None,
+                     resampling=None):
+    """Extract the features of several datasets on one shared worker pool and compare their distributions.
+    Parameters:
+    paths (list(str)): paths to the datasets
+    workers (int): number of worker processes
+    features (iterable(str)): names of the features to compare
+    parameters (dict): additional keyword arguments of the feature extraction, e.g. connectivity
+    store (str): directory of a feature store. Datasets that are stored with the same parameters and features, and
+        whose case files did not change since, are read from it instead of being extracted, and extracted datasets
+        are written into it
+    resampling (dict): if given, all datasets are resampled to a common spacing before the extraction, with the keys
+        spacing, cache (ResampleCache) and label_interpolator, see resampling.resample_cases()
+    Returns:
+    dict: names and number of cases of the datasets, mean and std of each feature column per dataset, the pairwise
+        distance matrices per distance and feature column, and the columns that were skipped because some dataset
+        has no values of them
+    """
+    ids = [dataset_id(path) for path in paths]
+    store_parameters = dict(parameters or {}, feature_version=FEATURE_VERSION)
+    if resampling is not None:
+        store_parameters.update(spacing=list(resampling["spacing"]),
+                                label_interpolator=resampling.get("label_interpolator", "nearest"))
+    stored = dataset_files(store) if store is not None else {}
+
+    cases = [list_cases(path) for path in paths]
+    dataset_lung_labels = [lung_label_files(path) for path in paths]
+    identities = [case_identities(cases[i], dataset_lung_labels[i]) for i in range(len(paths))]
+
+    columns = [None] * len(paths)
+    nr_cases = [0] * len(paths)
+    for i, dataset in enumerate(ids):
+        if dataset in stored:
+            metadata = read_metadata(stored[dataset])
+            # cases that were added, removed or changed since the dataset was stored make it stale
+            if metadata["parameters"] == store_parameters and set(features) <= set(metadata["features"]) and \
+                    metadata.get("identities") == identities[i]:
+                table = read_dataset(stored[dataset])
+                columns[i] = {name: table[name] for name in feature_column_names(table, features)}
+                nr_cases[i] = len(table["dataset"])
+    todo = [i for i in range(len(paths)) if columns[i] is None]
+    if len(todo) < len(paths):
+        print(len(paths) - len(todo), "of", len(paths), "datasets loaded from the feature store")
+
+    case_parameters = dict(parameters or {})
+    if "lung" in features:
+        case_parameters["lung_labels"] = {}
+        for i in todo:
+            case_parameters["lung_labels"].update(dataset_lung_labels[i])
+
+    # the features are extracted from the resampled volumes, while the feature store keeps the original paths
+    extraction_cases = {i: cases[i] for i in todo}
+    if resampling is not None:
+        extraction_cases = {}
+        lung_labels = {}
+        for i in todo:
+            extraction_cases[i], resampled_lung_labels = resample_cases(
+                cases[i], resampling["cache"], resampling["spacing"], resampling.get("label_interpolator", "nearest"),
+                case_parameters.get("lung_labels"))
+            lung_labels.update(resampled_lung_labels)
+        if "lung" in features:
+            case_parameters["lung_labels"] = lung_labels
+    all_cases = [case for i in todo for case in extraction_cases[i]]
+    results = extract_features(all_cases, workers, features, parameters=case_parameters)
+
+    # split the results of the shared run back into the datasets
+    start = 0
+    for i in todo:
+        dataset_results = results[start:start + len(cases[i])]
+        columns[i] = case_columns(dataset_results, features)
+        nr_cases[i] = len(cases[i])
+        if store is not None:
+            write_dataset(store, ids[i], cases[i], dataset_results, features, store_parameters,
+                          identities=identities[i])
+        start += len(cases[i])
+
+    # columns of label values that only some datasets have, or that no case of a dataset has (e.g. the lung features
+    # of a dataset without lung masks), cannot be compared
+    all_names = []
+    for dataset_columns in columns:
+        all_names += [name for name in dataset_columns if name not in all_names]
+    names = [name for name in all_names if all(name in dataset_columns and np.any(~np.isnan(dataset_columns[name]))
+                                               for dataset_columns in columns)]
+    skipped = [name for name in all_names if name not in names]
+    # features without any column, e.g. the lung features if no dataset has lung masks
+    skipped += [feature for feature in features if not feature_column_names(all_names, [feature])]
+    if skipped:
+        print(len(skipped), "features have no values in some dataset and are skipped:", ", ".join(skipped))
+    # undefined values (e.g. the intensity of a label value a case does not have) are left out
+    columns = [{name: dataset_columns[name][~np.isnan(dataset_columns[name])] for name in names}
+               for dataset_columns in columns]
+    if names:
+        distances = pairwise_distances([[dataset_columns[name] for dataset_columns in columns] for name in names])
+    else:
+        distances = {distance: np.empty((0, len(paths), len(paths))) for distance in ["wasserstein", "ks", "smd"]}
+
+    summary = []
+    for dataset_columns in columns:
+        statistics = {}
+        for name in names:
+            s = RunningStatistics()
+            for value in dataset_columns[name]:
+                s.update(value)
+            statistics[name] = {"mean": s.get_mean(), "std": s.get_std()}
+        summary.append(statistics)
+
+    def to_list(matrix):
+        # undefined standardized mean differences (no variance in both datasets) are stored as null
+        return [[None if np.isnan(x) else float(x) for x in row] for row in matrix]
+
+    return {
+        "datasets": [dataset_name(path) for path in paths],
+        "paths": list(paths),
+        "numCases": nr_cases,
+        "features": names,
+        "skipped": skipped,
+        "summary": summary,
+        "distances": {distance: {name: to_list(matrices[f]) for f, name in enumerate(names)}
+                      for distance, matrices in distances.items()},
+    }
+
+
+def main():
+    # ARGUMENT PARSING
+    parser = argparse.ArgumentParser(description='Compare the feature distributions of several datasets')
+
+    parser.add_argument('-p', '--paths', type=str, nargs='+', help='paths to the datasets', required=True)
+    parser.add_argument('-o', '--output', type=str, help='path of the json file with the comparison', required=True)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes shared by all datasets (default: 1)')
+    parser.add_argument('-c', '--connectivity', type=int, default=1,
+                        help='maximum number of orthogonal hops to consider a voxel a neighbor (default: 1)')
+    parser.add_argument('-s', '--store', type=str,
+                        help='directory of a feature store, datasets stored with the same parameters are not '
+                             'extracted again, extracted datasets are added to it')
+    parser.add_argument('--spacing', type=float, nargs=3,
+                        help='resample all datasets to this voxel spacing in mm (x y z) before the comparison')
+    parser.add_argument('--label_interpolator', type=str, default="nearest", choices=["nearest", "gaussian"],
+                        help='interpolation of the label maps when resampling (default: nearest)')
+    parser.add_argument('--resample_cache', type=str,
+                        help='directory of the cache of resampled volumes, required with --spacing')
+    parser.add_argument('-f', '--features', type=str, nargs='+', default=DEFAULT_FEATURES,
+                        choices=list(FEATURES),
+                        help='features to compare (default: %s)' % " ".join(DEFAULT_FEATURES))
+
+    args = parser.parse_args()
+    if args.spacing is not None and args.resample_cache is None:
+        parser.error("--spacing requires --resample_cache")
+
+    resampling = None
+    if args.spacing is not None:
+        resampling = {"spacing": args.spacing, "cache": ResampleCache(args.resample_cache),
+                      "label_interpolator": args.label_interpolator}
+    comparison = compare_datasets(args.paths, args.workers, args.features, {"connectivity": args.connectivity},
+                                  args.store, resampling)
+    with open(args.output, 'w') as f:
+        json.dump(comparison, f, indent=4)
+
+    for name in comparison["features"]:
+        print(name)
+        for i, dataset in enumerate(comparison["datasets"]):
+            print("  ", dataset, "- mean: ", comparison["summary"][i][name]["mean"],
+                  " - std: ", comparison["summary"][i][name]["std"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# distributed feature extraction and aggregation on a dask cluster
+from dask.base import tokenize
+from distributed import Client, LocalCluster
+from functools import partial
+import argparse
+import os
+from extract_features import DEFAULT_FEATURES, FEATURES, aggregate_statistics, extract_case, limit_threads, \
+    list_cases, lung_label_files
+from running_statistics import RunningStatistics, merge_statistics, save_statistics
+
+
+def make_client(scheduler=None, workers=1, threads_per_worker=1):
+    """Connect to a dask cluster, or start a local one.
+    Parameters:
+    scheduler (str): address of the scheduler of a running cluster, e.g. tcp://node1:8786. If not given, a
+        LocalCluster with one process per worker is started
+    workers (int): number of worker processes of the local cluster
+    threads_per_worker (int): number of threads of each worker process of the local cluster
+    Returns:
+    distributed.Client: client of the cluster
+    """
+    if scheduler is not None:
+        # the workers of a running cluster keep the thread limits they were started with
+        return Client(scheduler)
+    client = Client(LocalCluster(n_workers=workers, threads_per_worker=threads_per_worker, processes=True))
+    # every worker runs one case per thread, so SimpleITK and BLAS must not start threads of their own
+    client.run(limit_threads, threads_per_worker)
+    return client
+
+
+def case_workers(image_file, locality):
+    """Workers that can read a case, according to the path prefix of its image.
+    Parameters:
+    image_file (str): path to the image of the case
+    locality (dict(str, list(str))): worker addresses or host names per path prefix, e.g. the mount point of a
+        storage that only some nodes can read or that is local to them
+    Returns:
+    list(str): workers of the longest matching prefix, None if no prefix matches
+    """
+    prefixes = [prefix for prefix in (locality or {}) if os.path.abspath(image_file).startswith(prefix)]
+    return locality[max(prefixes, key=len)] if prefixes else None
+
+
+def submit_cases(client, cases, function, locality=None):
+    """Submit one task per case.
+    The tasks of cases with known workers are placed on these workers, but may run elsewhere when they are busy.
+    Parameters:
+    client (distributed.Client): client of the cluster
+    cases (list((str, str))): image/label pairs
+    function (callable or list(callable)): function applied to each image/label pair, e.g. extract_case with bound
+        parameters, or one function per case
+    locality (dict(str, list(str))): workers per path prefix, see case_workers()
+    Returns:
+    list(distributed.Future): the futures of the results, in the order of the cases
+    """
+    functions = function if isinstance(function, list) else [function] * len(cases)
+    futures = []
+    for (image_file, label_file), function in zip(cases, functions):
+        key = "extract_case-" + tokenize(image_file, label_file, function)
+        workers = case_workers(image_file, locality)
+        futures.append(client.submit(function, image_file, label_file, key=key, workers=workers,
+                                     allow_other_workers=workers is not None))
+    return futures
+
+
+def partial_statistics(features, *results):
+    """Statistics of a partition of the cases, see aggregate_statistics().
+    Returns:
+    (dict, dict, int): statistics, report names and number of cases of the partition
+    """
+    statistics, names = aggregate_statistics(list(results), features)
+    return statistics, names, len(results)
+
+
+def merge_partial_statistics(*partials):
+    """Merge the statistics of several partitions.
+    A partition without any component of a label value has no component count of it, its cases count as zero
+    components of that label value, like in aggregate_statistics().
+    Returns:
+    (dict, dict, int): merged statistics, report names and number of cases
+    """
+    count_keys = set(key for statistics, _, _ in partials for key in statistics if key.startswith("component_count_"))
+    completed = []
+    for statistics, names, nr_cases in partials:
+        statistics = dict(statistics)
+        for key in count_keys - set(statistics):
+            statistics[key] = RunningStatistics()
+            for _ in range(nr_cases):
+                statistics[key].update(0)
+        completed.append(statistics)
+
+    merged = merge_statistics(*completed)
+    names = {}
+    for _, partial_names, _ in partials:
+        names.update(partial_names)
+    return merged, names, sum(nr_cases for _, _, nr_cases in partials)
+
+
+def tree_reduce(client, futures, features, partition_size=16, fan_in=4):
+    """Aggregate the per-case results on the cluster with a tree of merges, without gathering them.
+    Each partition of cases is aggregated on the worker that holds its results, and the partial statistics are
+    merged fan_in at a time, always in case order. Counts, means, standard deviations, minima, maxima and histograms
+    are the same as those of aggregate_statistics() on all results, since the statistics keep exact sums. The quantile
+    sketches are compacted per partition, so the quantiles agree with the serial ones within the error bound of the
+    sketch, and are the same in every run.
+    Parameters:
+    client (distributed.Client): client of the cluster
+    futures (list(distributed.Future)): futures of the per-case results
+    features (iterable(str)): names of the extracted features
+    partition_size (int): number of cases aggregated by one task
+    fan_in (int): number of partial statistics merged by one task
+    Returns:
+    (dict(str, RunningStatistics or IntensityHistogram), dict(str, str)): statistics and report name of each feature
+    """
+    if not futures:
+        return {}, {}
+    level = [client.submit(partial_statistics, list(features), *futures[i:i + partition_size])
+             for i in range(0, len(futures), partition_size)]
+    while len(level) > 1:
+        level = [client.submit(merge_partial_statistics, *level[i:i + fan_in]) for i in range(0, len(level), fan_in)]
+    statistics, names, _ = level[0].result()
+    # the merged statistics are in order of first appearance, sort them like a single aggregate_statistics() call
+    return {key: statistics[key] for key in aggregate_order(statistics, features)}, names
+
+
+def aggregate_order(statistics, features):
+    """Report order of the aggregated statistics, the order of aggregate_statistics().
+    Parameters:
+    statistics (dict): aggregated statistics
+    features (iterable(str)): names of the extracted features
+    Returns:
+    list(str): keys of the statistics
+    """
+    order = []
+    for feature in features:
+        if feature == "intensity":
+            values = sorted((key[len("intensity_"):] for key in statistics
+                             if key.startswith("intensity_") and key != "intensity_global"), key=float)
+            order += ["intensity_global"] + ["intensity_" + value for value in values]
+        elif feature == "component_statistics":
+            values = sorted((key[len("component_count_"):] for key in statistics if key.startswith("component_count_")),
+                            key=float)
+            for value in values:
+                order += ["component_count_" + value, "component_volume_" + value]
+        elif feature == "lung":
+            values = sorted((key[len("lung_fraction_"):] for key in statistics
+                             if key.startswith("lung_fraction_") and key != "lung_fraction_total"), key=float)
+            for value in ["total"] + values:
+                order += ["lung_fraction_" + value, "lung_components_" + value]
+        else:
+            order.append(feature)
+    return [key for key in order if key in statistics]
+
+
+def main():
+    # ARGUMENT PARSING
+    parser = argparse.ArgumentParser(description='Extract the statistics of several datasets on a dask cluster')
+
+    parser.add_argument('-p', '--paths', type=str, nargs='+', help='paths to the datasets', required=True)
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='directory of the statistics, one json file per dataset')
+    parser.add_argument('--scheduler', type=str,
+                        help='address of the scheduler of a running cluster, a local cluster is started if not given')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes of the local cluster (default: 1)')
+    parser.add_argument('-c', '--connectivity', type=int, default=1,
+                        help='maximum number of orthogonal hops to consider a voxel a neighbor (default: 1)')
+    parser.add_argument('-f', '--features', type=str, nargs='+', default=DEFAULT_FEATURES, choices=list(FEATURES),
+                        help='features to extract (default: %s)' % " ".join(DEFAULT_FEATURES))
+    parser.add_argument('--locality', type=str, nargs='+', default=[],
+                        help='workers that can read a path prefix, as prefix=worker[,worker...], e.g. '
+                             '/mnt/node1=node1 to run the cases stored on node1 there')
+    parser.add_argument('--partition_size', type=int, default=16,
+                        help='number of cases aggregated by one task (default: 16)')
+
+    args = parser.parse_args()
+
+    locality = {}
+    for entry in args.locality:
+        prefix, workers = entry.split("=", 1)
+        locality[os.path.abspath(prefix)] = workers.split(",")
+
+    client = make_client(args.scheduler, args.workers)
+    lung_labels = {}
+    if "lung" in args.features:
+        for path in args.paths:
+            lung_labels.update(lung_label_files(path))
+    function = partial(extract_case, features=args.features, connectivity=args.connectivity, lung_labels=lung_labels)
+    os.makedirs(args.output, exist_ok=True)
+
+    # the cases of all datasets are submitted at once, so the cluster is busy until the last dataset is done
+    futures = [submit_cases(client, list_cases(path), function, locality) for path in args.paths]
+    for path, dataset_futures in zip(args.paths, futures):
+        statistics, names = tree_reduce(client, dataset_futures, args.features, args.partition_size)
+        name = os.path.basename(os.path.normpath(path))
+        save_statistics(statistics, os.path.join(args.output, name + ".json"))
+        print(name)
+        for key, s in statistics.items():
+            print("  ", names[key], "- mean: ", s.get_mean(), " - std: ", s.get_std())
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
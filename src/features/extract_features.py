@@ -1,9 +1,52 @@
 # for generating features such as mean resolution, number of connected components per label, ..
-from skimage.measure import label, regionprops
+from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import argparse
 import SimpleITK as sitk
+import json
 import os
+import pathlib
+import sys
+from feature_cache import CACHE_FILE, FeatureCache
+from running_statistics import IntensityHistogram, RunningStatistics, save_statistics
+from intensity import intensity_histograms
+from lung import lung_statistics
+from slab_labeling import connected_components_slabwise
+from volume_cache import VolumeCache
+from instrumentation import CaseTrace, NullTrace, print_summary, profile_call, write_trace
+from pipeline import pipelined_map
+from feature_store import case_identities, dataset_id, write_dataset
+from resampling import ResampleCache, resample_cases
+
+# the data package is next to the features directory in src
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from data.manifest import load_manifest
+from data.verify import broken_cases, verify_dataset
+
+# version of the feature code, cached results of other versions are recomputed
+FEATURE_VERSION = 2
+
+# features that can be extracted, and the name under which they are reported
+FEATURES = {
+    "voxel_spacing": "Voxel Spacing",
+    "resolution": "Resolution",
+    "connected_components": "Number of Connected Components",
+    "component_statistics": "Component Statistics",
+    "intensity": "Intensity (HU)",
+    "lung": "Lung Involvement",
+}
+
+# features that are extracted if none is selected explicitly
+DEFAULT_FEATURES = ["voxel_spacing", "resolution", "connected_components"]
+
+# features that only need the header of the image and not its voxel data
+HEADER_FEATURES = ["voxel_spacing", "resolution"]
+
+# environment variables that control the size of native thread pools (BLAS, OpenMP, ITK)
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                   "NUMEXPR_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"]
 
 
 def voxel_spacing(x_sitk):
@@ -29,8 +72,50 @@ def resolution(x):
         return x.GetSize()
 
 
+def compact_labels(y, chunk_size=16):
+    """Convert a label map to the smallest integer dtype that holds its values.
+    Label maps are often stored as int16, int32 or float, although their values fit into uint8.
+    Parameters:
+    y (numpy.ndarray): label map
+    chunk_size (int): number of z planes that are checked for integral values at once
+    Returns:
+    numpy.ndarray: the label map itself if it is already compact, a compact copy otherwise
+    Raises:
+    ValueError: if the label map has non-integral values
+    """
+    if y.dtype == bool or y.dtype == np.uint8 or y.size == 0:
+        return y
+    if y.dtype.kind == "f":
+        # chunk by chunk, so that the rounded copy is never made of the whole volume
+        for z in range(0, y.shape[0], chunk_size):
+            chunk = y[z:z + chunk_size]
+            if not np.array_equal(chunk, np.rint(chunk)):
+                raise ValueError("label map has non-integral values")
+    low, high = int(y.min()), int(y.max())
+    dtype = next(np.dtype(dtype) for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.int64)
+                 if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max)
+    if y.dtype.kind in "iu" and dtype.itemsize >= y.dtype.itemsize:
+        return y
+    return y.astype(dtype)
+
+
+def component_dtype(nr_components):
+    """Smallest unsigned integer dtype that holds the given number of component ids.
+    Parameters:
+    nr_components (int): (upper bound of the) number of components
+    Returns:
+    numpy.dtype: dtype of the component ids
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if nr_components <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
 def connected_components(y, connectivity=2):
     """Calculate the connected components of a label map.
+    Each label value is labeled on its own, so components of different values that touch stay separate. The component
+    ids get the smallest unsigned dtype that holds them (mostly uint16), instead of int64.
     Parameters:
     y (numpy.ndarray): label map
     connectivity (int): maximum number of orthogonal hops to consider a
@@ -40,53 +125,752 @@ def connected_components(y, connectivity=2):
     (numpy.ndarray, int): an array where each component is assigned a new label,
         ant the number of connected components
     """
-    labeled_image, nr_components = label(y, return_num=True, connectivity=1)
+    structure = ndimage.generate_binary_structure(y.ndim, connectivity)
+    values = set()
+    for z in range(0, y.shape[0], 16):
+        values.update(np.unique(y[z:z + 16]).tolist())
+    values = sorted(value for value in values if value != 0)
+
+    # the number of foreground voxels bounds the number of components, but usually far too loosely, so the ids are
+    # first tried with 16 bits
+    dtype = component_dtype(int(np.count_nonzero(y)))
+    dtypes = [dtype] if dtype.itemsize <= 2 else [np.dtype(np.uint16), dtype]
+    for dtype in dtypes:
+        try:
+            return label_values(y, values, structure, dtype)
+        except RuntimeError:
+            if dtype is dtypes[-1]:
+                raise
+
+
+def label_values(y, values, structure, dtype):
+    """Label the components of each value of a label map into one array of component ids.
+    Parameters:
+    y (numpy.ndarray): label map
+    values (list): non-zero values of the label map
+    structure (numpy.ndarray): neighborhood, see scipy.ndimage.generate_binary_structure()
+    dtype (numpy.dtype): dtype of the component ids
+    Returns:
+    (numpy.ndarray, int): component ids and number of components
+    Raises:
+    RuntimeError: if the dtype cannot hold the number of components
+    """
+    labeled_image = np.zeros(y.shape, dtype=dtype)
+    work = None
+    nr_components = 0
+    for i, value in enumerate(values):
+        mask = y if y.dtype == bool else y == value
+        if i == 0:
+            nr_components = ndimage.label(mask, structure, output=labeled_image)
+            continue
+        if work is None:
+            work = np.empty(y.shape, dtype=dtype)
+        nr = ndimage.label(mask, structure, output=work)
+        if nr_components + nr > np.iinfo(dtype).max:
+            raise RuntimeError("insufficient bit-depth in requested output type")
+        np.add(work, dtype.type(nr_components), out=labeled_image, where=mask)
+        nr_components += nr
     return labeled_image, nr_components
 
 
+def component_statistics(y, spacing, connectivity=2, labeled=None, offset=None, chunk_size=16):
+    """Per-label table of the connected components of a label map, computed in one pass with bulk operations.
+    Parameters:
+    y (numpy.ndarray): label map
+    spacing (tuple(float)): voxel spacing in mm, in SimpleITK (x, y, z) order
+    connectivity (int): maximum number of orthogonal hops to consider a pixel/voxel a neighbor
+    labeled (numpy.ndarray, int): output of connected_components(), if it was already computed
+    offset (tuple(int)): if y is a crop of a larger label map, the index of its first voxel in the larger map. It is
+        added to the bounding boxes and centroids, so they refer to the larger map
+    chunk_size (int): number of z planes whose component ids are counted at once
+    Returns:
+    dict: for each label value (as str): the number of components and, per component, its voxel count, bounding box
+        (start and stop index per axis of the array), centroid (array index) and physical volume in mm^3
+    """
+    labeled_image, nr_components = labeled if labeled is not None else connected_components(y, connectivity)
+    offset = np.zeros(y.ndim, dtype=int) if offset is None else np.asarray(offset, dtype=int)
+
+    # the bincounts need the component ids as intp, so they are computed in chunks of z planes to keep the copies small
+    voxel_counts = np.zeros(nr_components + 1, dtype=np.int64)
+    sums = np.zeros((y.ndim, nr_components + 1))
+    # all voxels of a component have the same value, so scattering the values gives the value of each component
+    component_values = np.zeros(nr_components + 1, dtype=y.dtype)
+    for z in range(0, y.shape[0], chunk_size):
+        chunk = labeled_image[z:z + chunk_size]
+        flat_labels = chunk.ravel().astype(np.intp)
+        voxel_counts += np.bincount(flat_labels, minlength=nr_components + 1)
+        component_values[flat_labels] = y[z:z + chunk_size].ravel()
+        # the coordinate sums are exact integers, so a crop gives the same centroids as the full label map
+        for axis in range(y.ndim):
+            shape = [1] * y.ndim
+            shape[axis] = chunk.shape[axis]
+            start = z if axis == 0 else 0
+            coordinates = np.broadcast_to(np.arange(start, start + chunk.shape[axis]).reshape(shape), chunk.shape)
+            sums[axis] += np.bincount(flat_labels, weights=coordinates.ravel(), minlength=nr_components + 1)
+    voxel_counts, component_values = voxel_counts[1:], component_values[1:]
+
+    bounding_boxes = np.array([[s.start for s in obj] + [s.stop for s in obj]
+                               for obj in ndimage.find_objects(labeled_image)], dtype=int).reshape(-1, 2 * y.ndim)
+    bounding_boxes += np.concatenate([offset, offset])
+
+    centroids = np.empty((nr_components, y.ndim))
+    for axis in range(y.ndim):
+        centroids[:, axis] = (sums[axis, 1:] + offset[axis] * voxel_counts) / voxel_counts
+    volumes = voxel_counts * np.prod(spacing)
+
+    table = {}
+    for value in np.unique(component_values):
+        selection = component_values == value
+        table[str(value)] = {
+            "count": int(np.count_nonzero(selection)),
+            "voxel_counts": voxel_counts[selection].tolist(),
+            "bounding_boxes": bounding_boxes[selection].tolist(),
+            "centroids": centroids[selection].tolist(),
+            "volumes": volumes[selection].tolist(),
+        }
+    return table
+
+
+def foreground_bounding_box(y, margin=1):
+    """Tight bounding box of the non-zero voxels of a label map, found with projections onto the axes.
+    Parameters:
+    y (numpy.ndarray): label map
+    margin (int): number of background voxels to keep around the foreground, clipped at the borders
+    Returns:
+    tuple(slice): the bounding box per axis. A label map without foreground gives a box of a single voxel
+    """
+    # the projection onto the last two axes marks the z planes with foreground, the one onto the first axis the
+    # rows and columns, so the volume is only reduced twice
+    planes = np.any(y, axis=tuple(range(1, y.ndim)))
+    if not planes.any():
+        return tuple(slice(0, 1) for _ in y.shape)
+    plane = np.any(y[planes.argmax():len(planes) - planes[::-1].argmax()], axis=0)
+
+    box = []
+    for axis, projection in enumerate([planes] + [np.any(plane, axis=tuple(a for a in range(plane.ndim) if a != i))
+                                                  for i in range(plane.ndim)]):
+        indices = np.flatnonzero(projection)
+        box.append(slice(max(0, indices[0] - margin), min(y.shape[axis], indices[-1] + 1 + margin)))
+    return tuple(box)
+
+
+def read_image_information(path):
+    """Read only the header of an image file, without decoding its voxel data.
+    The returned reader provides GetSpacing(), GetSize(), GetOrigin(), GetDirection() and GetPixelID()
+    just like an image, so it can be passed to voxel_spacing() and resolution().
+    Parameters:
+    path (str): path to the image
+    Returns:
+    (SimpleITK.ImageFileReader): reader holding the header information
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader
+
+
+class ImageBuffer:
+    """Exposes the voxel buffer of a SimpleITK image to numpy without copying it, and keeps the image alive for as
+    long as an array uses the buffer (numpy.asarray(ImageBuffer(image)))
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.__array_interface__ = sitk.GetArrayViewFromImage(image).__array_interface__
+
+
+def load_volume(path, volume_cache=None, trace=NullTrace(), labels=False):
+    """Voxel data and spacing of a volume.
+    Parameters:
+    path (str): path to the volume
+    volume_cache (VolumeCache): if given, the volume is read as memory map from the cache of decompressed volumes
+    trace (CaseTrace): records the decoding and array conversion stages
+    labels (bool): the volume is a label map (or lung mask). It is returned in the smallest dtype that holds its
+        values, see compact_labels(), and without a copy of the decoded buffer if it is already compact
+    Returns:
+    (numpy.ndarray, tuple(float)): voxel data of shape (z, y, x) and spacing in (x, y, z) order
+    """
+    if volume_cache is not None:
+        # a memory map is shared with the page cache, converting it would make a private copy. Label maps are only
+        # converted if they are not compact, like a decoded label map
+        with trace.stage("volume_cache") as info:
+            array, metadata = volume_cache.load(path)
+            if labels:
+                array = compact_labels(array)
+            info["array_bytes"] = array.nbytes
+        return array, tuple(metadata["spacing"])
+    with trace.stage("read_image") as info:
+        sitk_img = sitk.ReadImage(path)
+        info["file_bytes"] = os.path.getsize(path)
+    with trace.stage("get_array") as info:
+        if labels:
+            array = compact_labels(np.asarray(ImageBuffer(sitk_img)))
+        else:
+            array = sitk.GetArrayFromImage(sitk_img)
+        info["array_bytes"] = array.nbytes
+    return array, sitk_img.GetSpacing()
+
+
+def extract_case(image_file, label_file, features=tuple(FEATURES), connectivity=1, memory_budget=None,
+                 volume_cache=None, trace=False, volumes=None, roi=False, lung_labels=None, header=None):
+    """Extract the features of one image/label pair.
+    The image is only decoded if a voxel-level feature is requested, header features are taken from the index of the
+    dataset or read from the file header alone.
+    Parameters:
+    image_file (str): path to the image
+    label_file (str): path to the label map
+    features (iterable(str)): names of the features to extract, see FEATURES
+    connectivity (int): connectivity of the connected components
+    memory_budget (int): if given, the label map is labeled slab by slab within this number of bytes, instead of
+        being loaded into memory as a whole
+    volume_cache (VolumeCache): if given, voxel data is read from this cache of decompressed volumes
+    trace (bool): record the time and memory of each stage, the trace is returned as "trace" in the result
+    volumes (dict): volumes that were already loaded, e.g. by the reader threads of the pipeline, as
+        (voxel data, spacing) per path, see load_volume()
+    roi (bool): label only the bounding box of the foreground of the label map (with a margin of one voxel), the
+        results are the same as for the whole label map
+    lung_labels (dict((str, str), str)): path to the lung mask of each image/label pair, see lung_label_files(). The
+        lung feature of a case without lung mask is None
+    header (dict): header metadata of the image from the index of the dataset (with spacing and size, see
+        indexed_headers()), the header is read from the file if not given
+    Returns:
+    dict: the value of each requested feature
+    """
+    volumes = volumes or {}
+    case_trace = CaseTrace(image_file) if trace else NullTrace()
+    result = {}
+    if any(feature in HEADER_FEATURES for feature in features) and header is not None:
+        if "voxel_spacing" in features:
+            result["voxel_spacing"] = [round(x_sp, 2) for x_sp in header["spacing"]]
+        if "resolution" in features:
+            result["resolution"] = tuple(header["size"])
+    elif any(feature in HEADER_FEATURES for feature in features):
+        with case_trace.stage("read_header"):
+            image_header = read_image_information(image_file)
+            if "voxel_spacing" in features:
+                result["voxel_spacing"] = voxel_spacing(image_header)
+            if "resolution" in features:
+                result["resolution"] = resolution(image_header)
+
+    if "connected_components" in features and memory_budget is not None:
+        with case_trace.stage("slab_labeling"):
+            # a cached volume is memory-mapped, so the slabs are read from the page cache instead of decoded
+            source = label_file if volume_cache is None else volume_cache.load(label_file)[0]
+            result["connected_components"] = connected_components_slabwise(source, connectivity, memory_budget)
+
+    if "intensity" in features:
+        with case_trace.stage("intensity"):
+            image_source, label_source = image_file, label_file
+            if volume_cache is not None:
+                image_source, label_source = volume_cache.load(image_file)[0], volume_cache.load(label_file)[0]
+            if image_file in volumes and label_file in volumes:
+                image_source, label_source = volumes[image_file][0], volumes[label_file][0]
+            histograms = intensity_histograms(image_source, label_source, memory_budget or 64 * 2 ** 20)
+            result["intensity"] = {key: histogram.counts for key, histogram in histograms.items()}
+
+    lung_file = (lung_labels or {}).get((image_file, label_file)) if "lung" in features else None
+    if "lung" in features and lung_file is None:
+        result["lung"] = None
+
+    in_memory_labeling = "connected_components" in features and memory_budget is None
+    if in_memory_labeling or "component_statistics" in features or lung_file is not None:
+        if label_file in volumes:
+            labels, spacing = volumes[label_file]
+        else:
+            labels, spacing = load_volume(label_file, volume_cache, case_trace, labels=True)
+        offset = None
+        if roi:
+            with case_trace.stage("roi") as info:
+                box = foreground_bounding_box(labels)
+                labels = labels[box]
+                offset = [s.start for s in box]
+                info["array_bytes"] = labels.nbytes
+        with case_trace.stage("connected_components") as info:
+            labeled = connected_components(labels, connectivity)
+            info["array_bytes"] = labeled[0].nbytes
+        if in_memory_labeling:
+            result["connected_components"] = labeled[1]
+        if "component_statistics" in features:
+            with case_trace.stage("component_statistics"):
+                result["component_statistics"] = component_statistics(labels, spacing, connectivity, labeled,
+                                                                     offset)
+        if lung_file is not None:
+            if lung_file in volumes:
+                lung = volumes[lung_file][0]
+            else:
+                lung = load_volume(lung_file, volume_cache, case_trace, labels=True)[0]
+            with case_trace.stage("lung"):
+                result["lung"] = lung_statistics(labeled, lung, spacing, offset, memory_budget or 64 * 2 ** 20)
+
+    if trace:
+        result["trace"] = case_trace.to_dict()
+    return result
+
+
+def pipelined_volumes(image_file, label_file, features, memory_budget=None, lung_label_file=None):
+    """Paths of the volumes that extract_case() loads into memory as a whole, and that the pipeline can read ahead.
+    Volumes that are processed slab by slab within a memory budget are not read ahead.
+    Parameters:
+    image_file (str): path to the image
+    label_file (str): path to the label map
+    features (iterable(str)): names of the features to extract
+    memory_budget (int): memory budget of the slab-wise processing, None if the volumes are processed as a whole
+    lung_label_file (str): path to the lung mask, if the lung feature is extracted and the case has one
+    Returns:
+    list(str): paths of the volumes
+    """
+    paths = []
+    if "intensity" in features and memory_budget is None:
+        paths.append(image_file)
+    if paths or "component_statistics" in features or lung_label_file is not None or \
+            ("connected_components" in features and memory_budget is None):
+        paths.append(label_file)
+    if lung_label_file is not None:
+        paths.append(lung_label_file)
+    return paths
+
+
+def volume_bytes(path):
+    """Size of the decoded voxel data of a volume, estimated from its header.
+    Parameters:
+    path (str): path to the volume
+    Returns:
+    int: number of bytes
+    """
+    reader = read_image_information(path)
+    itemsize = sitk.GetArrayViewFromImage(sitk.Image([1] * 3, reader.GetPixelID())).itemsize
+    return int(np.prod(reader.GetSize())) * itemsize
+
+
+def limit_threads(num_threads):
+    """Limit the number of threads SimpleITK and the BLAS/OpenMP libraries may use in this process.
+    Used as initializer of the worker processes, so that N workers do not oversubscribe the CPU.
+    Parameters:
+    num_threads (int): maximum number of threads per process
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(num_threads)
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+    # numpy is already imported at this point, so the environment variables alone are not enough
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(num_threads)
+    except ImportError:
+        pass
+
+
+def list_cases(path, manifest=None):
+    """List the image/label pairs of a dataset in medical decathlon structure.
+    The pairs are taken from the training section of dataset.json, or, if there is none, by pairing the sorted
+    files of imagesTr and labelsTr. The directories are listed through the index of the dataset.
+    Parameters:
+    path (str): path to the dataset
+    manifest (DatasetManifest): index of the dataset, it is loaded (and updated) if not given
+    Returns:
+    list((str, str)): list of image and label paths
+    """
+    if manifest is None:
+        manifest = load_manifest(path, headers=False)
+
+    json_file = os.path.join(path, "dataset.json")
+    if os.path.exists(json_file):
+        with open(json_file) as f:
+            training = json.load(f).get("training", [])
+        cases = [(os.path.normpath(os.path.join(path, case["image"])),
+                  os.path.normpath(os.path.join(path, case["label"]))) for case in training]
+        existing = [case for case in cases
+                    if manifest.entry(case[0]) is not None and manifest.entry(case[1]) is not None]
+        if len(existing) < len(cases):
+            print(len(cases) - len(existing), "cases of dataset.json do not exist and are skipped")
+        if training:
+            return existing
+
+    return [(os.path.join(path, "imagesTr", image), os.path.join(path, "labelsTr", label))
+            for image, label in manifest.pairs(("imagesTr", "labelsTr"))]
+
+
+def indexed_headers(manifest, cases):
+    """Header metadata of the images of a dataset, as far as its index has them. The index only keeps the headers of
+    files whose size and modification time did not change since they were read.
+    Parameters:
+    manifest (DatasetManifest): index of the dataset
+    cases (list((str, str))): image/label pairs
+    Returns:
+    dict(str, dict): header metadata of each indexed image, see data.manifest.read_header()
+    """
+    headers = {}
+    for image_file, _ in cases:
+        entry = manifest.entry(image_file)
+        if entry is not None and entry.get("header") is not None:
+            headers[image_file] = entry["header"]
+    return headers
+
+
+def call_case(function, image_file, label_file):
+    return function(image_file, label_file)
+
+
+def lung_label_files(path):
+    """Lung masks of the training cases of a dataset, as listed in the lungLabel entries of its dataset.json.
+    Parameters:
+    path (str): path to the dataset
+    Returns:
+    dict((str, str), str): path to the lung mask of each image/label pair, only for the masks that exist. The masks
+        are looked up by the whole case, since several cases may share a label map (e.g. an empty one)
+    """
+    json_file = os.path.join(path, "dataset.json")
+    if not os.path.exists(json_file):
+        return {}
+    with open(json_file) as f:
+        training = json.load(f).get("training", [])
+    lung_labels = {}
+    for case in training:
+        if case.get("lungLabel") is not None and os.path.exists(os.path.join(path, case["lungLabel"])):
+            lung_labels[(os.path.normpath(os.path.join(path, case["image"])),
+                         os.path.normpath(os.path.join(path, case["label"])))] = \
+                os.path.normpath(os.path.join(path, case["lungLabel"]))
+    return lung_labels
+
+
+def extract_features(cases, workers=1, features=tuple(FEATURES), case_function=extract_case, parameters=None,
+                     cache=None, pipeline=None, client=None):
+    """Extract the features of all cases, either serially or on a process pool.
+    The results are always returned in the order of the given cases.
+    Parameters:
+    cases (list((str, str))): image/label pairs
+    workers (int): number of worker processes. 1 runs everything in the current process
+    features (iterable(str)): names of the features to extract, see FEATURES
+    case_function (callable): function that is applied to every image/label pair
+    parameters (dict): additional keyword arguments of the case function, e.g. connectivity. The headers (dict of
+        the indexed header of each image, see indexed_headers()) are passed per case as keyword argument header
+    cache (FeatureCache): if given, only the cases that are not cached are computed
+    pipeline (dict): if given and workers is 1, the volumes of the next cases are read on reader threads while the
+        current case is computed, see pipeline.pipelined_map() for the keys (prefetch, readers, max_bytes). The case
+        function receives the read volumes as keyword argument volumes, like extract_case()
+    client (distributed.Client): if given, the cases are extracted on this dask cluster instead, see dask_backend
+    Returns:
+    list(dict): features of each case
+    """
+    results = [None] * len(cases)
+    lung_labels = (parameters or {}).get("lung_labels") or {}
+    if cache is not None:
+        results = [cache.get(image_file, label_file, features, lung_labels.get((image_file, label_file)))
+                   for image_file, label_file in cases]
+        print(sum(result is not None for result in results), "of", len(cases), "cases loaded from the cache")
+
+    todo = [i for i, result in enumerate(results) if result is None]
+    image_files = [cases[i][0] for i in todo]
+    label_files = [cases[i][1] for i in todo]
+    parameters = dict(parameters or {})
+    headers = parameters.pop("headers", None) or {}
+    function = partial(case_function, features=features, **parameters)
+    # the header of an indexed image is not read from the file again
+    functions = [partial(function, header=headers[image_file]) if image_file in headers else function
+                 for image_file in image_files]
+
+    if client is not None:
+        from dask_backend import submit_cases
+        futures = submit_cases(client, list(zip(image_files, label_files)), functions)
+        computed = collect_results(future.result() for future in futures)
+    elif workers <= 1 and pipeline is not None:
+        memory_budget = (parameters or {}).get("memory_budget")
+        volume_cache = (parameters or {}).get("volume_cache")
+
+        def paths(case):
+            lung_label_file = lung_labels.get(tuple(case)) if "lung" in features else None
+            return pipelined_volumes(case[0], case[1], features, memory_budget, lung_label_file)
+
+        def read(case):
+            return {path: load_volume(path, volume_cache, labels=path != case[0]) for path in paths(case)}
+
+        def estimate(case):
+            return sum(volume_bytes(path) for path in paths(case))
+
+        computed = collect_results(pipelined_map(lambda case, volumes: case[2](case[0], case[1], volumes=volumes),
+                                                 list(zip(image_files, label_files, functions)), read, estimate,
+                                                 **pipeline))
+    elif workers <= 1:
+        computed = collect_results(map(call_case, functions, image_files, label_files))
+    else:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=limit_threads,
+                                 initargs=(threads_per_worker,)) as executor:
+            # map keeps the order of the input, independent of the order in which the workers finish
+            computed = collect_results(executor.map(call_case, functions, image_files, label_files))
+
+    for i, result in zip(todo, computed):
+        results[i] = result
+        if cache is not None:
+            cache.put(cases[i][0], cases[i][1], {key: value for key, value in result.items() if key != "trace"},
+                      lung_labels.get(tuple(cases[i])))
+
+    if cache is not None:
+        cache.evict(cases)
+    return results
+
+
+def collect_results(results):
+    """Collect the per-case results while reporting the progress.
+    Parameters:
+    results (iterable): per-case results in case order
+    Returns:
+    list: the collected results
+    """
+    features = []
+    for ctr, result in enumerate(results, 1):
+        print('Volume ', ctr)
+        features.append(result)
+    return features
+
+
+def aggregate_statistics(results, features):
+    """Aggregate the per-case results into streaming statistics.
+    The component statistics are split up by label value: the number of components per case, and the volume of
+    every single component. The intensity histograms of all cases are merged into one histogram per label value.
+    Parameters:
+    results (list(dict)): features of each case
+    features (iterable(str)): names of the extracted features
+    Returns:
+    (dict(str, RunningStatistics or IntensityHistogram), dict(str, str)): statistics and report name of each
+        aggregated feature
+    """
+    statistics = {}
+    names = {}
+    for feature in features:
+        if feature == "intensity":
+            # the histograms of all cases are summed up to the histogram of the dataset
+            values = sorted(set(value for result in results for value in result[feature] if value != "global"),
+                            key=float)
+            for value in ["global"] + values:
+                key = "intensity_" + value
+                statistics[key] = IntensityHistogram()
+                names[key] = FEATURES[feature] + (" of label " + value if value != "global" else "")
+                for result in results:
+                    if value in result[feature]:
+                        statistics[key].merge(IntensityHistogram(result[feature][value]))
+            continue
+
+        if feature == "lung":
+            # cases without lung mask are left out, as are lung values a case does not have
+            tables = [result[feature] for result in results if result[feature] is not None]
+            values = sorted(set(value for table in tables for value in table if value != "total"), key=float)
+            for value in (["total"] if tables else []) + values:
+                fraction_key, components_key = "lung_fraction_" + value, "lung_components_" + value
+                suffix = " of lung label " + value if value != "total" else ""
+                statistics[fraction_key], statistics[components_key] = RunningStatistics(), RunningStatistics()
+                names[fraction_key] = "Infected Fraction of the Lung" + suffix
+                names[components_key] = "Number of Infection Components in the Lung" + suffix
+                for table in tables:
+                    if value in table:
+                        statistics[fraction_key].update(table[value]["fraction"])
+                        statistics[components_key].update(table[value]["components"])
+            continue
+
+        if feature != "component_statistics":
+            statistics[feature] = RunningStatistics()
+            names[feature] = FEATURES[feature]
+            for result in results:
+                statistics[feature].update(result[feature])
+            continue
+
+        # cases without a component of some label value count as zero components of it
+        values = sorted(set(value for result in results for value in result[feature]), key=float)
+        for value in values:
+            count_key, volume_key = "component_count_" + value, "component_volume_" + value
+            statistics[count_key], statistics[volume_key] = RunningStatistics(), RunningStatistics()
+            names[count_key] = "Number of Connected Components of label " + value
+            names[volume_key] = "Component Volume (mm^3) of label " + value
+            for result in results:
+                table = result[feature].get(value, {"count": 0, "volumes": []})
+                statistics[count_key].update(table["count"])
+                for volume in table["volumes"]:
+                    statistics[volume_key].update(volume)
+    return statistics, names
+
+
 def main():
     # ARGUMENT PARSING
     parser = argparse.ArgumentParser(description='Retrieve statistics about the dataset')
 
     parser.add_argument('-p', '--path', type=str, help='path to the data', required=True)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes used to extract the features (default: 1)')
+    parser.add_argument('-c', '--connectivity', type=int, default=1,
+                        help='maximum number of orthogonal hops to consider a voxel a neighbor (default: 1)')
+    parser.add_argument('-mb', '--memory_budget', type=int,
+                        help='label the label maps slab by slab within this memory budget (in MB) per case, instead '
+                             'of loading them into memory as a whole')
+    parser.add_argument('--roi', action='store_true',
+                        help='label only the bounding box of the foreground of each label map, which gives the same '
+                             'results with less time and memory for small lesions')
+    parser.add_argument('-vc', '--volume_cache', type=str,
+                        help='directory of a cache of decompressed volumes, which are then read as memory maps')
+    parser.add_argument('-vcs', '--volume_cache_size', type=float, default=20,
+                        help='size cap of the volume cache in GB (default: 20)')
+    parser.add_argument('--spacing', type=float, nargs=3,
+                        help='resample images (linearly) and label maps to this voxel spacing in mm (x y z) before '
+                             'extracting the features, so that datasets of different spacing can be compared')
+    parser.add_argument('--label_interpolator', type=str, default="nearest", choices=["nearest", "gaussian"],
+                        help='interpolation of the label maps when resampling, gaussian is the label Gaussian '
+                             'interpolator (default: nearest)')
+    parser.add_argument('--resample_cache', type=str,
+                        help='directory of the cache of resampled volumes, required with --spacing')
+    parser.add_argument('--resample_cache_size', type=float, default=20,
+                        help='size cap of the cache of resampled volumes in GB (default: 20)')
+    parser.add_argument('--scheduler', type=str,
+                        help='extract the cases on the dask cluster with this scheduler address, instead of local '
+                             'worker processes')
+    parser.add_argument('--dask_workers', type=int,
+                        help='extract the cases on a local dask cluster with this number of worker processes')
+    parser.add_argument('-pl', '--pipeline', type=int,
+                        help='read the volumes of up to this many cases ahead on reader threads, while the current '
+                             'case is computed (only with a single worker)')
+    parser.add_argument('--readers', type=int, default=2,
+                        help='number of reader threads of the pipeline (default: 2)')
+    parser.add_argument('--in_flight', type=int, default=2048,
+                        help='maximum size in MB of the decoded volumes that the pipeline holds (default: 2048)')
+    parser.add_argument('--verify', action='store_true',
+                        help='verify the checksums and gzip streams of the dataset files first, only new and changed '
+                             'files are read, broken cases are reported and skipped')
+    parser.add_argument('--cache', action='store_true',
+                        help='cache the results of each case next to dataset.json and only process new or changed cases')
+    parser.add_argument('--hash', action='store_true',
+                        help='compare the content hash of cached files whose modification time changed')
+    parser.add_argument('-s', '--statistics', type=str,
+                        help='store the mergeable statistics of each feature in this json file')
+    parser.add_argument('--store', type=str,
+                        help='directory of a feature store, the per-case features are written into a compressed '
+                             'columnar file of the dataset in it')
+    parser.add_argument('--store_format', type=str, default="npz", choices=["npz", "parquet"],
+                        help='file format of the feature store, parquet needs pyarrow (default: npz)')
+    parser.add_argument('-t', '--trace', type=str,
+                        help='record the time and memory of each stage of each case in this jsonl file, and print '
+                             'the slowest cases and stages')
+    parser.add_argument('--profile_case', type=int,
+                        help='run the case with this number (as printed, starting at 1) again under cProfile and '
+                             'tracemalloc, and store the results next to the trace file')
+    parser.add_argument('-m', '--metadata', type=str,
+                        help='only read the headers and store the spacing, size, origin, direction and dtype of '
+                             'each case in this json file')
 
-    # TODO these arguments are currently not implemented
-    parser.add_argument('-v', '--voxel_spacing', type=bool, help='voxel spacing of the image')
-    parser.add_argument('-r', '--resolution', type=bool, help='Image resolution of the image')
-    parser.add_argument('-cc', '--conn_comp', type=bool, help='Connected components of the label map')
+    # if none of the features is selected, the default features are extracted
+    parser.add_argument('-v', '--voxel_spacing', action='store_true', help='voxel spacing of the image')
+    parser.add_argument('-r', '--resolution', action='store_true', help='Image resolution of the image')
+    parser.add_argument('-cc', '--conn_comp', action='store_true', help='Connected components of the label map')
+    parser.add_argument('-cs', '--comp_stats', action='store_true',
+                        help='Number and volume of the connected components per label')
+    parser.add_argument('-i', '--intensity', action='store_true',
+                        help='Intensity histogram of the image, overall and per label')
+    parser.add_argument('-l', '--lung', action='store_true',
+                        help='Infected fraction and infection components of the lung, for cases with a lung mask '
+                             '(lungLabel in dataset.json)')
 
     args = parser.parse_args()
+    if args.spacing is not None and args.resample_cache is None:
+        parser.error("--spacing requires --resample_cache")
+
+    broken = set()
+    if args.verify:
+        problems = verify_dataset(args.path, args.workers, decode=True)
+        broken.update(os.path.normpath(os.path.join(args.path, key)) for key in problems)
+        for index, case, case_problems in broken_cases(args.path, problems):
+            print("Broken case", index, ":", ", ".join(case_problems))
+            broken.update(os.path.normpath(os.path.join(args.path, file)) for file in case.values())
+
+    selected = {"voxel_spacing": args.voxel_spacing, "resolution": args.resolution,
+                "connected_components": args.conn_comp, "component_statistics": args.comp_stats,
+                "intensity": args.intensity, "lung": args.lung}
+    features = [feature for feature in FEATURES if selected[feature]] or DEFAULT_FEATURES
+
+    # header metadata is only read for new or changed files, and only if it is needed
+    header_features = any(feature in HEADER_FEATURES for feature in features)
+    manifest = load_manifest(args.path, headers=args.metadata is not None or header_features, workers=args.workers)
+    cases = [case for case in list_cases(args.path, manifest) if case[0] not in broken and case[1] not in broken]
 
-    image_path = args.path + "/imagesTr"
-    label_path = args.path + "/labelsTr"
+    if args.metadata is not None:
+        metadata = [{"image_file": image_file, "label_file": label_file, "image": manifest.header(image_file),
+                     "label": manifest.header(label_file)} for image_file, label_file in cases]
+        with open(args.metadata, 'w') as f:
+            json.dump(metadata, f, indent=4)
+        return
+
+    parameters = {"connectivity": args.connectivity}
+    cache = None
+    if args.cache:
+        cache = FeatureCache(os.path.join(args.path, CACHE_FILE), FEATURE_VERSION, parameters, args.hash)
+
+    # the memory budget, volume cache and roi do not change the results, so they are not part of the cached parameters
+    memory_budget = None if args.memory_budget is None else args.memory_budget * 2 ** 20
+    volume_cache = None
+    if args.volume_cache is not None:
+        volume_cache = VolumeCache(args.volume_cache, int(args.volume_cache_size * 2 ** 30))
 
     # iterate over files and labels
-    ctr = 1
-    voxel_spacing_list = []
-    resolution_list = []
-    connected_components_list = []
-    for filename in zip(os.listdir(image_path), os.listdir(label_path)):
-        if filename[0].endswith(".nii.gz"):
-            print('Volume ', ctr)
-            ctr += 1
-
-            image_file = os.path.join(image_path, filename[0])
-            label_file = os.path.join(label_path, filename[1])
-
-            sitk_img = sitk.ReadImage(image_file)
-            sitk_labels = sitk.ReadImage(label_file)
-            labels = sitk.GetArrayFromImage(sitk_labels)
-
-            voxel_spacing_list.append(voxel_spacing(sitk_img))
-            resolution_list.append(resolution(sitk_img))
-            connected_components_list.append(connected_components(labels)[1])
-
-    voxel_spacing_mean, voxel_spacing_std = np.mean(voxel_spacing_list, axis=0), np.std(voxel_spacing_list, axis=0)
-    resolution_mean, resolution_std = np.mean(resolution_list, axis=0), np.std(resolution_list, axis=0)
-    connected_components_mean, connected_components_std = np.mean(connected_components_list), np.std(connected_components_list)
-    print("Voxel Spacing - mean: ", voxel_spacing_mean, " - std: ", voxel_spacing_std)
-    print("Resolution - mean: ", resolution_mean, " - std: ", resolution_std)
-    print("Number of Connected Components - mean: ", connected_components_mean, " - std: ", connected_components_std)
+    case_parameters = dict(parameters, memory_budget=memory_budget, volume_cache=volume_cache,
+                           trace=args.trace is not None, roi=args.roi)
+    if header_features:
+        case_parameters["headers"] = indexed_headers(manifest, cases)
+    if "lung" in features:
+        case_parameters["lung_labels"] = lung_label_files(args.path)
+        missing = sum(tuple(case) not in case_parameters["lung_labels"] for case in cases)
+        if missing:
+            print(missing, "of", len(cases), "cases have no lung mask, their lung features are skipped")
+
+    # the features are extracted from the resampled volumes, while the feature store keeps the original paths
+    extraction_cases = cases
+    store_parameters = dict(parameters, feature_version=FEATURE_VERSION)
+    if args.spacing is not None:
+        resample_cache = ResampleCache(args.resample_cache, int(args.resample_cache_size * 2 ** 30))
+        extraction_cases, lung_labels = resample_cases(cases, resample_cache, args.spacing, args.label_interpolator,
+                                                       case_parameters.get("lung_labels"))
+        if "lung" in features:
+            case_parameters["lung_labels"] = lung_labels
+        store_parameters.update(spacing=args.spacing, label_interpolator=args.label_interpolator)
+    pipeline = None
+    if args.pipeline is not None:
+        pipeline = {"prefetch": args.pipeline, "readers": args.readers, "max_bytes": args.in_flight * 2 ** 20}
+    client = None
+    if args.scheduler is not None or args.dask_workers is not None:
+        from dask_backend import make_client
+        client = make_client(args.scheduler, args.dask_workers or 1)
+    results = extract_features(extraction_cases, args.workers, features, parameters=case_parameters, cache=cache,
+                               pipeline=pipeline, client=client)
+    if client is not None:
+        client.close()
+    if cache is not None:
+        cache.close()
+
+    if args.trace is not None:
+        # cases that were loaded from the cache were not traced
+        traces = [result.pop("trace") for result in results if "trace" in result]
+        write_trace(traces, args.trace)
+        print_summary(traces)
+
+    if args.profile_case is not None:
+        output_prefix = os.path.splitext(args.trace or "profile")[0] + "_case_%d" % args.profile_case
+        image_file, label_file = extraction_cases[args.profile_case - 1]
+        profile_parameters = {key: value for key, value in case_parameters.items() if key != "headers"}
+        profile_call(extract_case, output_prefix, image_file, label_file, features,
+                     **dict(profile_parameters, trace=False, header=case_parameters.get("headers", {}).get(image_file)))
+        print("Profile of case", args.profile_case, "stored in", output_prefix + ".prof and",
+              output_prefix + ".tracemalloc.txt")
+
+    if args.store is not None:
+        identities = case_identities(cases, lung_label_files(args.path))
+        print("Features stored in", write_dataset(args.store, dataset_id(args.path), cases, results, features,
+                                                   store_parameters, args.store_format, identities))
+
+    statistics, names = aggregate_statistics(results, features)
+    for key, s in statistics.items():
+        if isinstance(s, IntensityHistogram):
+            print(names[key], "- mean: ", s.get_mean(), " - std: ", s.get_std(),
+                  " - percentiles (5, 25, 50, 75, 95): ", s.get_quantile([0.05, 0.25, 0.5, 0.75, 0.95]))
+        else:
+            print(names[key], "- mean: ", s.get_mean(), " - std: ", s.get_std())
+
+    if args.statistics is not None:
+        save_statistics(statistics, args.statistics)
 
 
 if __name__ == '__main__':
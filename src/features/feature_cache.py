@@ -0,0 +1,198 @@
+# persistent cache of per-case feature results, so that re-runs only process new or changed cases
+import numpy as np
+import hashlib
+import sqlite3
+import json
+import os
+
+# name of the cache file, stored next to the dataset.json of a dataset
+CACHE_FILE = "features_cache.sqlite"
+
+
+def file_identity(path, with_hash=False):
+    """Identity of a file, used to find out if it has changed since the last run.
+    Parameters:
+    path (str): path to the file
+    with_hash (bool): also compute the sha1 of the file content
+    Returns:
+    dict: size, modification time (ns) and optionally the content hash of the file
+    """
+    stat = os.stat(path)
+    identity = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": None}
+    if with_hash:
+        identity["hash"] = file_hash(path)
+    return identity
+
+
+def file_hash(path, chunk_size=2 ** 20):
+    """Content hash of a file.
+    Parameters:
+    path (str): path to the file
+    chunk_size (int): number of bytes read at once
+    Returns:
+    str: hex digest of the sha1 of the file content
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def to_json(value):
+    """Serialize a feature result, converting numpy types to their python counterparts."""
+    def default(x):
+        if isinstance(x, np.ndarray):
+            return x.tolist()
+        if isinstance(x, np.generic):
+            return x.item()
+        raise TypeError("Object of type %s is not JSON serializable" % type(x).__name__)
+    return json.dumps(value, default=default, sort_keys=True)
+
+
+class FeatureCache:
+    """SQLite cache of the feature results of each image/label pair of a dataset.
+    An entry is only valid for the feature version and parameters (e.g. connectivity) it was computed with, and as
+    long as the size and modification time of its files do not change. The lung mask of a case is part of the
+    identity of its label map, so replacing or changing the mask invalidates the entry as well. If content hashing is
+    enabled, a file with a new modification time but the same content is still treated as unchanged.
+    """
+
+    def __init__(self, path, version, parameters=None, use_hash=False):
+        """
+        Parameters:
+        path (str): path to the sqlite file
+        version (int): version of the feature code. Entries of other versions are evicted
+        parameters (dict): parameters the features are computed with
+        use_hash (bool): compare the content hash of files whose modification time changed
+        """
+        self.path = path
+        self.version = version
+        self.parameters = to_json(parameters or {})
+        self.use_hash = use_hash
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS features ("
+                                "image TEXT, label TEXT, image_identity TEXT, label_identity TEXT, "
+                                "version INTEGER, parameters TEXT, result TEXT, PRIMARY KEY (image, label))")
+        # entries computed with another feature version or other parameters can never be hit again
+        self.connection.execute("DELETE FROM features WHERE version != ? OR parameters != ?",
+                                (self.version, self.parameters))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def _key(self, image_file, label_file):
+        return os.path.abspath(image_file), os.path.abspath(label_file)
+
+    def _unchanged(self, path, cached_identity):
+        """Check if a file still has the cached identity.
+        Returns:
+        (bool, dict): if the file is unchanged, and its current identity
+        """
+        cached_identity = json.loads(cached_identity)
+        identity = file_identity(path)
+        if identity["size"] != cached_identity["size"]:
+            return False, None
+        if identity["mtime"] == cached_identity["mtime"]:
+            return True, cached_identity
+        if not self.use_hash or cached_identity["hash"] is None:
+            return False, None
+        identity["hash"] = file_hash(path)
+        return identity["hash"] == cached_identity["hash"], identity
+
+    def _label_identity(self, label_file, lung_file):
+        """Identity of a label map and its lung mask, see file_identity()."""
+        identity = file_identity(label_file, self.use_hash)
+        identity["lung"] = None
+        if lung_file is not None:
+            identity["lung"] = dict(file_identity(lung_file, self.use_hash), path=os.path.abspath(lung_file))
+        return identity
+
+    def _lung_unchanged(self, lung_file, cached_identity):
+        """Check if the lung mask of a label map is still the cached one.
+        Returns:
+        (bool, dict): if the mask is unchanged, and its current identity
+        """
+        if lung_file is None or cached_identity is None:
+            return lung_file is None and cached_identity is None, None
+        if cached_identity["path"] != os.path.abspath(lung_file):
+            return False, None
+        unchanged, identity = self._unchanged(lung_file, to_json(cached_identity))
+        return unchanged, dict(identity, path=cached_identity["path"]) if unchanged else None
+
+    def get(self, image_file, label_file, features, lung_file=None):
+        """Cached result of an image/label pair.
+        Parameters:
+        image_file (str): path to the image
+        label_file (str): path to the label map
+        features (iterable(str)): names of the features that are needed
+        lung_file (str): path to the lung mask of the label map, if it has one
+        Returns:
+        dict or None: the cached features, None if the pair changed or some features are not cached
+        """
+        row = self.connection.execute("SELECT image_identity, label_identity, result FROM features "
+                                      "WHERE image = ? AND label = ?", self._key(image_file, label_file)).fetchone()
+        if row is None:
+            return None
+
+        image_unchanged, image_identity = self._unchanged(image_file, row[0])
+        if not image_unchanged:
+            return None
+        label_unchanged, label_identity = self._unchanged(label_file, row[1])
+        if not label_unchanged:
+            return None
+        lung_unchanged, lung_identity = self._lung_unchanged(lung_file, json.loads(row[1]).get("lung"))
+        if not lung_unchanged:
+            return None
+        label_identity = dict(label_identity, lung=lung_identity)
+
+        result = json.loads(row[2])
+        if any(feature not in result for feature in features):
+            return None
+
+        # the files were only touched, remember their new modification time
+        if json.loads(row[0]) != image_identity or json.loads(row[1]) != label_identity:
+            self.connection.execute("UPDATE features SET image_identity = ?, label_identity = ? "
+                                    "WHERE image = ? AND label = ?",
+                                    (to_json(image_identity), to_json(label_identity))
+                                    + self._key(image_file, label_file))
+            self.connection.commit()
+
+        return {feature: result[feature] for feature in features}
+
+    def put(self, image_file, label_file, result, lung_file=None):
+        """Store the result of an image/label pair. Features of an earlier run on the same unchanged files are kept.
+        Parameters:
+        image_file (str): path to the image
+        label_file (str): path to the label map
+        result (dict): the extracted features
+        lung_file (str): path to the lung mask of the label map, if it has one
+        """
+        image_identity = to_json(file_identity(image_file, self.use_hash))
+        label_identity = to_json(self._label_identity(label_file, lung_file))
+        key = self._key(image_file, label_file)
+
+        row = self.connection.execute("SELECT image_identity, label_identity, result FROM features "
+                                      "WHERE image = ? AND label = ?", key).fetchone()
+        stored = {}
+        if row is not None and row[0] == image_identity and row[1] == label_identity:
+            stored = json.loads(row[2])
+        stored.update(json.loads(to_json(result)))
+
+        self.connection.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                key + (image_identity, label_identity, self.version, self.parameters,
+                                       to_json(stored)))
+        self.connection.commit()
+
+    def evict(self, cases):
+        """Remove all entries of image/label pairs that are no longer part of the dataset.
+        Parameters:
+        cases (list((str, str))): the current image/label pairs
+        """
+        keep = set(self._key(image_file, label_file) for image_file, label_file in cases)
+        rows = self.connection.execute("SELECT image, label FROM features").fetchall()
+        stale = [row for row in rows if tuple(row) not in keep]
+        self.connection.executemany("DELETE FROM features WHERE image = ? AND label = ?", stale)
+        self.connection.commit()
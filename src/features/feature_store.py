@@ -0,0 +1,242 @@
+# columnar store of the per-case features: one compressed file per dataset, one row per case, one column per feature
+import numpy as np
+import hashlib
+import json
+import os
+import re
+import time
+from feature_cache import file_identity
+from running_statistics import IntensityHistogram
+
+# names of the components of vector valued features
+AXES = ["x", "y", "z"]
+
+# columns that identify a case, all other columns are feature values
+ID_COLUMNS = ["dataset", "image", "label"]
+
+# name of the member of an npz file that holds the metadata of the run
+METADATA_KEY = "__metadata__"
+
+
+def case_columns(results, features):
+    """Split the per-case results into one scalar column per feature (component).
+    Vector valued features get one column per axis (e.g. voxel_spacing_x). The component statistics give the number
+    and the total volume of the components per label value, the intensity histograms their mean and standard deviation
+    per label value. Cases without a label value have zero components, and an undefined (NaN) intensity, of it. The
+    lung features give the infected fraction and the number of infection components per lung value, NaN for cases
+    without lung mask.
+    Parameters:
+    results (list(dict)): features of each case
+    features (iterable(str)): names of the extracted features
+    Returns:
+    dict(str, numpy.ndarray): values of each column, one per case
+    """
+    columns = {}
+    for feature in features:
+        if feature == "component_statistics":
+            values = sorted(set(value for result in results for value in result[feature]), key=float)
+            for value in values:
+                tables = [result[feature].get(value, {"count": 0, "volumes": []}) for result in results]
+                columns["component_count_" + value] = np.array([table["count"] for table in tables], dtype=float)
+                columns["component_volume_" + value] = np.array([sum(table["volumes"]) for table in tables],
+                                                                dtype=float)
+        elif feature == "intensity":
+            values = sorted(set(value for result in results for value in result[feature] if value != "global"),
+                            key=float)
+            for value in ["global"] + values:
+                histograms = [IntensityHistogram(result[feature][value]) if value in result[feature] else None
+                              for result in results]
+                columns["intensity_mean_" + value] = np.array(
+                    [h.get_mean() if h is not None else np.nan for h in histograms], dtype=float)
+                columns["intensity_std_" + value] = np.array(
+                    [h.get_std() if h is not None else np.nan for h in histograms], dtype=float)
+        elif feature == "lung":
+            tables = [result[feature] or {} for result in results]
+            values = sorted(set(value for table in tables for value in table if value != "total"), key=float)
+            for value in (["total"] if any(tables) else []) + values:
+                for key, column in [("fraction", "lung_fraction_"), ("components", "lung_components_")]:
+                    columns[column + value] = np.array([table[value][key] if value in table else np.nan
+                                                        for table in tables], dtype=float)
+        else:
+            values = np.array([result[feature] for result in results], dtype=float)
+            if values.ndim == 1:
+                columns[feature] = values
+            else:
+                for i in range(values.shape[1]):
+                    columns[feature + "_" + AXES[i]] = values[:, i]
+    return columns
+
+
+def feature_column_names(columns, features):
+    """Names of the columns that belong to the given features, see case_columns().
+    Parameters:
+    columns (iterable(str)): names of all columns, e.g. of a stored dataset
+    features (iterable(str)): names of the features
+    Returns:
+    list(str): names of the columns of these features
+    """
+    prefixes = []
+    for feature in features:
+        if feature == "component_statistics":
+            prefixes += ["component_count_", "component_volume_"]
+        elif feature == "intensity":
+            prefixes += ["intensity_mean_", "intensity_std_"]
+        elif feature == "lung":
+            prefixes += ["lung_fraction_", "lung_components_"]
+        else:
+            prefixes.append(feature + "_")
+    return [name for name in columns if name not in ID_COLUMNS and
+            (name in features or any(name.startswith(prefix) for prefix in prefixes))]
+
+
+def dataset_id(path):
+    """Id of a dataset in a store: the name in its dataset.json (or the name of its directory) and a hash of its
+    resolved path, so that different datasets with the same name get files of their own.
+    Parameters:
+    path (str): path to the dataset
+    Returns:
+    str: id of the dataset, usable as file name
+    """
+    path = os.path.realpath(path)
+    name = os.path.basename(path)
+    json_file = os.path.join(path, "dataset.json")
+    if os.path.exists(json_file):
+        with open(json_file) as f:
+            name = json.load(f).get("name", name)
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name) + "-" + hashlib.sha1(path.encode()).hexdigest()[:10]
+
+
+def case_identities(cases, lung_labels=None):
+    """Identities of the files of the cases of a dataset, to find out if the stored features are still up to date.
+    Parameters:
+    cases (list((str, str))): image/label pairs
+    lung_labels (dict((str, str), str)): path to the lung mask of each image/label pair, see
+        extract_features.lung_label_files()
+    Returns:
+    list(list): per case the absolute path, size and modification time of the image, the label map and the lung mask
+        (None if the case has none)
+    """
+    def identity(path):
+        if path is None:
+            return None
+        stat = file_identity(path)
+        return [os.path.abspath(path), stat["size"], stat["mtime"]]
+    return [[identity(image_file), identity(label_file), identity((lung_labels or {}).get((image_file, label_file)))]
+            for image_file, label_file in cases]
+
+
+def store_path(store, dataset, file_format="npz"):
+    return os.path.join(store, dataset + "." + file_format)
+
+
+def write_dataset(store, dataset, cases, results, features, parameters=None, file_format="npz", identities=None):
+    """Write the features of one dataset into the store.
+    Every dataset is a file of its own, so adding a dataset does not rewrite the others, and writing a dataset again
+    replaces only its own file (atomically).
+    Parameters:
+    store (str): directory of the store, it is created if it does not exist
+    dataset (str): id of the dataset, used as file name
+    cases (list((str, str))): image/label pairs
+    results (list(dict)): features of each case
+    features (iterable(str)): names of the extracted features
+    parameters (dict): parameters of the run (e.g. connectivity), stored as metadata of the file
+    file_format (str): "npz" (compressed numpy archive) or "parquet" (needs pyarrow)
+    identities (list(list)): identities of the files of the cases, see case_identities(), stored as metadata
+    Returns:
+    str: path of the written file
+    """
+    columns = {
+        "dataset": np.array([dataset] * len(cases)),
+        "image": np.array([image_file for image_file, _ in cases]),
+        "label": np.array([label_file for _, label_file in cases]),
+    }
+    columns.update(case_columns(results, features))
+    metadata = {"dataset": dataset, "features": list(features), "parameters": parameters or {},
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "numCases": len(cases), "identities": identities}
+
+    os.makedirs(store, exist_ok=True)
+    path = store_path(store, dataset, file_format)
+    tmp_path = path + ".tmp"
+    if file_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.table(columns).replace_schema_metadata({METADATA_KEY: json.dumps(metadata)})
+        pq.write_table(table, tmp_path, compression="zstd")
+    else:
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **columns, **{METADATA_KEY: np.array(json.dumps(metadata))})
+    os.replace(tmp_path, path)
+    return path
+
+
+def dataset_files(store):
+    """Files of the datasets in a store.
+    Parameters:
+    store (str): directory of the store
+    Returns:
+    dict(str, str): path of the file of each dataset id
+    """
+    if not os.path.isdir(store):
+        return {}
+    return {os.path.splitext(name)[0]: os.path.join(store, name) for name in sorted(os.listdir(store))
+            if name.endswith(".npz") or name.endswith(".parquet")}
+
+
+def read_metadata(path):
+    """Metadata of the run that wrote a dataset file, see write_dataset().
+    Parameters:
+    path (str): path to the file of a dataset
+    Returns:
+    dict: dataset id, features, parameters, creation time, number of cases and identities of the case files
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return json.loads(pq.read_schema(path).metadata[METADATA_KEY.encode()])
+    with np.load(path) as f:
+        return json.loads(str(f[METADATA_KEY]))
+
+
+def read_dataset(path, columns=None):
+    """Read the columns of one dataset file. Only the requested columns are decompressed.
+    Parameters:
+    path (str): path to the file of a dataset
+    columns (list(str)): columns to read, all if not given
+    Returns:
+    dict(str, numpy.ndarray): values of each column, columns missing in the file are left out
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        names = pq.read_schema(path).names
+        table = pq.read_table(path, columns=[c for c in names if columns is None or c in columns])
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+    with np.load(path) as f:
+        names = [name for name in f.files if name != METADATA_KEY]
+        return {name: f[name] for name in names if columns is None or name in columns}
+
+
+def load_features(store, columns=None, datasets=None):
+    """Load the per-case features of several datasets of a store as one table.
+    Parameters:
+    store (str): directory of the store
+    columns (list(str)): feature columns to read, all if not given. The id columns are always read
+    datasets (list(str)): ids of the datasets to read, all if not given
+    Returns:
+    dict(str, numpy.ndarray): values of each column, one per case of all datasets, e.g. for pandas.DataFrame.
+        Feature columns a dataset does not have are NaN for its cases
+    """
+    tables = []
+    for dataset, path in dataset_files(store).items():
+        if datasets is None or dataset in datasets:
+            tables.append(read_dataset(path, None if columns is None else ID_COLUMNS + list(columns)))
+
+    names = []
+    for table in tables:
+        names += [name for name in table if name not in names]
+    merged = {}
+    for name in names:
+        parts = []
+        for table in tables:
+            nr_cases = len(table["dataset"])
+            parts.append(table[name] if name in table else np.full(nr_cases, np.nan))
+        merged[name] = np.concatenate(parts) if parts else np.array([])
+    return merged
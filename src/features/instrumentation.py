@@ -0,0 +1,148 @@
+# per-case, per-stage timing and memory instrumentation of the feature extraction
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+
+def read_bytes():
+    """Number of bytes the current process has read so far (rchar of /proc/self/io), None if not available"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """Current resident set size of the process in bytes, None if not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes (ru_maxrss is in kB on Linux and in bytes on macOS)"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+class CaseTrace:
+    """Records wall time, CPU time, bytes read, sizes of the created arrays and memory of each stage of a case"""
+
+    def __init__(self, case):
+        """
+        Parameters:
+        case (str): name of the case, e.g. the path to its image
+        """
+        self.case = case
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that records one stage. It yields a dict, in which the stage can store additional
+        information, e.g. the number of bytes of the arrays it creates ("array_bytes").
+        Parameters:
+        name (str): name of the stage
+        """
+        info = {}
+        bytes_before = read_bytes()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        yield info
+        record = {"stage": name, "wall_time": time.perf_counter() - wall_start,
+                  "cpu_time": time.process_time() - cpu_start}
+        bytes_after = read_bytes()
+        record["read_bytes"] = bytes_after - bytes_before if bytes_before is not None else None
+        record.update(info)
+        record["rss"] = current_rss()
+        record["peak_rss"] = peak_rss()
+        self.stages.append(record)
+
+    def to_dict(self):
+        return {"case": self.case, "pid": os.getpid(), "wall_time": sum(s["wall_time"] for s in self.stages),
+                "stages": self.stages}
+
+
+class NullTrace:
+    """Trace that records nothing, used when the instrumentation is disabled"""
+
+    @contextmanager
+    def stage(self, name):
+        yield {}
+
+
+def write_trace(traces, path):
+    """Write the traces of all cases as json lines.
+    Parameters:
+    traces (list(dict)): traces of each case, see CaseTrace.to_dict()
+    path (str): path to the jsonl file
+    """
+    with open(path, 'w') as f:
+        for trace in traces:
+            f.write(json.dumps(trace) + "\n")
+
+
+def print_summary(traces, nr_slowest=5):
+    """Print the slowest cases and the time spent in each stage over all cases.
+    Parameters:
+    traces (list(dict)): traces of each case, see CaseTrace.to_dict()
+    nr_slowest (int): number of slowest cases to print
+    """
+    print("Slowest cases:")
+    for trace in sorted(traces, key=lambda t: t["wall_time"], reverse=True)[:nr_slowest]:
+        slowest_stage = max(trace["stages"], key=lambda s: s["wall_time"], default={"stage": "-", "wall_time": 0})
+        print("  %8.3f s  %s  (slowest stage: %s, %.3f s)" % (trace["wall_time"], trace["case"],
+                                                              slowest_stage["stage"], slowest_stage["wall_time"]))
+
+    stages = {}
+    for trace in traces:
+        for s in trace["stages"]:
+            total = stages.setdefault(s["stage"], {"wall_time": 0, "cpu_time": 0, "read_bytes": 0, "count": 0})
+            total["wall_time"] += s["wall_time"]
+            total["cpu_time"] += s["cpu_time"]
+            total["read_bytes"] += s["read_bytes"] or 0
+            total["count"] += 1
+
+    wall_time = sum(total["wall_time"] for total in stages.values()) or 1
+    print("Stages:")
+    print("  %-24s %10s %10s %7s %12s" % ("stage", "wall (s)", "cpu (s)", "share", "read (MB)"))
+    for name, total in sorted(stages.items(), key=lambda item: item[1]["wall_time"], reverse=True):
+        print("  %-24s %10.3f %10.3f %6.1f%% %12.1f" % (name, total["wall_time"], total["cpu_time"],
+                                                         100 * total["wall_time"] / wall_time,
+                                                         total["read_bytes"] / 2 ** 20))
+    print("  peak RSS: %.1f MB" % (max((s["peak_rss"] for t in traces for s in t["stages"]), default=0) / 2 ** 20))
+
+
+def profile_call(function, output_prefix, *args, **kwargs):
+    """Run a function under cProfile and tracemalloc.
+    The profile is stored in <output_prefix>.prof (readable with pstats or snakeviz), and the lines that allocated
+    the most memory in <output_prefix>.tracemalloc.txt.
+    Parameters:
+    function (callable): function to profile
+    output_prefix (str): path prefix of the output files
+    Returns:
+    the return value of the function
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        result = profiler.runcall(function, *args, **kwargs)
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    profiler.dump_stats(output_prefix + ".prof")
+
+    with open(output_prefix + ".tracemalloc.txt", 'w') as f:
+        f.write("peak traced memory: %.1f MB\n" % (peak / 2 ** 20))
+        for statistic in snapshot.statistics("lineno")[:25]:
+            f.write(str(statistic) + "\n")
+    return result
@@ -0,0 +1,41 @@
+# intensity (HU) histograms of CT volumes, computed chunk by chunk
+import numpy as np
+from running_statistics import IntensityHistogram
+from slab_labeling import open_slab_source
+
+# bytes per voxel of a chunk: the voxels of image and label map, bin indices and the combined label/bin indices
+INTENSITY_BYTES_PER_VOXEL = 24
+
+
+def intensity_histograms(image, labels=None, memory_budget=64 * 2 ** 20):
+    """Histograms of the intensities of a volume, over the whole volume and restricted to each label value.
+    The volume is processed in chunks of z planes, so no full float copy of the volume is made.
+    Parameters:
+    image (str or numpy.ndarray): path to the image, or an (memory-mapped) array of shape (z, y, x)
+    labels (str or numpy.ndarray): path to the label map, or an array with the same shape as the image
+    memory_budget (int): memory budget in bytes for a chunk
+    Returns:
+    dict(str, IntensityHistogram): histogram of the whole volume ("global") and of each non-zero label value
+    """
+    image = open_slab_source(image)
+    plane_bytes = image.shape[1] * image.shape[2] * INTENSITY_BYTES_PER_VOXEL
+    thickness = int(max(1, min(image.shape[0], memory_budget // plane_bytes)))
+
+    histograms = {"global": IntensityHistogram()}
+    nr_bins = len(histograms["global"].counts)
+    image_slabs = image.iter_slabs(thickness)
+    label_slabs = open_slab_source(labels).iter_slabs(thickness) if labels is not None else None
+
+    for image_slab in image_slabs:
+        bins = IntensityHistogram.bin_indices(image_slab)
+        histograms["global"].counts += np.bincount(bins, minlength=nr_bins)
+        if label_slabs is None:
+            continue
+
+        # one bincount over the combined (label value, bin) index gives the histograms of all label values at once
+        label_slab = np.asarray(next(label_slabs)).ravel().astype(np.int64)
+        nr_values = int(label_slab.max()) + 1
+        counts = np.bincount(label_slab * nr_bins + bins, minlength=nr_values * nr_bins).reshape(nr_values, nr_bins)
+        for value in np.flatnonzero(counts[1:].any(axis=1)) + 1:
+            histograms.setdefault(str(value), IntensityHistogram()).counts += counts[value]
+    return histograms
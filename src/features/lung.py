@@ -0,0 +1,61 @@
+# infection relative to the lung mask (lungLabelsTr), computed chunk by chunk with one combined bincount
+import numpy as np
+
+# bytes per voxel of a chunk: the component index and lung value (as int64) and their combined index
+LUNG_BYTES_PER_VOXEL = 24
+
+
+def lung_statistics(labeled, lung, spacing, offset=None, memory_budget=64 * 2 ** 20):
+    """Infected fraction and number of infection components of the lung, as a whole and per lung label value.
+    Every non-zero voxel of the label map counts as infection. A single bincount over the combined (component, lung
+    value) index gives the overlap of every component with every lung value, so no boolean mask is made per label or
+    lung value. The overlap is computed in chunks of z planes.
+    Parameters:
+    labeled (numpy.ndarray, int): connected components of the label map, see connected_components()
+    lung (numpy.ndarray): lung mask with the shape of the label map, one value per lung (e.g. left and right)
+    spacing (tuple(float)): voxel spacing in mm, in SimpleITK (x, y, z) order
+    offset (tuple(int)): if the components were labeled on a crop of the label map, the index of its first voxel
+    memory_budget (int): memory budget in bytes for a chunk
+    Returns:
+    dict: for the whole lung ("total") and each lung value (as str): the volume of the lung and of its infection in
+        mm^3, the infected fraction and the number of infection components that reach into it
+    """
+    labeled_image, nr_components = labeled
+    cropped = offset is not None
+    offset = np.zeros(lung.ndim, dtype=int) if offset is None else np.asarray(offset, dtype=int)
+    box = tuple(slice(o, o + s) for o, s in zip(offset, labeled_image.shape))
+    if (not cropped and labeled_image.shape != lung.shape) or any(s.stop > n for s, n in zip(box, lung.shape)):
+        raise ValueError("lung mask of shape %s does not match the label map" % (lung.shape,))
+
+    nr_values = int(lung.max()) + 1
+    plane_bytes = int(np.prod(labeled_image.shape[1:])) * LUNG_BYTES_PER_VOXEL
+    thickness = int(max(1, min(labeled_image.shape[0], memory_budget // plane_bytes)))
+    overlap = np.zeros((nr_components + 1) * nr_values, dtype=np.int64)
+    for z in range(0, labeled_image.shape[0], thickness):
+        component_slab = labeled_image[z:z + thickness].ravel().astype(np.int64)
+        lung_slab = lung[box][z:z + thickness].ravel().astype(np.int64)
+        overlap += np.bincount(component_slab * nr_values + lung_slab, minlength=len(overlap))
+    overlap = overlap.reshape(nr_components + 1, nr_values)
+
+    if labeled_image.shape == lung.shape:
+        lung_voxels = overlap.sum(axis=0)
+    else:
+        # the lung outside of the crop has no infection, but still counts to the volume of the lung
+        lung_thickness = int(max(1, memory_budget // (int(np.prod(lung.shape[1:])) * 8)))
+        lung_voxels = np.zeros(nr_values, dtype=np.int64)
+        for z in range(0, lung.shape[0], lung_thickness):
+            lung_voxels += np.bincount(lung[z:z + lung_thickness].ravel().astype(np.int64), minlength=nr_values)
+    infected_voxels = overlap[1:].sum(axis=0)
+    reached = overlap[1:, 1:] > 0
+    voxel_volume = float(np.prod(spacing))
+
+    def entry(voxels, infected, components):
+        return {"volume": voxels * voxel_volume, "infected_volume": infected * voxel_volume,
+                "fraction": infected / voxels if voxels > 0 else 0.0, "components": components}
+
+    table = {"total": entry(int(lung_voxels[1:].sum()), int(infected_voxels[1:].sum()),
+                            int(np.count_nonzero(reached.any(axis=1))))}
+    for value in np.flatnonzero(lung_voxels[1:]) + 1:
+        table[str(value)] = entry(int(lung_voxels[value]), int(infected_voxels[value]),
+                                  int(np.count_nonzero(reached[:, value - 1])))
+    return table
@@ -0,0 +1,101 @@
+# pipelined execution: reader threads decode the next cases while the current case is computed
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+
+
+class InFlightBudget:
+    """Back-pressure of the pipeline: limits the number of cases and the number of bytes that have been read ahead
+    but not yet computed. A single case that exceeds the byte limit on its own is still let through once nothing else
+    is in flight, so the pipeline cannot deadlock.
+    """
+
+    def __init__(self, max_cases, max_bytes):
+        """
+        Parameters:
+        max_cases (int): maximum number of cases in flight
+        max_bytes (int): maximum number of (estimated) bytes in flight
+        """
+        self.max_cases = max_cases
+        self.max_bytes = max_bytes
+        self.cases = 0
+        self.bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        """Wait until a case of the given size fits into the budget.
+        Parameters:
+        nbytes (int): estimated number of bytes of the case
+        Returns:
+        bool: False if the budget was closed while waiting, i.e. no further cases should be read
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or self.cases == 0 or
+                                    (self.cases < self.max_cases and self.bytes + nbytes <= self.max_bytes))
+            if self.closed:
+                return False
+            self.cases += 1
+            self.bytes += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self.condition:
+            self.cases -= 1
+            self.bytes -= nbytes
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def pipelined_map(function, items, load, estimate, prefetch=4, readers=2, max_bytes=2 * 2 ** 30):
+    """Apply a function to the loaded items, while the next items are loaded on reader threads.
+    The loading has to release the GIL to overlap with the computation, which SimpleITK and gzip do while decoding.
+    Parameters:
+    function (callable): called with an item and its loaded data, in the current thread
+    items (list): items to process
+    load (callable): loads the data of an item, called on the reader threads
+    estimate (callable): estimated number of bytes of the loaded data of an item
+    prefetch (int): maximum number of items that are loaded ahead of the current one
+    readers (int): number of reader threads
+    max_bytes (int): maximum number of estimated bytes of the items in flight, including the current one
+    Returns:
+    generator: the results of the function in the order of the items
+    """
+    budget = InFlightBudget(prefetch + 1, max_bytes)
+    pending = queue.Queue()
+    executor = ThreadPoolExecutor(max_workers=max(1, readers))
+
+    def dispatch():
+        try:
+            for item in items:
+                try:
+                    nbytes = estimate(item)
+                except Exception:
+                    # the error is raised again by the reader, when the item is consumed
+                    nbytes = 0
+                if not budget.acquire(nbytes):
+                    break
+                pending.put((item, executor.submit(load, item), nbytes))
+        finally:
+            pending.put(None)
+
+    dispatcher = threading.Thread(target=dispatch, daemon=True)
+    dispatcher.start()
+    try:
+        while True:
+            entry = pending.get()
+            if entry is None:
+                break
+            item, future, nbytes = entry
+            try:
+                yield function(item, future.result())
+            finally:
+                budget.release(nbytes)
+    finally:
+        budget.close()
+        dispatcher.join()
+        executor.shutdown(cancel_futures=True)
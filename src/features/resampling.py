@@ -0,0 +1,165 @@
+# harmonization of the voxel spacing: image/label pairs are resampled to a common spacing, and the resampled volumes
+# are kept in a content-addressed cache
+import SimpleITK as sitk
+import hashlib
+import json
+import os
+from feature_cache import file_hash
+
+# interpolators that can be selected for images and label maps
+INTERPOLATORS = {
+    "linear": sitk.sitkLinear,
+    "nearest": sitk.sitkNearestNeighbor,
+    "gaussian": sitk.sitkLabelGaussian,
+}
+
+
+def resample(image, spacing, interpolator="linear"):
+    """Resample an image to a voxel spacing, on all threads SimpleITK may use.
+    The resampled image covers the same physical extent, with the same origin and direction. Integer images are
+    interpolated in float and rounded back to their pixel type.
+    Parameters:
+    image (SimpleITK.Image): image or label map
+    spacing (tuple(float)): target spacing in mm, in SimpleITK (x, y, z) order
+    interpolator (str): name of the interpolator, see INTERPOLATORS
+    Returns:
+    SimpleITK.Image: the resampled image
+    """
+    size = [max(1, int(round(n * s / t))) for n, s, t in zip(image.GetSize(), image.GetSpacing(), spacing)]
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetOutputSpacing([float(s) for s in spacing])
+    resampler.SetSize(size)
+    resampler.SetOutputOrigin(image.GetOrigin())
+    resampler.SetOutputDirection(image.GetDirection())
+    resampler.SetInterpolator(INTERPOLATORS[interpolator])
+    if interpolator != "linear":
+        return resampler.Execute(image)
+
+    # voxels outside of the source get its minimum, i.e. air for CT
+    minimum_maximum = sitk.MinimumMaximumImageFilter()
+    minimum_maximum.Execute(image)
+    resampler.SetDefaultPixelValue(minimum_maximum.GetMinimum())
+    integer = image.GetPixelID() not in (sitk.sitkFloat32, sitk.sitkFloat64)
+    if integer:
+        resampler.SetOutputPixelType(sitk.sitkFloat32)
+    resampled = resampler.Execute(image)
+    return sitk.Cast(sitk.Round(resampled), image.GetPixelID()) if integer else resampled
+
+
+class ResampleCache:
+    """Cache of resampled volumes, stored as uncompressed NIfTI files.
+    An entry is addressed by the content hash of its source file, the target spacing and the interpolator, so renamed
+    or copied sources and the same volume in several datasets share their entries. The content hash of a source is
+    only computed again when its size or modification time changes. If the cache grows beyond its size cap, the
+    least recently used entries are evicted.
+    """
+
+    # file of the content hashes of the sources, by path
+    SOURCES_FILE = "sources.json"
+
+    def __init__(self, root, max_bytes=20 * 2 ** 30):
+        """
+        Parameters:
+        root (str): directory of the cache, it is created if it does not exist
+        max_bytes (int): size cap of the cache in bytes
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.sources = {}
+        sources_file = os.path.join(root, self.SOURCES_FILE)
+        if os.path.exists(sources_file):
+            with open(sources_file) as f:
+                self.sources = json.load(f)
+        self.evict()
+
+    def source_hash(self, path):
+        """Content hash of a source file, reused as long as its size and modification time do not change.
+        Parameters:
+        path (str): path to the source
+        Returns:
+        str: hex digest of the content
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.sources.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": file_hash(path)}
+            self.sources[path] = entry
+            self.save()
+        return entry["hash"]
+
+    def save(self):
+        sources_file = os.path.join(self.root, self.SOURCES_FILE)
+        with open(sources_file + ".tmp", 'w') as f:
+            json.dump(self.sources, f)
+        os.replace(sources_file + ".tmp", sources_file)
+
+    def get(self, path, spacing, interpolator="linear"):
+        """Path to the resampled volume, which is resampled only if it is not cached yet.
+        Parameters:
+        path (str): path to the source volume
+        spacing (tuple(float)): target spacing in mm, in (x, y, z) order
+        interpolator (str): name of the interpolator, see INTERPOLATORS
+        Returns:
+        str: path to the resampled volume in the cache
+        """
+        key = json.dumps([self.source_hash(path), [round(float(s), 6) for s in spacing], interpolator])
+        entry = os.path.join(self.root, hashlib.sha1(key.encode()).hexdigest() + ".nii")
+        if os.path.exists(entry):
+            # the modification time marks the last access
+            os.utime(entry)
+            return entry
+
+        # write to a temporary file first, so that a partial entry is never used
+        tmp_file = entry[:-len(".nii")] + ".%d.tmp.nii" % os.getpid()
+        sitk.WriteImage(resample(sitk.ReadImage(path), spacing, interpolator), tmp_file)
+        os.replace(tmp_file, entry)
+        self.evict(keep=entry)
+        return entry
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache is within its size cap.
+        Parameters:
+        keep (str): entry that must not be evicted
+        """
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".nii") and ".tmp" not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, entry.path, stat.st_size))
+
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+
+def resample_cases(cases, cache, spacing, label_interpolator="nearest", lung_labels=None):
+    """Resample the image/label pairs of a dataset to a common spacing.
+    Parameters:
+    cases (list((str, str))): image/label pairs
+    cache (ResampleCache): cache of the resampled volumes
+    spacing (tuple(float)): target spacing in mm, in (x, y, z) order
+    label_interpolator (str): "nearest" or "gaussian" (label Gaussian) interpolation of the label maps and lung masks,
+        images are interpolated linearly
+    lung_labels (dict((str, str), str)): path to the lung mask of each image/label pair, see
+        extract_features.lung_label_files()
+    Returns:
+    (list((str, str)), dict((str, str), str)): the resampled image/label pairs, and the resampled lung mask of each
+        resampled pair. Identical label maps share their resampled file, so the masks are looked up by the pair
+    """
+    resampled_cases = []
+    resampled_lung_labels = {}
+    for ctr, (image_file, label_file) in enumerate(cases, 1):
+        print('Resampling ', ctr)
+        resampled_case = (cache.get(image_file, spacing, "linear"), cache.get(label_file, spacing, label_interpolator))
+        resampled_cases.append(resampled_case)
+        if lung_labels is not None and (image_file, label_file) in lung_labels:
+            resampled_lung_labels[resampled_case] = cache.get(lung_labels[(image_file, label_file)], spacing,
+                                                              label_interpolator)
+    return resampled_cases, resampled_lung_labels
@@ -0,0 +1,414 @@
+# streaming, mergeable statistics of the per-case features
+import numpy as np
+import argparse
+import json
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch (a deterministic variant of the KLL compactor hierarchy).
+    Values are buffered in levels, a value at level i stands for 2^i input values. Whenever a level holds more than
+    k values, it is sorted and every second value is promoted to the next level. As long as no more than k values were
+    added, the quantiles are exact.
+    Every level keeps all its capacity, so the sketch of n values holds at most k values on each of its
+    log2(n / k) + 1 levels, i.e. O(k log(n / k)) values per dimension (at most about 3300 for k=256 and a million values).
+    A compaction at level i moves the rank of a value by at most 2^i, which bounds the rank error of a quantile by
+    (n / k) * (log2(n / k) + 1) values, however the sketches were merged.
+    """
+
+    def __init__(self, k=256):
+        """
+        Parameters:
+        k (int): maximum number of values per level
+        """
+        self.k = k
+        self.levels = []
+        self.compactions = 0
+
+    def update(self, values):
+        """Add a batch of values.
+        Parameters:
+        values (numpy.ndarray): array of shape (n, d), one row per value
+        """
+        self._add(0, values)
+        self._compress()
+
+    def merge(self, other):
+        """Add all values of another sketch.
+        Parameters:
+        other (QuantileSketch): sketch with values of the same dimension
+        """
+        for level, values in enumerate(other.levels):
+            self._add(level, values)
+        self._compress()
+
+    def _add(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(None)
+        if self.levels[level] is None:
+            self.levels[level] = np.array(values, dtype=float)
+        else:
+            self.levels[level] = np.concatenate([self.levels[level], values])
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if values is not None and len(values) > self.k:
+                # every dimension is compacted independently
+                values = np.sort(values, axis=0)
+                # an odd value stays at its level, so the total weight is preserved
+                keep = values[-1:] if len(values) % 2 else values[:0]
+                values = values[:len(values) - len(keep)]
+                # alternate between the even and odd values to not bias the sketch
+                offset = self.compactions % 2
+                self.compactions += 1
+                self.levels[level] = keep
+                self._add(level + 1, values[offset::2])
+            level += 1
+
+    def quantile(self, q):
+        """Approximate quantile of each dimension.
+        Parameters:
+        q (float or list(float)): quantile(s) between 0 and 1
+        Returns:
+        numpy.ndarray: quantiles of shape (len(q), d), or (d,) for a single q
+        """
+        levels = [(values, 2 ** level) for level, values in enumerate(self.levels)
+                  if values is not None and len(values)]
+        if not levels:
+            return None
+
+        values = np.concatenate([values for values, _ in levels])
+        weights = np.concatenate([np.full(len(values), weight, dtype=float) for values, weight in levels])
+        order = np.argsort(values, axis=0)
+        sorted_values = np.take_along_axis(values, order, axis=0)
+        cumulative = np.cumsum(weights[order], axis=0)
+        # position of each value in the (weighted) sorted sequence, scaled to [0, 1]
+        positions = (cumulative - weights[order] / 2) / cumulative[-1]
+
+        qs = np.atleast_1d(q)
+        result = np.array([[np.interp(x, positions[:, d], sorted_values[:, d]) for d in range(values.shape[1])]
+                           for x in qs])
+        return result if np.ndim(q) else result[0]
+
+    def to_dict(self):
+        return {"k": self.k, "compactions": self.compactions,
+                "levels": [None if values is None else values.tolist() for values in self.levels]}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["k"])
+        sketch.compactions = state["compactions"]
+        sketch.levels = [None if values is None else np.array(values, dtype=float) for values in state["levels"]]
+        # empty levels are stored without their dimension
+        dimension = max([values.shape[1] for values in sketch.levels if values is not None and values.ndim == 2],
+                        default=0)
+        sketch.levels = [values.reshape(-1, dimension) if values is not None and len(values) == 0 else values
+                         for values in sketch.levels]
+        return sketch
+
+
+class RunningStatistics:
+    """Streaming statistics of a scalar or vector valued feature.
+    Keeps count, sum and sum of squares, minimum, maximum and a quantile sketch. The sums are exact (integer
+    multiples of the smallest float), so two instances are merged without any rounding: statistics of several workers,
+    shards or runs give the same count, mean, standard deviation, minimum and maximum as a single pass over all values,
+    in any order, without keeping the raw values.
+    """
+
+    # the sums are kept as integer multiples of 2^-EXPONENT, the smallest positive float, and its square
+    EXPONENT = 1074
+
+    def __init__(self, sketch_size=256):
+        """
+        Parameters:
+        sketch_size (int): number of values per level of the quantile sketch
+        """
+        self.count = 0
+        self.sum = None
+        self.sum_squares = None
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(sketch_size)
+
+    @classmethod
+    def _exact(cls, x):
+        # numerator of each (finite) value and of its square, the denominators are powers of two
+        numerators = []
+        for value in x.tolist():
+            numerator, denominator = value.as_integer_ratio()
+            numerators.append(numerator * ((1 << cls.EXPONENT) // denominator))
+        return numerators, [numerator * numerator for numerator in numerators]
+
+    def update(self, value):
+        """Add the value of one case.
+        Parameters:
+        value (float or list(float)): feature value, all values need to have the same dimension
+        """
+        x = np.atleast_1d(np.asarray(value, dtype=float))
+        sums, sum_squares = self._exact(x)
+        self.count += 1
+        if self.count == 1:
+            self.sum, self.sum_squares = sums, sum_squares
+            self.min = x.copy()
+            self.max = x.copy()
+        else:
+            self.sum = [a + b for a, b in zip(self.sum, sums)]
+            self.sum_squares = [a + b for a, b in zip(self.sum_squares, sum_squares)]
+            self.min = np.minimum(self.min, x)
+            self.max = np.maximum(self.max, x)
+        self.sketch.update(x[np.newaxis])
+
+    def merge(self, other):
+        """Add all values of another instance.
+        Parameters:
+        other (RunningStatistics): statistics of the same feature
+        Returns:
+        RunningStatistics: self
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.sum, self.sum_squares = list(other.sum), list(other.sum_squares)
+            self.min, self.max = other.min.copy(), other.max.copy()
+        else:
+            self.sum = [a + b for a, b in zip(self.sum, other.sum)]
+            self.sum_squares = [a + b for a, b in zip(self.sum_squares, other.sum_squares)]
+            self.min = np.minimum(self.min, other.min)
+            self.max = np.maximum(self.max, other.max)
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+        return self
+
+    def _value(self, x):
+        # scalar features are also reported as scalars
+        return x[0] if x is not None and len(x) == 1 else x
+
+    def get_mean(self):
+        if self.count == 0:
+            return None
+        # integer division rounds correctly, so the mean is the float nearest to the exact mean
+        return self._value(np.array([total / (self.count << self.EXPONENT) for total in self.sum]))
+
+    def get_std(self):
+        """Population standard deviation (like numpy.std)"""
+        if self.count == 0:
+            return None
+        # count^2 * variance, scaled like the sum of squares
+        m2 = [self.count * squares - total * total for total, squares in zip(self.sum, self.sum_squares)]
+        return self._value(np.sqrt([x / (self.count * self.count << 2 * self.EXPONENT) for x in m2]))
+
+    def get_min(self):
+        return self._value(self.min)
+
+    def get_max(self):
+        return self._value(self.max)
+
+    def get_quantile(self, q):
+        quantiles = self.sketch.quantile(q)
+        return quantiles if np.ndim(q) else self._value(quantiles)
+
+    def to_dict(self):
+        def to_list(x):
+            return None if x is None else x.tolist()
+        def to_strings(x):
+            # json numbers are read as floats by many parsers, the exact sums are stored as strings
+            return None if x is None else [str(value) for value in x]
+        return {"count": self.count, "sum": to_strings(self.sum), "sum_squares": to_strings(self.sum_squares),
+                "min": to_list(self.min), "max": to_list(self.max), "sketch": self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state):
+        def to_array(x):
+            return None if x is None else np.array(x, dtype=float)
+
+        def to_integers(x):
+            return None if x is None else [int(value) for value in x]
+        statistics = cls()
+        statistics.count = state["count"]
+        statistics.sum, statistics.sum_squares = to_integers(state["sum"]), to_integers(state["sum_squares"])
+        statistics.min, statistics.max = to_array(state["min"]), to_array(state["max"])
+        statistics.sketch = QuantileSketch.from_dict(state["sketch"])
+        return statistics
+
+
+class IntensityHistogram:
+    """Mergeable histogram of intensities with fixed bins of width one over the Hounsfield range (or another range,
+    e.g. the gray values of 16-bit slices). Values outside the range are counted in the first or last bin. Mean, std
+    and percentiles are derived from the histogram, so no voxels need to be kept, and histograms of several cases or
+    datasets are merged by adding their counts.
+    """
+
+    # default range of the bins in HU, the bins are centered on the integers from MIN to MAX
+    MIN = -1024
+    MAX = 3071
+
+    def __init__(self, counts=None, minimum=None, maximum=None):
+        """
+        Parameters:
+        counts (list(int)): counts of the bins, an empty histogram if not given
+        minimum (int): center of the first bin, MIN if not given
+        maximum (int): center of the last bin, MAX if not given
+        """
+        self.minimum = self.MIN if minimum is None else int(minimum)
+        self.maximum = self.MAX if maximum is None else int(maximum)
+        nr_bins = self.maximum - self.minimum + 1
+        self.counts = np.zeros(nr_bins, dtype=np.int64) if counts is None else np.array(counts, dtype=np.int64)
+        self.centers = np.arange(self.minimum, self.maximum + 1, dtype=float)
+
+    @classmethod
+    def bin_indices(cls, values, minimum=None, maximum=None):
+        """Bin index of each value, computed without a float copy for integer inputs.
+        Parameters:
+        values (numpy.ndarray): intensities
+        minimum (int): center of the first bin, MIN if not given
+        maximum (int): center of the last bin, MAX if not given
+        Returns:
+        numpy.ndarray: bin indices with the same shape as values
+        """
+        minimum = cls.MIN if minimum is None else minimum
+        maximum = cls.MAX if maximum is None else maximum
+        if np.issubdtype(values.dtype, np.floating):
+            values = np.clip(np.rint(values), minimum, maximum)
+        else:
+            # the bounds have to be representable in the integer type of the values
+            info = np.iinfo(values.dtype)
+            values = np.clip(values, max(minimum, info.min), min(maximum, info.max))
+        return (values.astype(np.int32) - minimum).ravel()
+
+    def resized(self, minimum, maximum):
+        """Histogram with another range, with the counts of this one.
+        Parameters:
+        minimum (int): center of the first bin, it must not be above the one of this histogram
+        maximum (int): center of the last bin, it must not be below the one of this histogram
+        Returns:
+        IntensityHistogram: the histogram with the new range
+        """
+        resized = IntensityHistogram(minimum=minimum, maximum=maximum)
+        start = self.minimum - resized.minimum
+        resized.counts[start:start + len(self.counts)] = self.counts
+        return resized
+
+    def update(self, values):
+        """Add a chunk of intensities.
+        Parameters:
+        values (numpy.ndarray): intensities
+        """
+        self.counts += np.bincount(self.bin_indices(values, self.minimum, self.maximum), minlength=len(self.counts))
+
+    def merge(self, other):
+        """Add the counts of another histogram. If the ranges differ, the range grows to cover both.
+        Parameters:
+        other (IntensityHistogram): histogram to add
+        Returns:
+        IntensityHistogram: self
+        """
+        if (other.minimum, other.maximum) != (self.minimum, self.maximum):
+            minimum, maximum = min(self.minimum, other.minimum), max(self.maximum, other.maximum)
+            resized = self.resized(minimum, maximum)
+            self.minimum, self.maximum, self.counts, self.centers = minimum, maximum, resized.counts, resized.centers
+            other = other.resized(minimum, maximum)
+        self.counts += other.counts
+        return self
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def get_mean(self):
+        if self.count == 0:
+            return None
+        return float(np.dot(self.counts, self.centers) / self.count)
+
+    def get_std(self):
+        """Population standard deviation of the binned intensities"""
+        if self.count == 0:
+            return None
+        return float(np.sqrt(np.dot(self.counts, (self.centers - self.get_mean()) ** 2) / self.count))
+
+    def get_min(self):
+        return self.get_quantile(0)
+
+    def get_max(self):
+        return self.get_quantile(1)
+
+    def get_quantile(self, q):
+        """Quantile of the binned intensities (lower value, like numpy.quantile(method='lower')).
+        Parameters:
+        q (float or list(float)): quantile(s) between 0 and 1
+        Returns:
+        float or numpy.ndarray: quantile(s) in HU
+        """
+        if self.count == 0:
+            return None
+        cumulative = np.cumsum(self.counts)
+        ranks = np.floor(np.asarray(q, dtype=float) * (self.count - 1))
+        quantiles = self.centers[np.searchsorted(cumulative, ranks, side='right')]
+        return quantiles if np.ndim(q) else float(quantiles)
+
+    def to_dict(self):
+        return {"type": "histogram", "counts": self.counts.tolist(), "min": self.minimum, "max": self.maximum}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state["counts"], state.get("min"), state.get("max"))
+
+
+def save_statistics(statistics, path):
+    """Store the state of several statistics in a json file.
+    Parameters:
+    statistics (dict(str, RunningStatistics or IntensityHistogram)): statistics per feature
+    path (str): path to the json file
+    """
+    with open(path, 'w') as f:
+        json.dump({name: s.to_dict() for name, s in statistics.items()}, f)
+
+
+def load_statistics(path):
+    """Load statistics stored with save_statistics().
+    Parameters:
+    path (str): path to the json file
+    Returns:
+    dict(str, RunningStatistics or IntensityHistogram): statistics per feature
+    """
+    with open(path) as f:
+        return {name: (IntensityHistogram if state.get("type") == "histogram" else RunningStatistics).from_dict(state)
+                for name, state in json.load(f).items()}
+
+
+def merge_statistics(*statistics):
+    """Merge the statistics of several runs feature by feature.
+    Parameters:
+    statistics (dict(str, RunningStatistics)): statistics per feature of each run
+    Returns:
+    dict(str, RunningStatistics): merged statistics per feature
+    """
+    merged = {}
+    for run in statistics:
+        for name, s in run.items():
+            if name not in merged:
+                merged[name] = IntensityHistogram() if isinstance(s, IntensityHistogram) else RunningStatistics(s.sketch.k)
+            merged[name].merge(s)
+    return merged
+
+
+def main():
+    # ARGUMENT PARSING
+    parser = argparse.ArgumentParser(description='Merge statistics stored by extract_features.py')
+
+    parser.add_argument('paths', type=str, nargs='+', help='json files with the statistics of each run')
+    parser.add_argument('-o', '--output', type=str, help='store the merged statistics in this json file')
+
+    args = parser.parse_args()
+
+    merged = merge_statistics(*[load_statistics(path) for path in args.paths])
+    for name, s in merged.items():
+        print(name, "- mean: ", s.get_mean(), " - std: ", s.get_std(), " - min: ", s.get_min(),
+              " - median: ", s.get_quantile(0.5), " - max: ", s.get_max(), " - n: ", s.count)
+
+    if args.output is not None:
+        save_statistics(merged, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# out-of-core connected component labeling: the label map is processed in slabs along the z axis
+from skimage.measure import label
+import numpy as np
+import SimpleITK as sitk
+import gzip
+import struct
+
+# numpy dtype of each NIfTI-1 datatype code
+NIFTI_DTYPES = {2: "u1", 4: "i2", 8: "i4", 16: "f4", 64: "f8", 256: "i1", 512: "u2", 768: "u4", 1024: "i8",
+                1280: "u8"}
+
+# estimated number of bytes per voxel for the int64 label output of a slab and the working copies of label()
+LABEL_BYTES_PER_VOXEL = 16
+
+
+class ArraySlabSource:
+    """Slab source of an array that is already in memory or memory-mapped (numpy.memmap, numpy.load(mmap_mode='r'))"""
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def iter_slabs(self, thickness):
+        for z in range(0, self.shape[0], thickness):
+            yield np.asarray(self.array[z:z + thickness])
+
+
+class NiftiSlabSource:
+    """Slab source of a (gzipped) NIfTI-1 file.
+    The voxel data is stored with x running fastest, so every z plane is a contiguous block of the file. The file is
+    decompressed in a single sequential pass and only one slab is held in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._open() as f:
+            header = f.read(348)
+
+        # the byte order is given by the size of the header, which has to be 348
+        endian = "<" if struct.unpack("<i", header[:4])[0] == 348 else ">"
+        if struct.unpack(endian + "i", header[:4])[0] != 348 or header[344:347] not in (b"n+1", b"ni1"):
+            raise ValueError("%s is not a NIfTI-1 file" % path)
+
+        dim = struct.unpack(endian + "8h", header[40:56])
+        datatype = struct.unpack(endian + "h", header[70:72])[0]
+        if dim[0] < 3 or any(d > 1 for d in dim[4:dim[0] + 1]) or datatype not in NIFTI_DTYPES:
+            raise ValueError("%s is not a scalar 3D NIfTI-1 volume" % path)
+
+        self.offset = int(struct.unpack(endian + "f", header[108:112])[0])
+        self.shape = (dim[3], dim[2], dim[1])
+        self.file_dtype = np.dtype(endian + NIFTI_DTYPES[datatype])
+        self.dtype = self.file_dtype
+
+        # like SimpleITK, scaled voxel values (e.g. CT stored with an intercept) are returned as float32
+        slope, intercept = struct.unpack(endian + "2f", header[112:120])
+        self.scaling = None
+        if slope != 0 and (slope, intercept) != (1, 0):
+            self.scaling = (np.float32(slope), np.float32(intercept))
+            self.dtype = np.dtype(np.float32)
+
+    def _open(self):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, 'rb')
+        return open(self.path, 'rb')
+
+    def iter_slabs(self, thickness):
+        plane_bytes = self.shape[1] * self.shape[2] * self.file_dtype.itemsize
+        with self._open() as f:
+            f.read(self.offset)
+            for z in range(0, self.shape[0], thickness):
+                n = min(thickness, self.shape[0] - z)
+                buffer = f.read(n * plane_bytes)
+                if len(buffer) != n * plane_bytes:
+                    raise EOFError("%s is truncated" % self.path)
+                slab = np.frombuffer(buffer, dtype=self.file_dtype).reshape((n,) + self.shape[1:])
+                if self.scaling is not None:
+                    slab = slab.astype(np.float32) * self.scaling[0] + self.scaling[1]
+                yield slab
+
+
+class SitkSlabSource:
+    """Slab source of any 3D image format SimpleITK can read, using region reads (ImageFileReader extraction)"""
+
+    def __init__(self, path):
+        self.reader = sitk.ImageFileReader()
+        self.reader.SetFileName(path)
+        self.reader.ReadImageInformation()
+        self.shape = tuple(reversed(self.reader.GetSize()))
+        self.dtype = np.dtype(sitk.GetArrayFromImage(sitk.Image([1] * 3, self.reader.GetPixelID())).dtype)
+
+    def iter_slabs(self, thickness):
+        for z in range(0, self.shape[0], thickness):
+            n = min(thickness, self.shape[0] - z)
+            self.reader.SetExtractIndex([0, 0, z])
+            self.reader.SetExtractSize([self.shape[2], self.shape[1], n])
+            yield sitk.GetArrayFromImage(self.reader.Execute())
+
+
+def open_slab_source(source):
+    """Open a volume (label map or image) as slab source.
+    Parameters:
+    source (str or numpy.ndarray): path to the volume, or an (memory-mapped) array of shape (z, y, x)
+    Returns:
+    ArraySlabSource, NiftiSlabSource or SitkSlabSource: source that provides shape, dtype and iter_slabs(thickness)
+    """
+    if isinstance(source, np.ndarray):
+        return ArraySlabSource(source)
+    if source.endswith(".npy"):
+        return ArraySlabSource(np.load(source, mmap_mode='r'))
+    if source.endswith(".nii") or source.endswith(".nii.gz"):
+        try:
+            return NiftiSlabSource(source)
+        except ValueError:
+            pass
+    return SitkSlabSource(source)
+
+
+def slab_thickness(shape, dtype, memory_budget):
+    """Number of z planes per slab, such that a slab and its labeling fit into the memory budget.
+    Parameters:
+    shape (tuple(int)): shape (z, y, x) of the volume
+    dtype (numpy.dtype): dtype of the label map
+    memory_budget (int): memory budget in bytes
+    Returns:
+    int: slab thickness, at least one plane
+    """
+    plane_bytes = shape[1] * shape[2] * (2 * np.dtype(dtype).itemsize + LABEL_BYTES_PER_VOXEL)
+    return int(max(1, min(shape[0], memory_budget // plane_bytes)))
+
+
+def plane_offsets(connectivity):
+    """In-plane offsets (dy, dx) of the neighbors in the adjacent z plane for the given connectivity.
+    Parameters:
+    connectivity (int): maximum number of orthogonal hops to consider a voxel a neighbor
+    Returns:
+    list((int, int)): offsets, one hop is already used for the step in z
+    """
+    return [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if abs(dy) + abs(dx) <= connectivity - 1]
+
+
+def boundary_edges(values_a, labels_a, values_b, labels_b, connectivity):
+    """Pairs of components that touch across the boundary of two adjacent planes.
+    Two voxels are only connected if they have the same (non-zero) label value, like in skimage.measure.label.
+    Parameters:
+    values_a, values_b (numpy.ndarray): label values of the last plane of a slab and the first plane of the next one
+    labels_a, labels_b (numpy.ndarray): component ids of these planes
+    connectivity (int): maximum number of orthogonal hops to consider a voxel a neighbor
+    Returns:
+    numpy.ndarray: unique pairs of component ids, shape (n, 2)
+    """
+    height, width = values_a.shape
+    edges = []
+    for dy, dx in plane_offsets(connectivity):
+        a = (slice(max(dy, 0), height + min(dy, 0)), slice(max(dx, 0), width + min(dx, 0)))
+        b = (slice(max(-dy, 0), height + min(-dy, 0)), slice(max(-dx, 0), width + min(-dx, 0)))
+        match = (values_a[a] == values_b[b]) & (values_a[a] != 0)
+        edges.append(np.stack([labels_a[a][match], labels_b[b][match]], axis=1))
+    return np.unique(np.concatenate(edges), axis=0)
+
+
+def count_merges(edges):
+    """Union-find over the component pairs that touch across slab boundaries.
+    Parameters:
+    edges (numpy.ndarray): pairs of component ids, shape (n, 2)
+    Returns:
+    int: number of unions, i.e. by how much the sum of the per-slab component counts overestimates the total
+    """
+    parent = {}
+
+    def find(x):
+        root = x
+        while parent.get(root, root) != root:
+            root = parent[root]
+        # path compression
+        while x != root:
+            parent[x], x = root, parent.get(x, x)
+        return root
+
+    merges = 0
+    for a, b in edges.tolist():
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+            merges += 1
+    return merges
+
+
+def connected_components_slabwise(source, connectivity=1, memory_budget=256 * 2 ** 20):
+    """Number of connected components of a label map, computed slab by slab.
+    Each slab is labeled in memory, and components that touch across the boundary of two slabs are merged with a
+    union-find. The result is the same as the component count of skimage.measure.label on the whole volume, but only
+    one slab, its labeling and the boundary plane of the previous slab are held in memory.
+    Parameters:
+    source (str or numpy.ndarray): path to the label map, or an (memory-mapped) array of shape (z, y, x)
+    connectivity (int): maximum number of orthogonal hops to consider a voxel a neighbor
+    memory_budget (int): memory budget in bytes for a slab and its labeling
+    Returns:
+    int: the number of connected components
+    """
+    source = open_slab_source(source)
+    thickness = slab_thickness(source.shape, source.dtype, memory_budget)
+
+    nr_components = 0
+    edges = []
+    previous_values, previous_labels = None, None
+    for slab in source.iter_slabs(thickness):
+        labeled_slab, nr_slab_components = label(slab, return_num=True, connectivity=connectivity)
+        # give the components of this slab ids that are unique across all slabs
+        labeled_slab[labeled_slab > 0] += nr_components
+        nr_components += nr_slab_components
+
+        if previous_values is not None:
+            edges.append(boundary_edges(previous_values, previous_labels, slab[0], labeled_slab[0], connectivity))
+        previous_values, previous_labels = slab[-1].copy(), labeled_slab[-1].copy()
+
+    if edges:
+        nr_components -= count_merges(np.unique(np.concatenate(edges), axis=0))
+    return nr_components
@@ -0,0 +1,223 @@
+# streaming statistics of large collections of 2D CT slices (PNG, TIFF, ...) with a metadata csv
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import SimpleITK as sitk
+import argparse
+import csv
+import os
+from extract_features import FEATURES
+from running_statistics import IntensityHistogram, RunningStatistics, save_statistics
+
+# columns of meta_data_covid.csv of the "Large COVID-19 CT scan slice dataset"
+FILE_COLUMN = "File name"
+PATIENT_COLUMN = "Patient ID"
+
+
+def read_metadata(path, chunk_size=256, encoding="windows-1252"):
+    """Read a metadata csv in chunks of rows, so that the whole table is never held in memory.
+    Parameters:
+    path (str): path to the csv file
+    chunk_size (int): number of rows per chunk
+    encoding (str): encoding of the csv file
+    Returns:
+    generator(list(dict)): chunks of rows, every row maps the column names to the values
+    """
+    with open(path, newline='', encoding=encoding) as f:
+        chunk = []
+        for row in csv.DictReader(f):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def index_files(root):
+    """Find all files below a directory, the slices of a collection are often split into several subdirectories.
+    Parameters:
+    root (str): directory of the slices
+    Returns:
+    dict(str, str): path of each file name
+    """
+    files = {}
+    directories = [root]
+    while directories:
+        with os.scandir(directories.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    directories.append(entry.path)
+                else:
+                    files[entry.name] = entry.path
+    return files
+
+
+def gray_value_range(dtype):
+    """Range of the gray value histogram of slices of a pixel type.
+    Parameters:
+    dtype (numpy.dtype): pixel type of the slices
+    Returns:
+    (int, int): the whole range of 8 and 16 bit pixel types (e.g. 0 to 65535 for 16-bit TIFF slices), the
+        Hounsfield range of IntensityHistogram otherwise
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "iu" and dtype.itemsize <= 2:
+        info = np.iinfo(dtype)
+        return int(info.min), int(info.max)
+    return IntensityHistogram.MIN, IntensityHistogram.MAX
+
+
+def decode_slice(path):
+    """Decode a slice and reduce it to the values needed for the statistics.
+    Colour images are converted to gray values by averaging their channels.
+    Parameters:
+    path (str): path to the slice
+    Returns:
+    (tuple(int), IntensityHistogram, int): size (x, y) of the slice, the histogram of its gray values over the range
+        of its pixel type, and the number of values outside of that range, which are counted in the first or last bin
+    """
+    image = sitk.ReadImage(path)
+    array = sitk.GetArrayViewFromImage(image)
+    minimum, maximum = gray_value_range(array.dtype)
+    if image.GetNumberOfComponentsPerPixel() > 1:
+        array = array.mean(axis=-1)
+    clipped = int(np.count_nonzero((array < minimum - 0.5) | (array >= maximum + 0.5))) if array.size else 0
+    histogram = IntensityHistogram(minimum=minimum, maximum=maximum)
+    histogram.update(array)
+    return image.GetSize()[:2], histogram, clipped
+
+
+def slice_statistics(metadata_file, image_path, workers=4, chunk_size=256, encoding="windows-1252",
+                     file_column=FILE_COLUMN, patient_column=PATIENT_COLUMN):
+    """Per-patient statistics of a slice collection, computed in a streaming way.
+    The csv is read in chunks, the slices of a chunk are decoded on a thread pool and immediately reduced, so only
+    one chunk of slices is in memory. Per patient, only the number of slices and the slice size are kept. The slices of
+    a patient form a pseudo-volume, whose resolution is (x, y, number of slices) like the one of a 3D volume. The
+    gray value histogram covers the range of the pixel types of the slices, see gray_value_range().
+    Parameters:
+    metadata_file (str): path to the metadata csv, with one row per slice
+    image_path (str): directory of the slices, they are searched by file name in all subdirectories
+    workers (int): number of threads decoding the slices
+    chunk_size (int): number of csv rows (slices) per chunk
+    encoding (str): encoding of the csv file
+    file_column (str): column with the file name of a slice
+    patient_column (str): column with the patient of a slice
+    Returns:
+    (dict(str, dict), IntensityHistogram, int): per patient the number of slices and their size, the histogram of the
+        gray values of all slices, and the number of slices that were not found
+    """
+    files = index_files(image_path)
+    patients = {}
+    histogram = None
+    missing = 0
+    clipped = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for chunk in read_metadata(metadata_file, chunk_size, encoding):
+            rows = [row for row in chunk if row[file_column] in files]
+            missing += len(chunk) - len(rows)
+            for row, (size, slice_histogram, slice_clipped) in zip(
+                    rows, executor.map(decode_slice, [files[row[file_column]] for row in rows])):
+                patient = patients.setdefault(row[patient_column], {"slices": 0, "size": size})
+                patient["slices"] += 1
+                # the histogram takes the range of the first slice, and grows if other slices have a wider one
+                histogram = slice_histogram if histogram is None else histogram.merge(slice_histogram)
+                clipped += slice_clipped
+                if tuple(patient["size"]) != tuple(size):
+                    # slices of different sizes cannot be stacked, report the largest one
+                    patient["size"] = tuple(np.maximum(patient["size"], size))
+    histogram = histogram if histogram is not None else IntensityHistogram()
+    if clipped:
+        # only slices of other pixel types than 8 and 16 bit integers are binned over the Hounsfield range
+        print(clipped, "gray values are outside of the range from", IntensityHistogram.MIN, "to",
+              IntensityHistogram.MAX, "and are counted in the first or last bin")
+    return patients, histogram, missing
+
+
+def count_slices(metadata_file, encoding="windows-1252", patient_column=PATIENT_COLUMN):
+    """Number of slices per patient, read from the metadata csv alone.
+    Parameters:
+    metadata_file (str): path to the metadata csv, with one row per slice
+    encoding (str): encoding of the csv file
+    patient_column (str): column with the patient of a slice
+    Returns:
+    dict(str, int): number of slices per patient
+    """
+    counts = {}
+    for chunk in read_metadata(metadata_file, encoding=encoding):
+        for row in chunk:
+            counts[row[patient_column]] = counts.get(row[patient_column], 0) + 1
+    return counts
+
+
+def aggregate_patients(patients, histogram):
+    """Dataset statistics of the per-patient results, with the names and report names of the 3D extractor.
+    Parameters:
+    patients (dict(str, dict)): number of slices and slice size per patient, see slice_statistics()
+    histogram (IntensityHistogram): histogram of the gray values of all slices
+    Returns:
+    (dict(str, RunningStatistics or IntensityHistogram), dict(str, str)): statistics and report name of each feature
+    """
+    resolution = RunningStatistics()
+    for patient in patients.values():
+        resolution.update(list(patient["size"]) + [patient["slices"]])
+    statistics = {"resolution": resolution, "intensity_global": histogram}
+    names = {"resolution": FEATURES["resolution"] + " (slices as z)", "intensity_global": "Gray value"}
+    return statistics, names
+
+
+def main():
+    # ARGUMENT PARSING
+    parser = argparse.ArgumentParser(description='Retrieve statistics about a collection of 2D slices')
+
+    parser.add_argument('-m', '--metadata', type=str, help='path to the metadata csv, one row per slice',
+                        required=True)
+    parser.add_argument('-p', '--path', type=str, help='directory of the slices')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of threads decoding the slices (default: 4)')
+    parser.add_argument('-cs', '--chunk_size', type=int, default=256,
+                        help='number of slices that are read and decoded at once (default: 256)')
+    parser.add_argument('--encoding', type=str, default="windows-1252",
+                        help='encoding of the csv file (default: windows-1252)')
+    parser.add_argument('--file_column', type=str, default=FILE_COLUMN,
+                        help='column of the file names (default: %s)' % FILE_COLUMN)
+    parser.add_argument('--patient_column', type=str, default=PATIENT_COLUMN,
+                        help='column of the patient ids (default: %s)' % PATIENT_COLUMN)
+    parser.add_argument('--min_slices', type=int,
+                        help='only list the patients with at least this number of slices, from the csv alone')
+    parser.add_argument('-s', '--statistics', type=str,
+                        help='store the mergeable statistics of each feature in this json file')
+
+    args = parser.parse_args()
+
+    if args.min_slices is not None:
+        counts = count_slices(args.metadata, args.encoding, args.patient_column)
+        selected = sorted(((n, p) for p, n in counts.items() if n >= args.min_slices), reverse=True)
+        print("Number of patients with at least", args.min_slices, "slices:", len(selected))
+        for n, patient in selected:
+            print("  ", patient, n)
+        return
+
+    if args.path is None:
+        parser.error("--path is required to decode the slices")
+
+    patients, histogram, missing = slice_statistics(args.metadata, args.path, args.workers, args.chunk_size,
+                                                    args.encoding, args.file_column, args.patient_column)
+    if missing:
+        print(missing, "slices of the csv were not found and are skipped")
+    print(len(patients), "patients,", sum(patient["slices"] for patient in patients.values()), "slices")
+
+    statistics, names = aggregate_patients(patients, histogram)
+    for key, s in statistics.items():
+        if isinstance(s, IntensityHistogram):
+            print(names[key], "- mean: ", s.get_mean(), " - std: ", s.get_std(),
+                  " - percentiles (5, 25, 50, 75, 95): ", s.get_quantile([0.05, 0.25, 0.5, 0.75, 0.95]))
+        else:
+            print(names[key], "- mean: ", s.get_mean(), " - std: ", s.get_std())
+
+    if args.statistics is not None:
+        save_statistics(statistics, args.statistics)
+
+
+if __name__ == '__main__':
+    main()
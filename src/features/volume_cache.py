@@ -0,0 +1,110 @@
+# opt-in cache of decompressed volumes as memory-mappable .npy files, so the gzip decoding is only paid once
+import numpy as np
+import SimpleITK as sitk
+import hashlib
+import json
+import os
+
+
+class VolumeCache:
+    """Cache that stores the voxel data of each volume as uncompressed .npy file, with its header metadata in a json
+    file beside it. Cached volumes are returned as read-only memory maps, so reading them costs no decoding and no
+    copy. An entry is invalidated when the size or modification time of its source file changes. If the cache grows
+    beyond its size cap, the least recently used entries are evicted.
+    """
+
+    def __init__(self, root, max_bytes=20 * 2 ** 30):
+        """
+        Parameters:
+        root (str): directory of the cache, it is created if it does not exist
+        max_bytes (int): size cap of the cache in bytes
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        # the size cap might be lower than in the previous run
+        self.evict()
+
+    def _paths(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.root, key + ".npy"), os.path.join(self.root, key + ".json")
+
+    def _is_valid(self, path, metadata_file, array_file):
+        if not (os.path.exists(metadata_file) and os.path.exists(array_file)):
+            return False
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+        stat = os.stat(path)
+        return metadata["source_size"] == stat.st_size and metadata["source_mtime"] == stat.st_mtime_ns
+
+    def load(self, path):
+        """Voxel data and header metadata of a volume, decoded only if it is not cached yet.
+        Parameters:
+        path (str): path to the volume
+        Returns:
+        (numpy.memmap, dict): read-only voxel data of shape (z, y, x), and spacing, origin, direction and size
+        """
+        array_file, metadata_file = self._paths(path)
+        if not self._is_valid(path, metadata_file, array_file):
+            self._store(path, array_file, metadata_file)
+            self.evict(keep=metadata_file)
+        else:
+            # the modification time of the metadata file marks the last access
+            os.utime(metadata_file)
+
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+        return np.load(array_file, mmap_mode='r'), metadata
+
+    def _store(self, path, array_file, metadata_file):
+        stat = os.stat(path)
+        img = sitk.ReadImage(path)
+        metadata = {
+            "source": os.path.abspath(path),
+            "source_size": stat.st_size,
+            "source_mtime": stat.st_mtime_ns,
+            "spacing": list(img.GetSpacing()),
+            "origin": list(img.GetOrigin()),
+            "direction": list(img.GetDirection()),
+            "size": list(img.GetSize()),
+        }
+
+        # write to temporary files first, so that concurrent workers never see a partial entry
+        suffix = ".%d.tmp" % os.getpid()
+        with open(array_file + suffix, 'wb') as f:
+            np.save(f, sitk.GetArrayViewFromImage(img))
+        with open(metadata_file + suffix, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(array_file + suffix, array_file)
+        os.replace(metadata_file + suffix, metadata_file)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache is within its size cap.
+        Parameters:
+        keep (str): metadata file of an entry that must not be evicted
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if not entry.name.endswith(".json"):
+                continue
+            array_file = entry.path[:-len(".json")] + ".npy"
+            try:
+                size = entry.stat().st_size + os.path.getsize(array_file)
+                entries.append((entry.stat().st_mtime_ns, entry.path, array_file, size))
+            except FileNotFoundError:
+                # evicted by another worker in the meantime
+                continue
+            total += size
+
+        for _, metadata_file, array_file, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if metadata_file == keep:
+                continue
+            for file in (metadata_file, array_file):
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+            total -= size
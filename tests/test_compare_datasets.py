@@ -0,0 +1,85 @@
+import pathlib
+import sys
+import numpy as np
+import pytest
+from scipy.stats import ks_2samp, wasserstein_distance
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "features"))
+from compare_datasets import compare_datasets, pairwise_distances  # noqa: E402
+from test_manifest import make_dataset  # noqa: E402
+
+
+def test_pairwise_distances():
+    rng = np.random.default_rng(0)
+    samples = [[rng.normal(0, 1, 50), rng.normal(0.5, 2, 80), rng.integers(0, 3, 20).astype(float)],
+               [rng.exponential(1, 30), rng.exponential(3, 7), rng.uniform(0, 1, 200)],
+               [np.full(5, 2.0), np.full(9, 2.0), np.full(3, 4.0)]]
+    distances = pairwise_distances(samples)
+    for f, feature_samples in enumerate(samples):
+        for i, a in enumerate(feature_samples):
+            for j, b in enumerate(feature_samples):
+                assert np.isclose(distances["wasserstein"][f, i, j], wasserstein_distance(a, b))
+                assert np.isclose(distances["ks"][f, i, j], ks_2samp(a, b).statistic)
+                pooled_std = np.sqrt((np.var(a) + np.var(b)) / 2)
+                if pooled_std > 0:
+                    assert np.isclose(distances["smd"][f, i, j], (np.mean(a) - np.mean(b)) / pooled_std)
+    # constant features have a standardized mean difference only if their means are equal
+    assert distances["smd"][2, 0, 1] == 0
+    assert np.isnan(distances["smd"][2, 0, 2])
+
+
+def test_pairwise_distances_without_values():
+    with pytest.raises(ValueError):
+        pairwise_distances([])
+    with pytest.raises(ValueError):
+        pairwise_distances([[np.array([1.0, 2.0]), np.array([])]])
+
+
+def test_datasets_without_lung_masks(tmp_path):
+    paths = [str(tmp_path / "a"), str(tmp_path / "b")]
+    for path in paths:
+        make_dataset(path)
+    comparison = compare_datasets(paths, features=["lung"])
+    assert comparison["features"] == []
+    assert comparison["skipped"] == ["lung"]
+    assert comparison["distances"] == {"wasserstein": {}, "ks": {}, "smd": {}}
+
+    comparison = compare_datasets(paths, features=["voxel_spacing", "lung"])
+    assert comparison["features"] == ["voxel_spacing_x", "voxel_spacing_y", "voxel_spacing_z"]
+    assert np.allclose(comparison["distances"]["wasserstein"]["voxel_spacing_z"], 0)
+
+
+def test_dataset_without_lung_masks(tmp_path):
+    paths = [str(tmp_path / "without"), str(tmp_path / "with")]
+    make_dataset(paths[0])
+    make_dataset(paths[1], lung=True)
+    for order in [paths, paths[::-1]]:
+        comparison = compare_datasets(order, features=["lung"])
+        assert comparison["features"] == []
+        assert comparison["skipped"] == ["lung_fraction_total", "lung_components_total", "lung_fraction_1",
+                                         "lung_components_1"]
+
+
+def test_feature_store(tmp_path, capsys):
+    import os
+    import SimpleITK as sitk
+    paths = [str(tmp_path / "a" / "Task01"), str(tmp_path / "b" / "Task01")]
+    make_dataset(paths[0], nr_cases=2)
+    make_dataset(paths[1], nr_cases=3)
+    store = str(tmp_path / "store")
+
+    first = compare_datasets(paths, features=["voxel_spacing"], store=store)
+    assert first["numCases"] == [2, 3]
+    assert len(os.listdir(store)) == 2
+    again = compare_datasets(paths, features=["voxel_spacing"], store=store)
+    assert "2 of 2 datasets loaded from the feature store" in capsys.readouterr().out
+    assert again["numCases"] == [2, 3]
+
+    # a changed case makes the stored dataset stale
+    image_file = os.path.join(paths[1], "imagesTr", "case_0000.nii.gz")
+    image = sitk.ReadImage(image_file)
+    image.SetSpacing((1.0, 1.0, 2.0))
+    sitk.WriteImage(image, image_file)
+    changed = compare_datasets(paths, features=["voxel_spacing"], store=store)
+    assert "1 of 2 datasets loaded from the feature store" in capsys.readouterr().out
+    assert changed["summary"][1]["voxel_spacing_x"]["mean"] > first["summary"][1]["voxel_spacing_x"]["mean"]
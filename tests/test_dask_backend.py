@@ -0,0 +1,54 @@
+from functools import partial
+import pathlib
+import sys
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "features"))
+from dask_backend import make_client, submit_cases, tree_reduce  # noqa: E402
+from extract_features import aggregate_statistics, extract_case, list_cases  # noqa: E402
+from running_statistics import IntensityHistogram  # noqa: E402
+from test_manifest import make_dataset  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def client():
+    client = make_client(workers=2)
+    yield client
+    client.close()
+
+
+def test_tree_reduce(tmp_path, client):
+    path = str(tmp_path / "dataset")
+    make_dataset(path, nr_cases=7)
+    cases = list_cases(path)
+    rng = np.random.default_rng(0)
+    for i, (image_file, label_file) in enumerate(cases):
+        # spacings and volumes whose sums are rounded differently in another order
+        spacing = tuple(rng.uniform(0.3, 3, 3))
+        image = sitk.GetImageFromArray(rng.normal(0, 100, (4, 5, 6)).astype(np.int16))
+        image.SetSpacing(spacing)
+        sitk.WriteImage(image, image_file)
+        # label 2 only in some cases, and an empty label map
+        values = rng.integers(1, 3 if i % 3 else 2, (4, 5, 6)) * (rng.random((4, 5, 6)) < 0.1) * (i != 4)
+        labels = sitk.GetImageFromArray(values.astype(np.uint8))
+        labels.SetSpacing(spacing)
+        sitk.WriteImage(labels, label_file)
+
+    features = ["voxel_spacing", "resolution", "connected_components", "component_statistics", "intensity"]
+    expected, expected_names = aggregate_statistics([extract_case(*case, features) for case in cases], features)
+
+    futures = submit_cases(client, cases, partial(extract_case, features=features))
+    for partition_size, fan_in in [(1, 2), (2, 2), (3, 4), (16, 4)]:
+        statistics, names = tree_reduce(client, futures, features, partition_size, fan_in)
+        assert list(statistics) == list(expected) and names == expected_names
+        for key, s in statistics.items():
+            if isinstance(s, IntensityHistogram):
+                assert np.array_equal(s.counts, expected[key].counts)
+                continue
+            assert s.count == expected[key].count
+            for get in ["get_mean", "get_std", "get_min", "get_max"]:
+                assert np.array_equal(getattr(s, get)(), getattr(expected[key], get)())
+            # no feature has more values than the sketch holds, so the quantiles are exact
+            assert np.array_equal(s.get_quantile([0, 0.5, 1]), expected[key].get_quantile([0, 0.5, 1]))
@@ -0,0 +1,16 @@
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src"))
+from data.dataset import DecathlonDataset  # noqa: E402
+from test_manifest import make_dataset  # noqa: E402
+
+
+def test_relative_root(tmp_path, monkeypatch):
+    make_dataset(str(tmp_path / "dataset"))
+    monkeypatch.chdir(tmp_path)
+    dataset = DecathlonDataset("dataset", prefetch=0)
+    assert len(dataset) == 2
+    assert dataset[0].spacing == (0.5, 0.5, 2.0)
+    assert dataset[1].label_header["size"] == [6, 5, 4]
+    assert dataset[1].label.shape == (4, 5, 6)
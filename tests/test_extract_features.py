@@ -0,0 +1,92 @@
+import os
+import pathlib
+import sys
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "features"))
+import extract_features  # noqa: E402
+from extract_features import component_statistics, connected_components, extract_case, foreground_bounding_box, \
+    indexed_headers, list_cases, lung_label_files  # noqa: E402
+from data.manifest import load_manifest  # noqa: E402
+from test_manifest import make_dataset  # noqa: E402
+
+
+def test_indexed_headers(tmp_path, monkeypatch):
+    path = str(tmp_path / "dataset")
+    make_dataset(path)
+    manifest = load_manifest(path)
+    cases = list_cases(path, manifest)
+    headers = indexed_headers(manifest, cases)
+    assert sorted(headers) == sorted(image_file for image_file, _ in cases)
+
+    features = ["voxel_spacing", "resolution"]
+    expected = [extract_case(*case, features) for case in cases]
+
+    # the header features of indexed images are computed without reading the files
+    def read_image_information(path):
+        raise AssertionError("header of %s read from the file" % path)
+    monkeypatch.setattr(extract_features, "read_image_information", read_image_information)
+    assert [extract_case(*case, features, header=headers[case[0]]) for case in cases] == expected
+    assert extract_features.extract_features(cases, features=features, parameters={"headers": headers}) == expected
+
+    # a changed file is not indexed with its old header
+    os.utime(cases[0][0], ns=(0, 0))
+    assert cases[0][0] not in indexed_headers(load_manifest(path, headers=False), cases)
+    with pytest.raises(AssertionError):
+        extract_case(*cases[0], features)
+
+
+def roi_statistics(y, spacing, connectivity):
+    box = foreground_bounding_box(y)
+    crop = y[box]
+    return component_statistics(crop, spacing, connectivity, connected_components(crop, connectivity),
+                                [s.start for s in box])
+
+
+def test_component_statistics_of_roi():
+    rng = np.random.default_rng(0)
+    spacing = (0.5, 0.75, 2.0)
+    volumes = []
+    for density in [0.05, 0.3]:
+        y = ((rng.random((12, 10, 9)) < density) * rng.integers(1, 3, (12, 10, 9))).astype(np.uint8)
+        volumes.append(y)
+        # foreground in the middle only, the box has a margin on every side
+        inner = np.zeros_like(y)
+        inner[3:8, 2:7, 4:6] = y[3:8, 2:7, 4:6]
+        volumes.append(inner)
+    # components that touch the border of the volume, in every corner and along the faces
+    border = np.zeros((8, 7, 6), dtype=np.uint8)
+    border[0, 0, 0] = border[-1, -1, -1] = border[0, -1, 0] = 1
+    border[:, 3, -1] = 2
+    border[4, :, 0] = 2
+    volumes.append(border)
+
+    for y in volumes:
+        for connectivity in [1, 2, 3]:
+            expected = component_statistics(y, spacing, connectivity)
+            assert expected
+            assert roi_statistics(y, spacing, connectivity) == expected
+
+    # an empty label map has no components, with or without the box of a single voxel
+    empty = np.zeros((5, 4, 3), dtype=np.uint8)
+    assert component_statistics(empty, spacing) == roi_statistics(empty, spacing, 2) == {}
+
+
+def test_extract_case_with_roi(tmp_path):
+    path = str(tmp_path / "dataset")
+    make_dataset(path, lung=True)
+    cases = list_cases(path)
+    lung_labels = lung_label_files(path)
+    features = ["connected_components", "component_statistics", "lung"]
+
+    # the label map of the first case has components at its borders, the one of the second case is empty
+    y = np.zeros((4, 5, 6), dtype=np.uint8)
+    y[0, 0, 0] = y[-1, -1, -1] = 1
+    y[1:3, 2, -1] = 2
+    sitk.WriteImage(sitk.GetImageFromArray(y), cases[0][1])
+    results = [extract_case(*case, features, lung_labels=lung_labels) for case in cases]
+    assert results[0]["connected_components"] == 3
+    assert results[1]["connected_components"] == 0 and results[1]["component_statistics"] == {}
+    assert [extract_case(*case, features, lung_labels=lung_labels, roi=True) for case in cases] == results
@@ -0,0 +1,66 @@
+import json
+import os
+import pathlib
+import sys
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src"))
+from data.manifest import DatasetManifest, load_manifest  # noqa: E402
+
+
+def make_dataset(root, nr_cases=2, lung=False):
+    for directory in ("imagesTr", "labelsTr") + (("lungLabelsTr",) if lung else ()):
+        os.makedirs(os.path.join(root, directory))
+    training = []
+    for i in range(nr_cases):
+        name = "case_%04d.nii.gz" % i
+        image = sitk.GetImageFromArray(np.zeros((4, 5, 6), dtype=np.int16))
+        image.SetSpacing((0.5, 0.5, 2.0))
+        sitk.WriteImage(image, os.path.join(root, "imagesTr", name))
+        sitk.WriteImage(sitk.GetImageFromArray(np.zeros((4, 5, 6), dtype=np.uint8)), os.path.join(root, "labelsTr", name))
+        training.append({"image": "./imagesTr/" + name, "label": "./labelsTr/" + name})
+        if lung:
+            sitk.WriteImage(sitk.GetImageFromArray(np.ones((4, 5, 6), dtype=np.uint8)),
+                            os.path.join(root, "lungLabelsTr", name))
+            training[-1]["lungLabel"] = "./lungLabelsTr/" + name
+    with open(os.path.join(root, "dataset.json"), 'w') as f:
+        json.dump({"training": training}, f)
+
+
+def test_relative_root(tmp_path, monkeypatch):
+    make_dataset(str(tmp_path / "dataset"))
+    monkeypatch.chdir(tmp_path)
+    manifest = load_manifest("dataset")
+
+    # relative to the dataset directory, relative to the working directory and absolute
+    for path in ("./imagesTr/case_0000.nii.gz", os.path.join("dataset", "imagesTr", "case_0000.nii.gz"),
+                 str(tmp_path / "dataset" / "imagesTr" / "case_0000.nii.gz")):
+        assert manifest.entry(path) is not None
+        assert manifest.header(path)["spacing"] == [0.5, 0.5, 2.0]
+
+
+def test_relative_root_inside_dataset(tmp_path, monkeypatch):
+    make_dataset(str(tmp_path / "dataset"))
+    monkeypatch.chdir(tmp_path / "dataset" / "imagesTr")
+    manifest = load_manifest("..")
+    assert manifest.entry("imagesTr/case_0001.nii.gz") is not None
+    assert manifest.entry("../labelsTr/case_0001.nii.gz") is not None
+
+
+def test_list_cases_relative_root(tmp_path, monkeypatch):
+    sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "features"))
+    from extract_features import list_cases
+
+    make_dataset(str(tmp_path / "dataset"))
+    monkeypatch.chdir(tmp_path)
+    assert len(list_cases("dataset")) == 2
+
+
+def test_unwritable_index(tmp_path):
+    make_dataset(str(tmp_path / "dataset"))
+    manifest = DatasetManifest(str(tmp_path / "dataset"), path=str(tmp_path / "missing" / "dataset_index.json"))
+    manifest.update()
+    manifest.save()
+    assert manifest.changed
+    assert manifest.entry("./labelsTr/case_0000.nii.gz") is not None
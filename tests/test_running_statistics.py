@@ -0,0 +1,83 @@
+import pathlib
+import sys
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "features"))
+from running_statistics import IntensityHistogram, RunningStatistics, load_statistics, merge_statistics, \
+    save_statistics  # noqa: E402
+
+
+def test_histogram_custom_range():
+    histogram = IntensityHistogram(minimum=0, maximum=65535)
+    histogram.update(np.array([0, 1, 100], dtype=np.uint16))
+    assert histogram.counts[0] == 1 and histogram.counts[1] == 1 and histogram.counts[100] == 1
+    assert histogram.get_quantile(0) == 0.0
+    assert histogram.get_quantile(1) == 100.0
+
+    values = np.random.default_rng(0).integers(0, 65536, 10000).astype(np.uint16)
+    histogram = IntensityHistogram(minimum=0, maximum=65535)
+    histogram.update(values)
+    q = [0, 0.05, 0.25, 0.5, 0.75, 0.95, 1]
+    assert np.array_equal(histogram.get_quantile(q), np.quantile(values, q, method='lower'))
+    assert np.isclose(histogram.get_mean(), values.mean())
+
+
+def test_histogram_merge_of_ranges():
+    low = IntensityHistogram()
+    low.update(np.array([-1000.0, 0.0]))
+    high = IntensityHistogram(minimum=0, maximum=65535)
+    high.update(np.array([60000], dtype=np.uint16))
+    low.merge(high)
+    assert (low.minimum, low.maximum) == (-1024, 65535)
+    assert low.get_quantile([0, 0.5, 1]).tolist() == [-1000.0, 0.0, 60000.0]
+
+
+def test_merge_of_shards(tmp_path):
+    rng = np.random.default_rng(0)
+    # values of very different magnitude, where a different summation order changes the rounding
+    values = np.concatenate([rng.normal(1e6, 1e-3, 3000), rng.lognormal(0, 3, 3000), rng.integers(0, 10, 3000)])
+    values = rng.permutation(values)[:, np.newaxis] * [1, -1]
+    k = 64
+
+    single = RunningStatistics(k)
+    for value in values:
+        single.update(value)
+    assert np.allclose(single.get_mean(), values.mean(axis=0), rtol=1e-12)
+    assert np.allclose(single.get_std(), values.std(axis=0), rtol=1e-9)
+
+    for nr_shards in [2, 7, 50]:
+        shards = [RunningStatistics(k) for _ in range(nr_shards)]
+        for shard, shard_values in zip(shards, np.array_split(values, nr_shards)):
+            for value in shard_values:
+                shard.update(value)
+        # any merge order, and through the stored state
+        save_statistics({"x": shards[0]}, tmp_path / "shard.json")
+        shards[0] = load_statistics(tmp_path / "shard.json")["x"]
+        for merged in [merge_statistics(*[{"x": shard} for shard in shards])["x"],
+                       merge_statistics(*[{"x": shard} for shard in reversed(shards)])["x"]]:
+            assert merged.count == single.count
+            assert np.array_equal(merged.get_mean(), single.get_mean())
+            assert np.array_equal(merged.get_std(), single.get_std())
+            assert np.array_equal(merged.get_min(), values.min(axis=0))
+            assert np.array_equal(merged.get_max(), values.max(axis=0))
+
+            # the rank of each quantile is within the error bound of the sketch, plus the weight of one value of
+            # its highest level for the interpolation between two values
+            n = len(values)
+            bound = n / k * (np.log2(n / k) + 1) + 2 ** len(merged.sketch.levels)
+            assert sum(len(level) for level in merged.sketch.levels if level is not None) <= \
+                k * (np.log2(n / k) + 1)
+            q = np.linspace(0, 1, 21)
+            for d in range(values.shape[1]):
+                ranks = np.searchsorted(np.sort(values[:, d]), merged.get_quantile(q)[:, d])
+                assert np.all(np.abs(ranks - q * n) <= bound)
+
+
+def test_exact_quantiles_of_few_values():
+    values = np.arange(100.0)
+    shards = [RunningStatistics(), RunningStatistics()]
+    for value in values:
+        shards[int(value) % 2].update(value)
+    merged = shards[0].merge(shards[1])
+    assert merged.get_quantile(0) == 0 and merged.get_quantile(1) == 99
+    assert merged.get_mean() == 49.5 and merged.get_std() == values.std()
@@ -0,0 +1,37 @@
+import pathlib
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src" / "features"))
+from extract_features import connected_components  # noqa: E402
+from slab_labeling import LABEL_BYTES_PER_VOXEL, connected_components_slabwise, slab_thickness  # noqa: E402
+
+
+def budget(shape, dtype, thickness):
+    # memory budget that gives slabs of exactly the given number of planes
+    return thickness * shape[1] * shape[2] * (2 * np.dtype(dtype).itemsize + LABEL_BYTES_PER_VOXEL)
+
+
+@pytest.mark.parametrize("connectivity", [1, 2, 3])
+@pytest.mark.parametrize("thickness", [1, 2, 3, 7, 13])
+def test_slabwise_count(connectivity, thickness):
+    rng = np.random.default_rng(thickness * 10 + connectivity)
+    shape = (13, 9, 11)
+    for density in [0.1, 0.3, 0.5]:
+        # binary and multi-valued label maps, components of different values that touch stay separate
+        for nr_values in [1, 3]:
+            y = (rng.random(shape) < density) * rng.integers(1, nr_values + 1, shape)
+            y = y.astype(np.uint8)
+            memory_budget = budget(shape, y.dtype, thickness)
+            assert slab_thickness(shape, y.dtype, memory_budget) == thickness
+            expected = connected_components(y, connectivity)[1]
+            assert connected_components_slabwise(y, connectivity, memory_budget) == expected
+
+
+def test_slabwise_count_of_empty_and_full_volumes():
+    for y in [np.zeros((5, 4, 3), dtype=np.uint8), np.ones((5, 4, 3), dtype=np.uint8)]:
+        for connectivity in [1, 2, 3]:
+            memory_budget = budget(y.shape, y.dtype, 2)
+            assert connected_components_slabwise(y, connectivity, memory_budget) == connected_components(
+                y, connectivity)[1]